@@ -1,6 +1,6 @@
-from flask import Flask, request, render_template, redirect, url_for, session, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
-from db import create_user, get_user
+from flask import Flask, request, render_template, redirect, url_for, session, jsonify, Response, g
+from werkzeug.exceptions import HTTPException
+from db import create_user, get_user, update_user_password
 import secrets, time, os
 import config
 import requests
@@ -8,14 +8,30 @@ import requests
 # 🧩 إصلاح مهم جدًا لمسار قاعدة البيانات عند تشغيل SSL
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
-from db import init_db, list_vms, insert_vm, update_vm_fields, vm_by_serial, vm_by_name, delete_vm, activate_vm_by_serial
+from db import init_db, insert_vm, update_vm_fields, vm_by_serial, vm_by_name, delete_vm, activate_vm_by_serial
+from db import update_vm_statuses, renew_vm, on_expiry_change, list_vms_page, to_epoch
+from db import get_job, update_vms_bulk, vm_cache, upsert_host, transaction, renew_vms
+from db import vm_status_summary, vm_events_range, jobs_by_ids
+from expiry import ExpiryScheduler
+from jobs import JobQueue
+from metrics import registry, http_request_seconds, vbox_request_seconds, login_attempts
+from db import vm_status_counts, job_status_counts
+from writebehind import WriteBehindBuffer
+from sync import SyncEngine
+from leader import LeaderElection
+from hosts import HostRegistry, Fleet, PlacementError
+from warmpool import WarmPool
+from history import HistoryRollup
+from reports import fleet_report, vm_report
+import atexit, signal
+from events import hub, relay
+import json
 
 import requests
 import os
 VBOX_API = os.getenv("VBOX_API")
 
 import threading
-from db import list_vms, update_vm_fields
 import datetime
 
 app = Flask(__name__)
@@ -27,12 +43,65 @@ AUTO_POWER_OFF = True
 
 # ⬇️⬇️ رابر (طبقة) تتعامل مع VBOX_API بدل vbox_helper_full ⬇️⬇️
 import logging, sys
+import random
+from logsetup import setup_logging, bind_request_id, new_request_id, current_request_id, request_id_var
+from concurrent.futures import ThreadPoolExecutor
+from auth import PasswordHasher, HasherBusy
+from ratelimit import TokenBucketLimiter
+from vmcache import StatusCache
+from assets import StaticFingerprints, CompressedCache, COMPRESSIBLE, pick_encoding, compress
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# 📝 سجلات منظمة (JSON) عبر طابور وخيط كاتب خلفي — المستويات من config.py
+setup_logging()
+log = logging.getLogger("dz.app")
+http_log = logging.getLogger("dz.http")
+vbox_log = logging.getLogger("dz.vbox")
+sync_log = logging.getLogger("dz.sync")
 
 class VBoxRemote:
-    def __init__(self, base_url, token=None):
+    # ⏱️ مهلة (اتصال، قراءة) لكل نوع عملية: الحالة قصيرة، الإنشاء/الحذف طويلة
+    TIMEOUTS = {
+        "status": (config.VBOX_CONNECT_TIMEOUT, config.VBOX_STATUS_TIMEOUT),
+        "action": (config.VBOX_CONNECT_TIMEOUT, config.VBOX_ACTION_TIMEOUT),
+        "long": (config.VBOX_CONNECT_TIMEOUT, config.VBOX_LONG_TIMEOUT),
+    }
+    # 🔁 عدد المحاولات الإضافية لكل نوع (الإنشاء لا يُعاد لأنه غير آمن للتكرار)
+    RETRIES = {"status": 2, "action": 1, "long": 0}
+    RETRY_STATUS_CODES = (502, 503, 504)
+
+    def __init__(self, base_url, token=None, pool_size=None):
         self.base_url = base_url.rstrip("/")
         self.token = token  # ← إضافة التوكن
 
+        # 🔌 جلسة واحدة مع مجمع اتصالات محدود (keep-alive) بدل اتصال جديد لكل طلب
+        self._adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size or config.VBOX_POOL_SIZE,
+            pool_block=True,
+            max_retries=0,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+        self.session.headers.update(self._headers())
+        self.status_cache = StatusCache()
+
+        # 📊 عدادات + رصيد إعادة المحاولة (retry budget)
+        self._stats_lock = threading.Lock()
+        self._retry_tokens = config.VBOX_RETRY_BUDGET
+        self._bulk_supported = True
+        # 🚦 سقف الإجراءات المتزامنة على هذا الـ Agent (طلبات الحالة لها حدودها الخاصة)
+        self._action_slots = threading.BoundedSemaphore(config.VBOX_ACTION_CONCURRENCY)
+        self._counters = {
+            "requests": 0,
+            "failures": 0,
+            "retries": 0,
+            "retries_denied": 0,
+            "busy_rejected": 0,
+        }
+
     def _headers(self):
         """هيدر التوكن إذا موجود"""
         h = {}
@@ -40,41 +109,117 @@ class VBoxRemote:
             h["X-API-KEY"] = self.token
         return h
 
-    def _post(self, path, payload=None, timeout=30):
-        url = f"{self.base_url}{path}"
-        try:
-            r = requests.post(
-                url,
-                json=payload or {},
-                headers=self._headers(),  # ← إضافة الهيدر
-                timeout=timeout
-            )
-            r.raise_for_status()
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self._counters[key] += n
+
+    def _earn_retry_token(self):
+        with self._stats_lock:
+            self._retry_tokens = min(config.VBOX_RETRY_BUDGET,
+                                     self._retry_tokens + config.VBOX_RETRY_RATIO)
+
+    def _spend_retry_token(self):
+        """يسمح بإعادة المحاولة فقط إذا بقي رصيد، حتى لا يستهلك VBOX_API البطيء كل الخيوط"""
+        with self._stats_lock:
+            if self._retry_tokens >= 1:
+                self._retry_tokens -= 1
+                self._counters["retries"] += 1
+                return True
+            self._counters["retries_denied"] += 1
+            return False
+
+    @staticmethod
+    def _not_sent(exc):
+        """فشل في مرحلة فتح الاتصال (قبل إرسال أي بايت) → الـ Agent لم يستلم الطلب قطعًا"""
+        if isinstance(exc, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(exc.args[0], "reason", None) if exc.args else None
+        return isinstance(reason, NewConnectionError)
+
+    def _retryable(self, op, exc):
+        if isinstance(exc, requests.exceptions.ConnectionError):
+            # طلبات الحالة آمنة للتكرار دائمًا؛ أما الإجراءات (تشغيل/إيقاف/حذف/استنساخ) فقد تكون
+            # وصلت قبل انقطاع اتصال keep-alive → تُعاد فقط إذا فشل فتح الاتصال نفسه
+            return op == "status" or self._not_sent(exc)
+        # مهلة القراءة: نعيد فقط طلبات القراءة (الحالة)
+        if isinstance(exc, requests.exceptions.ReadTimeout):
+            return op == "status"
+        if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+            return exc.response.status_code in self.RETRY_STATUS_CODES
+        return False
+
+    def _request(self, method, path, op, **kwargs):
+        t0 = time.perf_counter()
+        if op == "status":
+            resp = self._send(method, path, op, **kwargs)
+        elif self._action_slots.acquire(timeout=config.VBOX_ACTION_WAIT):
             try:
-                return r.json()
-            except Exception:
-                return {"ok": False, "error": "bad_json", "raw": r.text}
-        except Exception as e:
-            print(f"[VBOX_API POST ERROR] {url} -> {e}")
-            return {"ok": False, "error": str(e)}
+                resp = self._send(method, path, op, **kwargs)
+            finally:
+                self._action_slots.release()
+        else:
+            self._count("busy_rejected")
+            resp = {"ok": False, "error": "agent busy"}
+        outcome = "error" if resp.get("ok") is False else "ok"
+        vbox_request_seconds.observe(time.perf_counter() - t0, op=path, outcome=outcome)
+        return resp
 
-    def _get(self, path, params=None, timeout=30):
+    def _send(self, method, path, op, **kwargs):
         url = f"{self.base_url}{path}"
-        try:
-            r = requests.get(
-                url,
-                params=params or {},
-                headers=self._headers(),  # ← إضافة الهيدر
-                timeout=timeout
-            )
-            r.raise_for_status()
+        attempts = 1 + self.RETRIES.get(op, 0)
+        for attempt in range(attempts):
+            self._count("requests")
             try:
-                return r.json()
-            except Exception:
-                return {"ok": False, "error": "bad_json", "raw": r.text}
-        except Exception as e:
-            print(f"[VBOX_API GET ERROR] {url} -> {e}")
-            return {"ok": False, "error": str(e)}
+                rid = current_request_id()
+                headers = {"X-Request-ID": rid} if rid else None
+                r = self.session.request(method, url, timeout=self.TIMEOUTS[op], headers=headers, **kwargs)
+                r.raise_for_status()
+                self._earn_retry_token()
+                try:
+                    return r.json()
+                except Exception:
+                    return {"ok": False, "error": "bad_json", "raw": r.text}
+            except Exception as e:
+                last_attempt = attempt + 1 >= attempts
+                if last_attempt or not self._retryable(op, e) or not self._spend_retry_token():
+                    self._count("failures")
+                    vbox_log.warning("VBOX_API call failed", extra={
+                        "method": method, "url": url, "op": op, "error": str(e)})
+                    err = {"ok": False, "error": str(e)}
+                    if getattr(e, "response", None) is not None:
+                        err["status_code"] = e.response.status_code
+                    return err
+                # ⏳ تراجع أسّي مع jitter كامل
+                time.sleep(random.uniform(0, config.VBOX_RETRY_BACKOFF * (2 ** attempt)))
+
+    def _post(self, path, payload=None, op="action"):
+        return self._request("POST", path, op, json=payload or {})
+
+    def _get(self, path, params=None, op="status"):
+        return self._request("GET", path, op, params=params or {})
+
+    @property
+    def bulk_supported(self):
+        return self._bulk_supported
+
+    def stats(self):
+        """عدادات المجمع وإعادة المحاولة (لقياس نسبة إعادة استخدام الاتصالات)"""
+        connections = requests_sent = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        with self._stats_lock:
+            out = dict(self._counters)
+            out["retry_tokens"] = round(self._retry_tokens, 2)
+        out["pool_maxsize"] = self._adapter._pool_maxsize
+        out["connections_opened"] = connections
+        out["pool_requests"] = requests_sent
+        out["reuse_rate"] = round(1 - connections / requests_sent, 3) if requests_sent else 0.0
+        return out
 
     # === إنشاء VM عبر الـ API ===
     def create_vm_async(self, name, owner_email=None, memory_mb=None, cpus=None, disk_mb=None):
@@ -85,29 +230,87 @@ class VBoxRemote:
             "cpus": cpus,
             "disk_mb": disk_mb,
         }
-        resp = self._post("/api/vm/create", payload)
+        resp = self._post("/api/vm/create", payload, op="long")
         return resp
 
+    def _action(self, name, action, op="action"):
+        try:
+            return self._post("/api/vm/action", {"name": name, "action": action}, op=op)
+        finally:
+            self.status_cache.invalidate(name)   # الحالة تغيّرت (أو قد تكون تغيّرت)
+
     def start_vm(self, name):
-        return self._post("/api/vm/action", {"name": name, "action": "start"})
+        return self._action(name, "start")
 
     def poweroff_vm(self, name):
-        return self._post("/api/vm/action", {"name": name, "action": "stop"})
+        return self._action(name, "stop")
 
     def reset_vm(self, name):
-        return self._post("/api/vm/action", {"name": name, "action": "reset"})
+        return self._action(name, "reset")
 
     def delete_vm_full(self, name):
-        return self._post("/api/vm/action", {"name": name, "action": "delete"})
+        return self._action(name, "delete", op="long")
+
+    def _status(self, name):
+        """رد /api/vm/status كاملًا عبر الكاش القصير (طلب واحد لكل آلة مهما تعدد الطالبون)"""
+        return self.status_cache.get(name, lambda: self._get("/api/vm/status", {"name": name}))
 
     def get_vm_status(self, name):
-        resp = self._get("/api/vm/status", {"name": name})
-        return resp.get("status", "unknown")
+        return self._status(name).get("status", "unknown")
 
     def get_ip(self, name):
-        resp = self._get("/api/vm/status", {"name": name})
+        resp = self._status(name)
         return resp.get("ip") or resp.get("ip_internal") or "-"
 
+    def remember_status(self, name, **fields):
+        """دفع من الـ webhook إلى كاش الحالة"""
+        self.status_cache.update(name, **fields)
+
+    def get_statuses(self, names):
+        """
+        حالة عدة آلات دفعة واحدة → {name: status}
+        يستعمل طلبًا واحدًا لـ /api/vm/status_bulk، وإن لم يدعمه الـ Agent (404/405 فقط)
+        يرجع لطلبات فردية بتوازي محدود. الآلات التي فشل جلب حالتها لا تظهر في النتيجة.
+        """
+        names = list(names)
+        if not names:
+            return {}
+        # ما جُلب للتو (get_ip، webhook، فحص سابق) لا يُطلب مرة أخرى داخل نافذة الكاش
+        cached = {n: p["status"] for n, p in self.status_cache.fresh_many(names).items() if p.get("status")}
+        names = [n for n in names if n not in cached]
+        if not names:
+            return cached
+
+        if self._bulk_supported:
+            gen = self.status_cache.generation()
+            resp = self._post("/api/vm/status_bulk", {"names": names}, op="status")
+            if resp.get("ok") and isinstance(resp.get("vms"), dict):
+                out = dict(cached)
+                for n, info in resp["vms"].items():
+                    if isinstance(info, dict) and info.get("status"):
+                        self.status_cache.put(n, info, gen)
+                        out[n] = info["status"]
+                return out
+            if resp.get("status_code") not in (404, 405):
+                # مهلة أو 5xx: الـ Agent مثقل → لا نضاعف الحمل بطلب لكل آلة؛
+                # الآلات الناقصة تُعتبر فاشلة فتتراجع حلقة المزامنة عنها
+                return cached
+            vbox_log.info("الـ Agent لا يدعم status_bulk → طلبات فردية")
+            self._bulk_supported = False
+
+        rid = current_request_id()
+
+        def _one(name):
+            with bind_request_id(rid):
+                resp = self._status(name)
+            return name, (resp.get("status") if resp.get("ok", True) else None)
+
+        if len(names) == 1:
+            return {**cached, **{n: st for n, st in [_one(names[0])] if st}}
+        workers = max(1, min(config.VBOX_STATUS_CONCURRENCY, len(names)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return {**cached, **{n: st for n, st in pool.map(_one, names) if st}}
+
     def change_vm_password(self, name, current_pw, new_pw):
         resp = self._post("/api/vm/change_password", {
             "name": name,
@@ -116,11 +319,11 @@ class VBoxRemote:
         })
         return bool(resp.get("ok"))
 
-    def renew_vm_expiry(self, name, days=35):
-        resp = self._post("/api/vm/renew", {
-            "name": name,
-            "days": days
-        })
+    def renew_vm_expiry(self, name, days=35, owner_email=None):
+        payload = {"name": name, "days": days}
+        if owner_email:
+            payload["owner_email"] = owner_email   # آلة مخزون انتقلت لمالك جديد
+        resp = self._post("/api/vm/renew", payload)
         return bool(resp.get("ok"))
 
     def update_resources(self, name, memory_mb, cpus):
@@ -129,34 +332,307 @@ class VBoxRemote:
             "memory_mb": int(memory_mb),
             "cpus": int(cpus)
         })
+        self.status_cache.invalidate(name)
         return bool(resp.get("ok"))
 
-# هذا هو "vbox" الجديد لكن يكلّم API
-vbox = VBoxRemote(VBOX_API, token=os.getenv("API_TOKEN"))
+# 🖥️ عميل VBoxRemote لكل خادم (جدول hosts)، و"vbox" يوجّه كل استدعاء لخادم الآلة
+host_registry = HostRegistry(lambda h: VBoxRemote(h["url"], token=h["token"]))
+vbox = Fleet(host_registry)
+
+# 🧵 طابور المهام: عمليات الـ Agent الطويلة تُنفّذ خارج خيوط Waitress
+job_queue = JobQueue()
+# تعبئة المخزون تحجز عاملها حتى ينتهي الاستنساخ → سقف خاص حتى لا تُجوّع إنشاء/إجراءات الزبائن
+job_queue.limit("pool_fill", config.WARM_POOL_JOB_WORKERS)
+
+# الحالة في القاعدة بعد نجاح كل إجراء
+_ACTION_STATUS = {"start": "running", "stop": "stopped", "reset": "restarting"}
+
+def _agent_ok(resp):
+    """يرفع استثناء إذا أعاد الـ Agent خطأ (لتُسجَّل المهمة كفاشلة)"""
+    if isinstance(resp, dict) and resp.get("ok") is False:
+        raise RuntimeError(resp.get("error") or "agent error")
+    if resp is False:
+        raise RuntimeError("agent error")
+    return resp
+
+@job_queue.handler("create")
+def _job_create(job, progress):
+    name, p = job["vm_name"], job["payload"]
+    progress("cloning")
+    try:
+        vinfo = _agent_ok(vbox.create_vm_async(
+            name,
+            owner_email=p.get("owner_email"),
+            memory_mb=p.get("memory_mb"),
+            cpus=p.get("cpus"),
+            disk_mb=p.get("disk_mb")
+        ))
+    except Exception:
+        _apply_status_changes([("error", name)])
+        raise
+
+    fields = _created_fields(vinfo)
+    if fields:
+        update_vm_fields(name, **fields)
+    return fields
+
+def _created_fields(vinfo):
+    """حقول الآلة التي يعيدها الـ Agent بعد الإنشاء"""
+    fields = {
+        "connect": vinfo.get("connect"),
+        "port": vinfo.get("port"),
+        "service_ports": ','.join(map(str, vinfo["service_ports"])) if vinfo.get("service_ports") else None,
+        "created_at": vinfo.get("created_at"),
+        "expires_at": vinfo.get("expires_at"),
+    }
+    return {k: v for k, v in fields.items() if v is not None}
+
+@job_queue.handler("pool_fill")
+def _job_pool_fill(job, progress):
+    """⚡ استنساخ آلة للمخزون الجاهز: إنشاء ← انتظار انتهاء الاستنساخ ← إيقاف ← 'ready'"""
+    name, p = job["vm_name"], job["payload"]
+    try:
+        progress("cloning")
+        fields = _created_fields(_agent_ok(vbox.create_vm_async(
+            name, memory_mb=p["memory_mb"], cpus=p["cpus"], disk_mb=p["disk_mb"])))
+
+        progress("waiting for clone")
+        deadline = time.time() + config.WARM_POOL_BOOT_TIMEOUT
+        status = vbox.get_vm_status(name)
+        while status not in ("running", "stopped") and time.time() < deadline:
+            time.sleep(3)
+            status = vbox.get_vm_status(name)
+        if status == "running":
+            progress("stopping")
+            _agent_ok(vbox.poweroff_vm(name))
+        elif status != "stopped":
+            raise RuntimeError(f"clone not ready: {status}")
+        update_vm_fields(name, status="stopped", pool="ready", **fields)
+    except Exception:
+        # لا نترك آلة نصف جاهزة تحجز سعة الخادم
+        try:
+            vbox.delete_vm_full(name)
+        finally:
+            delete_vm(name)
+        raise
+    return {"pool": "ready"}
+
+@job_queue.handler("pool_handover")
+def _job_pool_handover(job, progress):
+    """
+    ⚡ تسليم آلة من المخزون لزبون: كلمة المرور الجديدة، ثم المالك والانتهاء (renew بالأيام التي
+    حسبها claim_pooled_vm)، ثم التشغيل. فشل المزامنة لا يمنع التشغيل: كلمة المرور تُرجع للقديمة
+    في القاعدة حتى تبقى مطابقة لما في الآلة فعلًا.
+    """
+    name, p = job["vm_name"], job["payload"]
+    progress("password")
+    password_synced = bool(vbox.change_vm_password(name, p["previous_password"], p["password"]))
+    if not password_synced:
+        log.warning("فشل تغيير كلمة مرور آلة المخزون", extra={"vm": name})
+        update_vm_fields(name, password=p["previous_password"])
+
+    expiry_synced = True
+    if p.get("renew_days"):
+        progress("renew")
+        expiry_synced = bool(vbox.renew_vm_expiry(name, days=p["renew_days"], owner_email=p.get("owner_email")))
+        if not expiry_synced:
+            log.warning("فشل مزامنة انتهاء آلة المخزون مع الـ Agent", extra={"vm": name})
+
+    progress("start")
+    _agent_ok(vbox.start_vm(name))
+    _apply_status_changes([("running", name)])
+    return {"status": "running", "password_synced": password_synced, "expiry_synced": expiry_synced}
+
+@job_queue.handler("action")
+def _job_action(job, progress):
+    name, action = job["vm_name"], job["payload"].get("action")
+    progress(action)
+    if action == "start":
+        _agent_ok(vbox.start_vm(name))
+    elif action == "stop":
+        _agent_ok(vbox.poweroff_vm(name))
+    elif action == "reset":
+        _agent_ok(vbox.reset_vm(name))
+    elif action == "delete":
+        _agent_ok(vbox.delete_vm_full(name))
+        delete_vm(name)
+        log.info("تم حذف الآلة", extra={"vm": name})
+        return {"deleted": True}
+    elif action == "refresh":
+        ip = vbox.get_ip(name)
+        update_vm_fields(name, ip=ip)
+        publish_vm(name, ip=ip)
+        return {"ip": ip}
+    else:
+        raise ValueError(f"unknown action: {action}")
 
-# فعّل اللوقينغ للكونسول
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-app.logger.setLevel(logging.DEBUG)
+    # حفظ + حدث vm: صفحة الزبون ونافذة الإنشاء تتابعان أحداث vm
+    _apply_status_changes([(_ACTION_STATUS[action], name)])
+    return {"status": _ACTION_STATUS[action]}
+
+@job_queue.handler("resize")
+def _job_resize(job, progress):
+    name, p = job["vm_name"], job["payload"]
+    vm = vm_by_name(name)
+    if vm is None:
+        raise RuntimeError("vm not found")
+
+    # 📒 حجز الموارد الجديدة في دفتر السعة أولًا (فحص + حجز في معاملة واحدة) ثم الإيقاف
+    progress("reserving")
+    with transaction():
+        host_registry.check_resize(vm, p["memory_mb"], p["cpus"])
+        update_vm_fields(name, memory=p["memory_mb"], cpus=p["cpus"])
+
+    try:
+        _resize_on_agent(name, p["memory_mb"], p["cpus"], progress)
+    except Exception:
+        update_vm_fields(name, memory=vm["memory"], cpus=vm["cpus"])   # إرجاع الحجز
+        raise
+    return {"memory": p["memory_mb"], "cpus": p["cpus"]}
+
+@job_queue.handler("renew")
+def _job_renew(job, progress):
+    """تمديد الصلاحية في الـ Agent ثم في القاعدة (يوقظ expiry_scheduler)"""
+    name, days = job["vm_name"], job["payload"]["days"]
+    progress("renew")
+    _agent_ok(vbox.renew_vm_expiry(name, days=days))
+    return {"expires_at": renew_vms([name], days).get(name)}
+
+def _resize_on_agent(name, memory_mb, cpus, progress=lambda step: None):
+    """إيقاف ← انتظار التوقف الفعلي (بدل sleep ثابت) ← تعديل الموارد"""
+    progress("stopping")
+    _agent_ok(vbox.poweroff_vm(name))
+
+    progress("waiting for power off")
+    deadline = time.time() + config.RESIZE_STOP_TIMEOUT
+    while vbox.get_vm_status(name) == "running" and time.time() < deadline:
+        time.sleep(1)
+
+    progress("resizing")
+    _agent_ok(vbox.update_resources(name, memory_mb, cpus))
+
+def _wants_json():
+    return request.accept_mimetypes.best == "application/json"
+
+def _job_accepted(job_id, endpoint="admin_dashboard"):
+    """رد فوري برقم المهمة: JSON للطلبات البرمجية، وإعادة توجيه لنماذج HTML"""
+    if _wants_json():
+        return jsonify({"ok": True, "job_id": job_id}), 202
+    return redirect(url_for(endpoint, job=job_id))
+
+# 📝 كتابة مؤجلة لتحديثات الـ webhook (دفعات في معاملة واحدة)
+webhook_writer = WriteBehindBuffer(update_vms_bulk)
+atexit.register(webhook_writer.close)
+
+# ⏰ مُجدول الإيقاف عند الانتهاء — يستيقظ عند أقرب موعد أو عند تغيّر أي موعد
+expiry_scheduler = ExpiryScheduler(vbox)
+# يمر عبر الأحداث (والمرحّل) حتى يوقظ مُجدول القائد ولو تغيّر الموعد في عملية أخرى
+on_expiry_change(lambda: hub.publish("expiry", None))
+
+@hub.listen
+def _wake_expiry(ev):
+    if ev["type"] == "expiry":
+        expiry_scheduler.reschedule()
 
 # خَلّي فلاسـك يطبع أخطاء الجنچا بدل ما يسكت
 app.config["PROPAGATE_EXCEPTIONS"] = True
-app.config["TEMPLATES_AUTO_RELOAD"] = True
+# 🚀 في الإنتاج (DZ_ENV=production) لا تُفحص ملفات القوالب مع كل طلب
+app.config["TEMPLATES_AUTO_RELOAD"] = not config.PRODUCTION
 
-# هاندلر عام يطبع أي استثناء مع الـ Traceback
+# هاندلر عام يسجّل أي استثناء مع الـ Traceback (أخطاء HTTP مثل 404 تمر كما هي)
 @app.errorhandler(Exception)
 def handle_exception(e):
-    import traceback
-    print("\n⚠️⚠️⚠️ حدث خطأ داخلي ⚠️⚠️⚠️")
-    traceback.print_exc()
+    if isinstance(e, HTTPException):
+        return e
+    log.exception("حدث خطأ داخلي", extra={"method": request.method, "path": request.path})
     return f"❌ خطأ داخلي في السيرفر: {e}", 500
 
-# (اختياري) اطبع كل طلب يدخل مع معلومات الجلسة
+# 🔗 رقم لكل طلب (أو من هيدر X-Request-ID القادم من الـ Agent) يظهر في كل السجلات
 @app.before_request
-def _dbg_req():
-    try:
-        print(f"[REQ] {request.method} {request.path}  session.is_admin={session.get('is_admin')}")
-    except Exception:
-        pass
+def _bind_request_id():
+    rid = request.headers.get("X-Request-ID") or new_request_id()
+    g._rid_token = request_id_var.set(rid[:64])
+
+@app.teardown_request
+def _unbind_request_id(exc=None):
+    token = g.pop("_rid_token", None)
+    if token is not None:
+        request_id_var.reset(token)
+
+# 📊 زمن كل طلب حسب المسار (لـ /metrics)
+@app.before_request
+def _metrics_start():
+    g._t0 = time.perf_counter()
+
+@app.after_request
+def _metrics_observe(resp):
+    t0 = getattr(g, "_t0", None)
+    if t0 is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        elapsed = time.perf_counter() - t0
+        http_request_seconds.observe(elapsed, method=request.method, route=route, code=resp.status_code)
+        # سجل وصول بعينات (LOG_SAMPLE) بدل طباعة كل طلب
+        http_log.info("request", extra={"method": request.method, "path": request.path,
+                                        "status": resp.status_code, "ms": round(elapsed * 1000, 2)})
+    rid = current_request_id()
+    if rid:
+        resp.headers["X-Request-ID"] = rid
+    return resp
+
+# 🔖 أصول ثابتة ببصمة: url_for('static', ...) يضيف ?v=<hash> فيُخزَّن الملف في المتصفح سنة
+static_fingerprints = StaticFingerprints(app.static_folder)
+static_compressed = CompressedCache()
+
+@app.url_defaults
+def _static_fingerprint(endpoint, values):
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        version = static_fingerprints.version(values["filename"])
+        if version:
+            values["v"] = version
+
+# 🗜️ تخزين مؤقت + ضغط (br/gzip) للنصوص و JSON والملفات الثابتة
+@app.after_request
+def _cache_and_compress(resp):
+    if request.endpoint == "static" and resp.status_code in (200, 304):
+        fresh = request.args.get("v") and request.args["v"] == static_fingerprints.version(request.view_args["filename"])
+        resp.cache_control.no_cache = None   # send_file يضعها افتراضيًا
+        resp.cache_control.public = True
+        resp.cache_control.max_age = config.STATIC_MAX_AGE if fresh else config.STATIC_FALLBACK_MAX_AGE
+        if fresh:
+            resp.cache_control.immutable = True
+
+    if not resp.mimetype or not resp.mimetype.startswith(COMPRESSIBLE) or resp.mimetype == "text/event-stream":
+        return resp
+    resp.vary.add("Accept-Encoding")
+    encoding = pick_encoding(request.headers.get("Accept-Encoding"))
+    if (encoding is None or resp.status_code != 200 or request.method == "HEAD"
+            or "Content-Encoding" in resp.headers):
+        return resp
+    static = request.endpoint == "static"
+    if resp.is_streamed and not static:
+        return resp
+    resp.direct_passthrough = False   # send_file يمرر الملف مباشرة؛ نقرؤه لنضغطه
+    data = resp.get_data()
+    if len(data) < config.COMPRESS_MIN_BYTES:
+        return resp
+    etag, weak = resp.get_etag()
+    if static:
+        body = static_compressed.get_or_compress((request.view_args["filename"], etag, encoding), data, encoding)
+    else:
+        body = compress(data, encoding)
+    resp.set_data(body)
+    resp.headers["Content-Encoding"] = encoding
+    if etag and not weak:
+        resp.set_etag(etag, weak=True)   # الجسم المضغوط ليس نفس البايتات
+    return resp
+
+def _conditional_json(payload):
+    """JSON مع ETag: الاستعلام المتكرر بلا تغيير يأخذ 304 بدون جسم"""
+    resp = jsonify(payload)
+    resp.add_etag(weak=True)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True   # المتصفح يعيد التحقق دائمًا بـ If-None-Match
+    return resp.make_conditional(request)
 
 import datetime
 
@@ -172,6 +648,13 @@ def todatetime(value):
     except Exception:
         return None
 
+# ✅ فلتر epoch → نص UTC (لتقارير SLA)
+@app.template_filter("epoch_utc")
+def epoch_utc(value):
+    if not value:
+        return "-"
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M")
+
 # ✅ دالة inject_now() لإتاحة استخدام now() داخل Jinja (بمنطقة زمنية UTC)
 @app.context_processor
 def inject_now():
@@ -179,6 +662,7 @@ def inject_now():
 
 app.secret_key = os.getenv("FLASK_SECRET", secrets.token_hex(16))
 init_db()
+host_registry.ensure_default(VBOX_API, os.getenv("API_TOKEN"))
 
 def require_admin():
     if not session.get("is_admin"):
@@ -202,28 +686,88 @@ def admin_logout():
     session.clear()
     return redirect(url_for("admin_login"))
 
+def _day_epoch(value):
+    """
+    'YYYY-MM-DD' → epoch بداية اليوم (UTC) لفلتر expires_before
+    ValueError إذا لم يُفهم: فلتر موجود لكن تالف يجب أن يُرفض لا أن يُتجاهل فيتسع الاستعلام
+    """
+    ts = to_epoch(f"{value} 00:00:00") if isinstance(value, str) else None
+    if ts is None:
+        raise ValueError(f"invalid expires_before: {value!r} (expected YYYY-MM-DD)")
+    return ts
+
 @app.get("/admin")
 def admin_dashboard():
     if require_admin():
         return require_admin()
+    # 🔎 فلاتر + ترتيب + صفحة (keyset) من رابط الطلب
+    filters = {
+        "status": request.args.get("status", "").strip() or None,
+        "owner": request.args.get("owner", "").strip() or None,
+        "expires_before": request.args.get("expires_before", "").strip() or None,
+        "sort": request.args.get("sort") if request.args.get("sort") in ("name", "expires") else "name",
+    }
+    cursor = request.args.get("cursor") or None
     try:
-        vms = list_vms()
-        print(f"[DEBUG] ✅ عدد الأجهزة المسترجعة من قاعدة البيانات: {len(vms)}")
-    except Exception as e:
-        import traceback
-        print("[ERROR] فشل أثناء جلب البيانات من قاعدة البيانات:")
-        traceback.print_exc()
+        limit = max(1, min(int(request.args.get("limit", config.ADMIN_PAGE_SIZE)), 200))
+    except ValueError:
+        limit = config.ADMIN_PAGE_SIZE
+
+    try:
+        expires_before_ts = _day_epoch(filters["expires_before"]) if filters["expires_before"] else None
+    except ValueError:
+        return "❌ تاريخ expires_before غير صالح (المطلوب YYYY-MM-DD).", 400
+
+    try:
+        vms, next_cursor = list_vms_page(
+            limit=limit,
+            cursor=cursor,
+            status=filters["status"],
+            owner=filters["owner"],
+            expires_before=expires_before_ts,
+            sort=filters["sort"],
+        )
+        log.debug("عدد الأجهزة المسترجعة من قاعدة البيانات", extra={"count": len(vms)})
+    except ValueError:
+        return "❌ رابط الصفحة (cursor) غير صالح.", 400
+    except Exception:
+        log.exception("فشل أثناء جلب البيانات من قاعدة البيانات")
         return "❌ خطأ أثناء قراءة البيانات من قاعدة البيانات. تحقق من الكونسول.", 500
 
     try:
-        print(f"[DEBUG] 🧩 عرض القالب admin.html باستخدام TEMPLATE_NAME={config.TEMPLATE_NAME}")
-        return render_template("admin.html", login=False, vms=vms, template_name=config.TEMPLATE_NAME, config=config)
-    except Exception as e:
-        import traceback
-        print("[ERROR] ⚠️ فشل أثناء عرض القالب admin.html:")
-        traceback.print_exc()
+        return render_template("admin.html", login=False, vms=vms, template_name=config.TEMPLATE_NAME, config=config,
+                               filters=filters, cursor=cursor, next_cursor=next_cursor, limit=limit,
+                               hosts=host_registry.capacity(), pool=warm_pool.stats(),
+                               error=request.args.get("error"))
+    except Exception:
+        log.exception("فشل أثناء عرض القالب admin.html")
         return "❌ خطأ أثناء عرض القالب admin.html. تحقق من الكونسول.", 500
 
+@app.get("/admin/vm/<name>")
+def admin_vm_details(name):
+    """تفاصيل آلة كاملة (مع بيانات الدخول) تُحمَّل عند الطلب من نافذة التفاصيل"""
+    if require_admin():
+        return require_admin()
+    vm = vm_by_name(name)
+    if not vm:
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    return jsonify({"ok": True, "vm": vm.to_dict()})
+
+@app.get("/admin/vm/<name>/history")
+def admin_vm_history(name):
+    """
+    سجل حالات آلة: ?days=30 (افتراضي) → ملخص التشغيل/التحولات للمدة + آخر الأحداث التفصيلية
+    """
+    if require_admin():
+        return require_admin()
+    try:
+        days = min(max(float(request.args.get("days") or 30), 0), 3660)
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid days"}), 400
+    since = time.time() - days * 86400
+    return jsonify({"ok": True, "summary": vm_status_summary(name, since),
+                    "events": vm_events_range(name, since, limit=200)})
+
 @app.post("/admin/create")
 def admin_create_vm():
     if require_admin(): return require_admin()
@@ -248,42 +792,32 @@ def admin_create_vm():
     except Exception:
         disk = config.DEFAULT_DISK_MB
 
+    if min(mem, cpus, disk) <= 0:
+        return jsonify({"ok": False, "error": "invalid resources"}), 400
+
     serial = secrets.token_hex(8).upper()
     user = "Administrator"
     temp_pw = secrets.token_urlsafe(10)[:12]
 
-    # ✅ إنشاء VM عبر API واسترجاع معلوماتها بما فيها created_at و expires_at
-    vinfo = vbox.create_vm_async(
-        name,
-        owner_email=owner,
-        memory_mb=mem,
-        cpus=cpus,
-        disk_mb=disk
-    )
-
+    # ⚡ أولًا: آلة جاهزة من المخزون بنفس الموارد (تشغيل فقط، بدون استنساخ)
+    # 🖥️ وإلا: اختيار الخادم + الحجز في دفتر السعة داخل معاملة واحدة (لا يتسابق طلبان على نفس الفراغ)
+    # ✅ الآلة تُخزَّن بحالة "creating" ثم الإنشاء الفعلي عبر طابور المهام
     try:
-        # ✅ تخزين البيانات مع الحقول الجديدة
-        insert_vm(
-            name, serial, owner, user, temp_pw, "-", "creating",
-            mem, cpus, disk,
-            connect=vinfo.get('connect'),
-            port=vinfo.get('port'),
-            service_ports=','.join(map(str, vinfo.get('service_ports', []))) if vinfo.get('service_ports') else None,
-            created_at=vinfo.get('created_at'),
-            expires_at=vinfo.get('expires_at')
-        )
-    except TypeError:
-        # fallback للنسخ القديمة
-        insert_vm(name, serial, owner, user, temp_pw, "-", "creating", mem, cpus, disk)
-        update_vm_fields(
-            name,
-            connect=vinfo.get('connect'),
-            port=vinfo.get('port'),
-            created_at=vinfo.get('created_at'),
-            expires_at=vinfo.get('expires_at')
-        )
-
-    return jsonify({"ok": True, "name": name}), 202
+        with transaction():
+            pooled = warm_pool.claim(mem, cpus, disk, serial, owner, temp_pw)
+            if not pooled:
+                host = host_registry.place(mem, cpus, disk)
+                insert_vm(name, serial, owner, user, temp_pw, "-", "creating", mem, cpus, disk, host=host)
+    except PlacementError as e:
+        return jsonify({"ok": False, "error": str(e)}), 409
+    if pooled:
+        job_id = job_queue.submit(pooled["name"], "pool_handover", owner_email=owner, password=temp_pw,
+                                  previous_password=pooled["previous_password"],
+                                  renew_days=pooled["renew_days"])
+        return jsonify({"ok": True, "name": pooled["name"], "pooled": True, "job_id": job_id}), 202
+    job_id = job_queue.submit(name, "create", owner_email=owner, memory_mb=mem, cpus=cpus, disk_mb=disk)
+
+    return jsonify({"ok": True, "name": name, "host": host, "job_id": job_id}), 202
 
 @app.post("/admin/activate")
 def admin_activate():
@@ -324,7 +858,7 @@ def home():
 
     if vm.get("expires_at"):
         try:
-            exp_date = datetime.datetime.strptime(vm["expires_at"], "%Y-%m-%d %H:%M:%S")
+            exp_date = datetime.datetime.strptime(vm["expires_at"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=datetime.timezone.utc)
             days_left = (exp_date - now).days
 
             # 🟢 الحالة الطبيعية
@@ -346,34 +880,64 @@ def home():
                 session.pop("serial", None)  # إزالة السيريال لانتهائه
                 return render_template("customer.html", vm=None, error="❌ انتهت صلاحية اشتراكك. يرجى التجديد لاستعادة الوصول.")
 
-            # 🚫 منتهي منذ أكثر من 3 أيام → إيقاف فعلي للآلة
+            # 🚫 منتهي منذ أكثر من 3 أيام → الإيقاف الفعلي من مسؤولية expiry_scheduler
             elif days_left < -3:
-                vbox.poweroff_vm(vm["name"])
-                update_vm_fields(vm["name"], status="expired")
+                if vm.get("status") not in ("expired", "deleted"):
+                    expiry_scheduler.reschedule()
                 session.pop("serial", None)
                 return render_template("customer.html", vm=None, error="⏰ انتهت صلاحية هذه الآلة وتم إيقافها تلقائيًا.")
 
         except Exception as e:
-            print(f"[WARN] خطأ في قراءة expires_at للآلة {vm['name']}: {e}")
+            log.warning("خطأ في قراءة expires_at", extra={"vm": vm["name"], "error": str(e)})
 
     # ✅ عرض تفاصيل الآلة (دون طلب السيريال مجددًا)
     return render_template("customer.html", vm=vm, error=None)
 
+# 🔐 هاش على مجمع محدود + حد محاولات لكل IP وبريد (يُفحص قبل أي هاش أو قاعدة بيانات)
+hasher = PasswordHasher()
+login_ip_limiter = TokenBucketLimiter(config.LOGIN_RATE_PER_IP, config.LOGIN_BURST_PER_IP)
+login_email_limiter = TokenBucketLimiter(config.LOGIN_RATE_PER_EMAIL, config.LOGIN_BURST_PER_EMAIL)
+
+def _throttled(template, email):
+    """رد 429 (مع Retry-After) إذا تجاوز الـ IP أو البريد حده، وإلا None"""
+    ok, wait = login_ip_limiter.allow(request.remote_addr or "-")
+    if ok and email:
+        ok, wait = login_email_limiter.allow(email)
+    if ok:
+        return None
+    login_attempts.inc(result="throttled")
+    resp = app.make_response((render_template(template, error="⏳ محاولات كثيرة، حاول بعد قليل."), 429))
+    resp.headers["Retry-After"] = str(max(1, int(wait + 0.999)))
+    return resp
+
+def _hasher_busy(template):
+    login_attempts.inc(result="busy")
+    resp = app.make_response((render_template(template, error="⏳ الخادم مشغول، حاول بعد ثوانٍ."), 503))
+    resp.headers["Retry-After"] = "2"
+    return resp
+
 @app.get("/register")
 def register_page():
     return render_template("register.html", error=None)
 
 @app.post("/register")
 def register_post():
-    email = request.form.get("email").strip().lower()
+    email = (request.form.get("email") or "").strip().lower()
     password = request.form.get("password")
     confirm = request.form.get("confirm")
+    throttled = _throttled("register.html", email)
+    if throttled:
+        return throttled
     if password != confirm:
         return render_template("register.html", error="كلمتا المرور غير متطابقتين.")
     if get_user(email):
         return render_template("register.html", error="هذا البريد مسجّل مسبقًا.")
-    hashed = generate_password_hash(password)
+    try:
+        hashed = hasher.hash(password)
+    except HasherBusy:
+        return _hasher_busy("register.html")
     create_user(email, hashed)
+    login_attempts.inc(result="registered")
     session["user_email"] = email
     return redirect(url_for("home"))
 
@@ -385,10 +949,22 @@ def login_page():
 def login_post():
     email = request.form.get("email", "").strip().lower()
     password = request.form.get("password", "")
+    throttled = _throttled("login.html", email)
+    if throttled:
+        return throttled
 
     user = get_user(email)
-    if not user or not check_password_hash(user[2], password):
+    try:
+        ok = bool(user) and hasher.verify(user[2], password)
+    except HasherBusy:
+        return _hasher_busy("login.html")
+    if not ok:
+        login_attempts.inc(result="failed")
         return render_template("login.html", error="بيانات الدخول غير صحيحة.")
+    login_attempts.inc(result="ok")
+    if hasher.needs_rehash(user[2]):
+        # 🔁 إعدادات هاش جديدة: نحدّث الهاش القديم في الخلفية بعد الدخول الناجح
+        hasher.rehash_later(password, lambda new: update_user_password(email, new, user[2]))
 
     # ✅ حفظ البريد في الجلسة
     session["user_email"] = email
@@ -406,6 +982,8 @@ def logout_user():
     session.clear()
     return redirect(url_for("login_page"))
 
+customer_action_limiter = TokenBucketLimiter(config.CUSTOMER_ACTION_RATE, config.CUSTOMER_ACTION_BURST)
+
 @app.post("/customer/action")
 def customer_action():
     serial = request.form.get("serial")
@@ -413,23 +991,76 @@ def customer_action():
     vm = vm_by_serial(serial)
     if not vm:
         return render_template("customer.html", vm=None, error="Serial not found.")
-    name = vm["name"]
-    if action == "start":
-        vbox.start_vm(name)
-    elif action == "stop":
-        vbox.poweroff_vm(name)
-    elif action == "reset":
-        vbox.reset_vm(name)
-    elif action == "refresh":
-        ip = vbox.get_ip(name)
-        update_vm_fields(name, ip=ip)
-    return render_template("customer.html", vm=vm_by_serial(serial), error=None)
+    if action not in ("start", "stop", "reset", "refresh"):
+        return render_template("customer.html", vm=vm, error=None)
+    ok, wait = customer_action_limiter.allow(vm["serial"])
+    if not ok:
+        retry = str(max(1, int(wait + 0.999)))
+        if _wants_json():
+            return jsonify({"ok": False, "error": "too_many_requests", "retry_after": int(retry)}), 429, {"Retry-After": retry}
+        return render_template("customer.html", vm=vm, error=f"⏳ طلبات كثيرة، حاول بعد {retry} ثانية."), 429, {"Retry-After": retry}
+    # نفس الإجراء وهو ما زال منتظرًا/جاريًا → نفس المهمة (لا استدعاءات مكررة للـ Agent)
+    job_id, merged = job_queue.submit_once(vm["name"], "action", ("action",), action=action)
+    if _wants_json():
+        return jsonify({"ok": True, "job_id": job_id, "merged": merged}), 202
+    return render_template("customer.html", vm=vm, error=f"⏳ تم استلام الطلب (مهمة #{job_id}).")
 
 @app.get("/customer/action")
 def customer_action_get():
     # إذا المستخدم دخل الرابط مباشرة، نعيده للصفحة الرئيسية بدل 405
     return redirect(url_for("home"))
 
+def _status_text(status):
+    if status == "running":
+        return "🟢 يعمل"
+    elif status == "stopped":
+        return "🟠 متوقف"
+    elif status == "expired":
+        return "🔴 منتهي"
+    elif status == "creating":
+        return "⚪ قيد الإنشاء..."
+    return "⚪ غير معروف"
+
+def publish_vm(name, status=None, ip=None):
+    """نشر تغيّر حالة/IP لقنوات SSE"""
+    hub.publish("vm", name, status=status, ip=ip,
+                status_text=_status_text(status) if status else None)
+
+@app.get("/api/events")
+def api_events():
+    """
+    📡 قناة Server-Sent Events
+    الأدمن يستلم أحداث كل الآلات، والزبون أحداث الآلة المرتبطة بسيريال جلسته فقط.
+    """
+    scope = None
+    if not session.get("is_admin"):
+        vm = vm_by_serial(session.get("serial")) if session.get("serial") else None
+        if not vm:
+            return jsonify({"ok": False, "error": "forbidden"}), 403
+        scope = vm["name"]
+
+    sub = hub.subscribe(scope)
+    if sub is None:
+        return jsonify({"ok": False, "error": "too_many_streams"}), 503
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            deadline = time.time() + config.SSE_MAX_SECONDS
+            while time.time() < deadline:
+                ev = sub.get(timeout=config.SSE_HEARTBEAT_SECONDS)
+                if ev is None:
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {ev['type']}\ndata: {json.dumps(ev)}\n\n"
+        finally:
+            hub.unsubscribe(sub)
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
 @app.get("/api/vm_status")
 def api_vm_status():
     """
@@ -451,19 +1082,10 @@ def api_vm_status():
         return jsonify({"ok": False, "status": "not_found"}), 404
 
     status = vm.get("status", "unknown")
-    if status == "running":
-        status_text = "🟢 يعمل"
-    elif status == "stopped":
-        status_text = "🟠 متوقف"
-    elif status == "expired":
-        status_text = "🔴 منتهي"
-    elif status == "creating":
-        status_text = "⚪ قيد الإنشاء..."
-    else:
-        status_text = "⚪ غير معروف"
+    status_text = _status_text(status)
 
     # 🔹 أعد كل الحقول المفيدة أيضًا، لتحديث الواجهة عند الجاهزية
-    return jsonify({
+    return _conditional_json({
         "ok": True,
         "status": status,
         "status_text": status_text,
@@ -501,24 +1123,26 @@ def api_vm_update():
     if not data or 'name' not in data:
         return jsonify({'ok': False, 'error': 'invalid payload'}), 400
     name = data.get('name')
-    ip = data.get('ip_internal') or data.get('ip') or data.get('ip_internal','-')
+    # بلا IP في الطلب → لا نلمس الـ IP المحفوظ (None يُسقط من التحديث)
+    ip = data.get('ip_internal') or data.get('ip') or None
     status = data.get('status')
-    password = data.get('password')
-    connect = data.get('connect')
-    port = data.get('port')
     service_ports = data.get('service_ports')
-    try:
-        update_vm_fields(
-            name,
-            ip=ip,
-            status=status,
-            password=password,
-            connect=connect,
-            port=port,
-            service_ports=','.join(map(str, service_ports)) if isinstance(service_ports, (list,tuple)) else service_ports
-        )
-    except Exception as e:
-        print('webhook db update failed', e)
+
+    # 📝 الكتابة مؤجلة ومدمجة لكل آلة (لا ننتظر fsync داخل الـ webhook)
+    accepted = webhook_writer.add(
+        name,
+        ip=ip,
+        status=status,
+        password=data.get('password'),
+        connect=data.get('connect'),
+        port=data.get('port'),
+        service_ports=','.join(map(str, service_ports)) if isinstance(service_ports, (list,tuple)) else service_ports
+    )
+    if not accepted:
+        return jsonify({'ok': False, 'error': 'busy'}), 429, {'Retry-After': '1'}
+    # 📡 الـ Agent دفع الحالة بنفسه → get_ip/get_vm_status لا يحتاجان طلبًا جديدًا
+    vbox.remember_status(name, status=status, ip=ip)
+    publish_vm(name, status=status, ip=ip)
     return jsonify({'ok': True})
 
 @app.post("/admin/renew")
@@ -537,15 +1161,16 @@ def admin_renew_vm():
         # ✅ تحويل قيمة الأيام (افتراضي 35)
         extra_days = int(days) if days else 35
 
-        # ✅ استدعاء دالة التجديد عبر API
-        vbox.renew_vm_expiry(name, days=extra_days)
+        # ✅ استدعاء دالة التجديد عبر API ثم تحديث الموعد في القاعدة (يوقظ expiry_scheduler)
+        if vbox.renew_vm_expiry(name, days=extra_days):
+            vm = vm_by_name(name)
+            if vm and vm.get("serial"):
+                renew_vm(vm["serial"], extra_days=extra_days)
 
-        msg = f"✅ تم تجديد صلاحية الآلة {name} لمدة {extra_days} يومًا إضافية."
-        print(msg)
+        log.info("تم تجديد صلاحية الآلة", extra={"vm": name, "days": extra_days})
 
     except Exception as e:
-        msg = f"❌ حدث خطأ أثناء التجديد: {e}"
-        print(msg)
+        log.warning("حدث خطأ أثناء التجديد", extra={"vm": name, "error": str(e)})
 
     return redirect(url_for("admin_dashboard"))
 
@@ -554,36 +1179,14 @@ def admin_action():
     if require_admin():
         return require_admin()
 
-    from db import update_vm_fields, delete_vm
-
     name = request.form.get("name")
     action = request.form.get("action")
 
-    if not name or not action:
+    if not name or action not in ("start", "stop", "reset", "delete"):
         return redirect(url_for("admin_dashboard"))
 
-    try:
-        if action == "start":
-            vbox.start_vm(name)
-            update_vm_fields(name, status="running")
-
-        elif action == "stop":
-            vbox.poweroff_vm(name)
-            update_vm_fields(name, status="stopped")
-
-        elif action == "reset":
-            vbox.reset_vm(name)
-            update_vm_fields(name, status="restarting")
-
-        elif action == "delete":
-            vbox.delete_vm_full(name)
-            delete_vm(name)
-            print(f"[OK] ✅ تم حذف الآلة {name}")
-
-    except Exception as e:
-        print(f"[ERR] أثناء تنفيذ الإجراء {action} للآلة {name}: {e}")
-
-    return redirect(url_for("admin_dashboard"))
+    job_id, _ = job_queue.submit_once(name, "action", ("action",), action=action)
+    return _job_accepted(job_id)
 
 @app.post("/admin/update_resources")
 def admin_update_resources():
@@ -596,95 +1199,335 @@ def admin_update_resources():
 
     if not name or not ram or not cpus:
         return redirect(url_for("admin_dashboard"))
+    try:
+        ram, cpus = int(ram), int(cpus)
+    except ValueError:
+        ram = cpus = 0
+    vm = vm_by_name(name)
+    if vm is None or ram <= 0 or cpus <= 0:
+        return jsonify({"ok": False, "error": "invalid resources"}), 400
+
+    # 📒 رفض فوري إذا كانت الزيادة تتجاوز سعة الخادم (يُعاد الفحص مع الحجز داخل المهمة)
+    try:
+        host_registry.check_resize(vm, ram, cpus)
+    except PlacementError as e:
+        if _wants_json():
+            return jsonify({"ok": False, "error": str(e)}), 409
+        return redirect(url_for("admin_dashboard", error=str(e)))
 
-    # 🛑 نطلب من الـ API يوقف الـ VM ويعدل الموارد داخله
-    vbox.poweroff_vm(name)
-    time.sleep(3)
-
-    # 🔧 تعديل الرام والأنوية عبر الـ API
-    vbox.update_resources(name, ram, cpus)
+    # 🛑 الإيقاف ثم تعديل الموارد يتمّان في الخلفية عبر طابور المهام
+    job_id = job_queue.submit(name, "resize", memory_mb=ram, cpus=cpus)
+    return _job_accepted(job_id)
 
-    # 📌 تحديث البيانات في قاعدة البيانات
-    update_vm_fields(name, memory=ram, cpus=cpus)
+# 🧰 عمليات جماعية: استدعاءات الـ Agent بتوازٍ محدود ثم تحديثات القاعدة في معاملة واحدة
+BULK_ACTIONS = ("start", "stop", "reset", "delete", "renew", "resize")
 
-    return redirect(url_for("admin_dashboard"))
+_BULK_FILTER_KEYS = ("owner", "status", "host", "expires_before")
 
-def auto_power_off_loop():
+def _bulk_targets(data):
     """
-    🔁 تعمل في الخلفية للتحقق من:
-      - تحديث الحالة الفعلية لكل VM (كل 30 ثانية)
-      - إيقاف أي آلة انتهى اشتراكها منذ أكثر من 3 أيام (مرة كل 24 ساعة)
+    أسماء الآلات من names أو من filter (owner/status/host/expires_before) — None إذا لم يُحدد أي منهما.
+    أي قيمة غير صالحة → ValueError: لا نُسقط شرطًا أبدًا لأن ذلك يوسّع الإجراء إلى آلات أكثر.
     """
-    import datetime
-    from threading import Lock
-
-    # قفل يمنع تشغيل أكثر من حلقة واحدة بنفس الوقت
-    global _auto_off_lock
+    if "names" in data:
+        names = data["names"]
+        if not isinstance(names, list) or not names or not all(isinstance(n, str) and n for n in names):
+            raise ValueError("names must be a non-empty list of strings")
+        return list(dict.fromkeys(names))
+    f = data.get("filter")
+    if f is None:
+        return None
+    if not isinstance(f, dict):
+        raise ValueError("filter must be an object")
+    unknown = set(f) - set(_BULK_FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"unknown filter keys: {', '.join(sorted(unknown))}")
+    for k, v in f.items():
+        if not isinstance(v, str) or not v:
+            raise ValueError(f"filter.{k} must be a non-empty string")
+    if not f:
+        return None   # لا نطبّق إجراءً على كل الأسطول بفلتر فارغ
+    exp = _day_epoch(f["expires_before"]) if "expires_before" in f else None
+    vms, more = list_vms_page(limit=config.BULK_MAX_VMS, status=f.get("status"), owner=f.get("owner"),
+                              host=f.get("host"), expires_before=exp)
+    names = [vm["name"] for vm in vms]
+    if more:
+        names.append(more)   # يتجاوز الحد → يُرفض في المسار
+    return names
+
+def _bulk_submit(name, action, days, mem, cpus):
+    """مهمة الآلة في الطابور: نفس مسار /admin/action و /admin/update_resources → (job_id, merged)"""
+    if action == "renew":
+        # كل تجديد يُضاف (دمج تجديدين متطابقين يُسقط أيامًا)
+        return job_queue.submit(name, "renew", days=days), False
+    if action == "resize":
+        return job_queue.submit_once(name, "resize", ("memory_mb", "cpus"), memory_mb=mem, cpus=cpus)
+    return job_queue.submit_once(name, "action", ("action",), action=action)
+
+@app.post("/admin/bulk")
+def admin_bulk():
+    """
+    JSON: {"action": "stop", "names": [...]} أو {"action": "renew", "days": 35, "filter": {"owner": ...}}
+    resize يحتاج memory_mb و cpus. كل آلة تصبح مهمة في الطابور (بالترتيب مع مهامها الأخرى)،
+    والرد 202 بأرقام المهام؛ النتيجة المجمّعة من /api/jobs?ids=...
+    """
+    if require_admin():
+        return require_admin()
+    data = request.get_json(silent=True) or {}
+    action = data.get("action")
+    if action not in BULK_ACTIONS:
+        return jsonify({"ok": False, "error": f"action must be one of {', '.join(BULK_ACTIONS)}"}), 400
     try:
-        _auto_off_lock
-    except NameError:
-        _auto_off_lock = Lock()
+        days = int(data.get("days") or 35)
+        mem, cpus = int(data.get("memory_mb") or 0), int(data.get("cpus") or 0)
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "invalid number"}), 400
+    if action == "resize" and (mem <= 0 or cpus <= 0):
+        return jsonify({"ok": False, "error": "memory_mb and cpus are required"}), 400
+    try:
+        names = _bulk_targets(data)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    if names is None:
+        return jsonify({"ok": False, "error": "names or filter required"}), 400
+    if len(names) > config.BULK_MAX_VMS:
+        return jsonify({"ok": False, "error": f"more than {config.BULK_MAX_VMS} VMs, narrow the selection"}), 413
+
+    # 🗄️ كل المهام في معاملة واحدة؛ العمّال يستيقظون بعد COMMIT
+    results = []
+    with transaction():
+        for name in names:
+            vm = vm_by_name(name)
+            if vm is None or vm.get("pool"):
+                results.append({"name": name, "ok": False, "error": "not_found", "job_id": None, "merged": False})
+                continue
+            job_id, merged = _bulk_submit(name, action, days, mem, cpus)
+            results.append({"name": name, "ok": True, "error": None, "job_id": job_id, "merged": merged})
+
+    job_ids = [r["job_id"] for r in results if r["ok"]]
+    failed = len(names) - len(job_ids)
+    log.info("bulk action", extra={"action": action, "total": len(names), "jobs": len(job_ids), "failed": failed})
+    return jsonify({
+        "ok": not failed,
+        "action": action,
+        "total": len(names),
+        "queued": sum(1 for r in results if r["ok"] and not r["merged"]),
+        "merged": sum(1 for r in results if r["merged"]),
+        "failed": failed,
+        "job_ids": job_ids,
+        "status_url": url_for("api_jobs_batch", ids=",".join(map(str, job_ids))) if job_ids else None,
+        "results": results,
+    }), 202
+
+def _apply_status_changes(changes):
+    """🟢 حفظ الحالات الفعلية الجديدة في معاملة واحدة + إشعار المتصفحات"""
+    update_vm_statuses(changes)
+    for real_status, name in changes:
+        publish_vm(name, status=real_status)
+
+# 🔄 مزامنة الحالة: فترات حسب الحالة + طلبات متوازية محدودة + تراجع لكل آلة (انظر sync.py)
+sync_engine = SyncEngine(vbox, _apply_status_changes)
+
+# ⚡ مخزون الآلات الجاهزة (WARM_POOL في config.py)
+warm_pool = WarmPool(host_registry, job_queue)
+history_rollup = HistoryRollup()
+
+def _start_leader_loops():
+    expiry_scheduler.start()
+    warm_pool.start()
+    history_rollup.start()
+    if AUTO_POWER_OFF:
+        sync_engine.start()
+
+def _stop_leader_loops():
+    sync_engine.stop()
+    warm_pool.stop()
+    history_rollup.stop()
+    expiry_scheduler.stop()
+
+# 👑 مع عدة عمليات (gunicorn -w N) عملية واحدة فقط تشغّل المزامنة والانتهاء
+leader = LeaderElection("background", _start_leader_loops, _stop_leader_loops)
+
+def start_background():
+    """خيوط الخلفية لهذه العملية: المهام والكتابة المؤجلة ومرحّل الأحداث في كل عملية، والحلقات الدورية للقائد فقط"""
+    job_queue.start()
+    webhook_writer.start()
+    relay.start()
+    leader.start()
+    atexit.register(leader.stop)
+    atexit.register(relay.stop)
+    atexit.register(job_queue.stop)
+
+@app.get("/api/jobs/<int:job_id>")
+def api_job_status(job_id):
+    """حالة مهمة: للأدمن، أو للزبون إذا كانت المهمة على آلته"""
+    job = get_job(job_id)
+    if job and not session.get("is_admin"):
+        vm = vm_by_serial(session.get("serial")) if session.get("serial") else None
+        if not vm or vm["name"] != job["vm_name"]:
+            job = None
+    if not job:
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    job.pop("payload", None)
+    return _conditional_json({"ok": True, "job": job})
+
+@app.get("/api/jobs")
+def api_jobs_batch():
+    """النتيجة المجمّعة لدفعة مهام (?ids=1,2,3): العدد لكل حالة + حالة/خطأ كل مهمة — للأدمن"""
+    if require_admin():
+        return require_admin()
+    try:
+        ids = [int(i) for i in request.args.get("ids", "").split(",") if i.strip()]
+    except ValueError:
+        return jsonify({"ok": False, "error": "ids must be comma-separated integers"}), 400
+    if not ids or len(ids) > config.BULK_MAX_VMS:
+        return jsonify({"ok": False, "error": f"1..{config.BULK_MAX_VMS} ids required"}), 400
+    jobs = jobs_by_ids(ids)
+    counts = {}
+    for job in jobs:
+        counts[job["status"]] = counts.get(job["status"], 0) + 1
+    return _conditional_json({
+        "ok": True,
+        "total": len(jobs),
+        "finished": counts.get("queued", 0) + counts.get("running", 0) == 0,
+        "counts": counts,
+        "jobs": [{k: job[k] for k in ("id", "vm_name", "kind", "status", "progress", "error", "result")}
+                 for job in jobs],
+    })
 
-    if _auto_off_lock.locked():
-        print("[AUTO-OFF] ⚠️ العملية تعمل بالفعل، لن أبدأ حلقة جديدة.")
-        return
+@app.get("/admin/vbox_stats")
+def admin_vbox_stats():
+    if require_admin():
+        return require_admin()
+    return jsonify(vbox.stats())
 
-    with _auto_off_lock:
-        sync_interval = 30               # ⏱️ تحقق من الحالة كل 30 ثانية
-        expire_check_interval = 86400    # ⏱️ فحص الاشتراكات المنتهية كل 24 ساعة
-        last_expire_check = 0
+@app.get("/admin/hosts")
+def admin_hosts():
+    """الخوادم مع السعة والمحجوز والمتبقي"""
+    if require_admin():
+        return require_admin()
+    return jsonify({"ok": True, "hosts": host_registry.capacity()})
 
-        print("[AUTO-OFF] 🚀 تم بدء حلقة المراقبة الخلفية بنجاح.")
+@app.post("/admin/hosts")
+def admin_hosts_save():
+    """إضافة/تعديل خادم (name, url, token, memory_mb, cpus, disk_mb, enabled)"""
+    if require_admin():
+        return require_admin()
+    data = request.get_json(silent=True) or request.form
+    name = (data.get("name") or "").strip()
+    url = (data.get("url") or "").strip()
+    if not name or not url:
+        return jsonify({"ok": False, "error": "name and url are required"}), 400
+    try:
+        limits = {k: int(data[k]) if data.get(k) not in (None, "") else None
+                  for k in ("memory_mb", "cpus", "disk_mb")}
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "invalid capacity"}), 400
+    enabled = str(data.get("enabled", "1")).lower() not in ("0", "false", "off", "")
+    upsert_host(name, url, token=data.get("token") or None, enabled=enabled, **limits)
+    host_registry.reload()
+    return jsonify({"ok": True, "hosts": host_registry.capacity()})
+
+# 📈 تقارير التوفر (SLA) من المجاميع التراكمية في vm_sla
+def _report_days():
+    try:
+        return min(max(int(request.args.get("days") or 30), 1), config.VM_OUTAGES_KEEP_DAYS)   # ما بعدها حُذفت نوافذه
+    except ValueError:
+        return 30
 
-        while AUTO_POWER_OFF:
-            try:
-                vms = list_vms()
-                now = datetime.datetime.now(datetime.timezone.utc)
-
-                # 🟢 1️⃣ تحديث الحالة الفعلية لكل VM من خلال الـ API
-                for vm in vms:
-                    try:
-                        real_status = vbox.get_vm_status(vm["name"])
-                        if real_status and real_status != vm["status"]:
-                            update_vm_fields(vm["name"], status=real_status)
-                            print(f"[SYNC] 🔄 تحديث حالة {vm['name']} → {real_status}")
-                    except Exception as e:
-                        print(f"[WARN] ⚠️ فشل في جلب حالة {vm['name']}: {e}")
-
-                # 🔴 2️⃣ فحص الاشتراكات المنتهية مرة كل 24 ساعة فقط
-                if (time.time() - last_expire_check) > expire_check_interval:
-                    print("[AUTO-OFF] 🔁 فحص الاشتراكات المنتهية...")
-                    expired_count = 0
-
-                    for vm in vms:
-                        exp_at = vm.get("expires_at")
-                        if not exp_at:
-                            continue
-
-                        try:
-                            exp_date = datetime.datetime.strptime(
-                                exp_at, "%Y-%m-%d %H:%M:%S"
-                            ).replace(tzinfo=datetime.timezone.utc)
-                        except Exception:
-                            continue
-
-                        if (now - exp_date).days > 3 and vm["status"] not in ("expired", "deleted"):
-                            print(f"[AUTO-OFF] ⏰ إيقاف {vm['name']} لانتهاء الاشتراك.")
-                            try:
-                                vbox.poweroff_vm(vm["name"])
-                                update_vm_fields(vm["name"], status="expired")
-                                expired_count += 1
-                            except Exception as e:
-                                print(f"[AUTO-OFF] ⚠️ فشل إيقاف {vm['name']}: {e}")
-
-                    print(f"[AUTO-OFF] ✅ تم فحص الاشتراكات المنتهية ({expired_count} متأثرة).")
-                    last_expire_check = time.time()
+@app.get("/admin/sla")
+def admin_sla():
+    """JSON: إجمالي الأسطول + لكل مالك + أسوأ الآلات + آخر نوافذ التعطل (?owner= ?days= ?worst=)"""
+    if require_admin():
+        return require_admin()
+    try:
+        worst = min(max(int(request.args.get("worst") or 50), 1), 1000)
+    except ValueError:
+        worst = 50
+    return jsonify({"ok": True, **fleet_report(owner=request.args.get("owner") or None,
+                                                days=_report_days(), worst=worst)})
+
+@app.get("/admin/sla/vm/<name>")
+def admin_sla_vm(name):
+    if require_admin():
+        return require_admin()
+    report = vm_report(name, days=_report_days())
+    if report is None:
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    return jsonify({"ok": True, "vm": report})
 
-            except Exception as e:
-                print(f"[AUTO-OFF ERROR] ❌ خطأ في الحلقة الخلفية: {e}")
+@app.get("/admin/sla/view")
+def admin_sla_view():
+    if require_admin():
+        return require_admin()
+    owner = request.args.get("owner") or None
+    return render_template("sla.html", report=fleet_report(owner=owner, days=_report_days()), owner=owner)
+
+@app.get("/admin/pool_stats")
+def admin_pool_stats():
+    if require_admin():
+        return require_admin()
+    return jsonify(warm_pool.stats())
+
+@app.get("/admin/leader")
+def admin_leader():
+    if require_admin():
+        return require_admin()
+    return jsonify({**leader.status(), "sync": sync_engine.stats()})
+
+# 📊 مقاييس تُحسب عند القراءة فقط (بدون كلفة على المسارات الساخنة)
+@registry.collector
+def _collect_state():
+    families = [
+        ("dz_vms", "gauge", "VMs by status",
+         [({"status": st or "unknown"}, n) for st, n in vm_status_counts().items()]),
+        ("dz_jobs", "gauge", "Jobs queued/running",
+         [({"status": st}, n) for st, n in job_status_counts().items()]),
+        ("dz_webhook_buffer_pending", "gauge", "VMs waiting in the webhook write-behind buffer",
+         [({}, webhook_writer.stats()["pending"])]),
+        ("dz_sse_subscribers", "gauge", "Open SSE streams", [({}, hub.count())]),
+        ("dz_leader", "gauge", "1 if this process runs the background loops",
+         [({}, int(leader.is_leader))]),
+        ("dz_sync_vms", "gauge", "VMs tracked by the sync engine",
+         [({"state": k}, v) for k, v in sync_engine.stats().items() if k in ("tracked", "in_flight", "backoff")]),
+    ]
+    pool = warm_pool.stats()
+    families.append(("dz_warm_pool_vms", "gauge", "Warm pool VMs by profile and state",
+                     [({"profile": f"{p['memory_mb']}:{p['cpus']}:{p['disk_mb']}", "state": st}, p[st])
+                      for p in pool["profiles"] for st in ("ready", "filling", "target")]))
+    families.append(("dz_warm_pool_claims", "counter", "Warm pool lookups on create",
+                     [({"result": "hit"}, pool["hits"]), ({"result": "miss"}, pool["misses"])]))
+    cache = vm_cache.stats()
+    families.append(("dz_vm_cache", "gauge", "VM cache counters",
+                     [({"key": k}, cache[k]) for k in ("hits", "misses", "evictions", "size")]))
+    families.append(("dz_vbox", "gauge", "VBoxRemote pool and retry counters per host",
+                     [({"host": h, "key": k}, v) for h, hs in vbox.stats().items() for k, v in hs.items()]))
+    families.append(("dz_status_cache", "gauge", "Agent status cache counters per host",
+                     [({"host": h, "key": k}, v) for h, hs in vbox.status_cache_stats().items() for k, v in hs.items()]))
+    return families
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """📊 صيغة Prometheus — بتوكن METRICS_TOKEN إن وُجد، وإلا للأدمن أو من localhost فقط"""
+    if config.METRICS_TOKEN:
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip() or request.args.get("token")
+        if not secrets.compare_digest(token or "", config.METRICS_TOKEN):
+            return "forbidden", 403
+    elif not session.get("is_admin") and request.remote_addr not in ("127.0.0.1", "::1"):
+        return "forbidden", 403
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.get("/admin/cache_stats")
+def admin_cache_stats():
+    if require_admin():
+        return require_admin()
+    return jsonify(vm_cache.stats())
 
-            # 💤 انتظر 30 ثانية قبل إعادة الفحص
-            time.sleep(sync_interval)
+@app.get("/admin/webhook_stats")
+def admin_webhook_stats():
+    if require_admin():
+        return require_admin()
+    return jsonify(webhook_writer.stats())
 
 @app.get('/favicon.ico')
 def favicon():
@@ -702,10 +1545,8 @@ def security_txt():
 if __name__ == "__main__":
     from waitress import serve
     port = int(os.environ.get("PORT", 5000))
-    print(f"[MAIN] Starting Waitress on port {port}")
-    serve(app, host="0.0.0.0", port=port)
-
-
-
-
-
+    log.info("Starting Waitress", extra={"port": port})
+    # SIGTERM → SystemExit حتى تُنفَّذ atexit (تفريغ webhook_writer)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    start_background()
+    serve(app, host="0.0.0.0", port=port, threads=config.WAITRESS_THREADS)
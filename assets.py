@@ -0,0 +1,82 @@
+import gzip, hashlib, os, threading
+from collections import OrderedDict
+
+import config
+
+try:
+    import brotli   # اختياري: pip install brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE = ("text/", "application/json", "application/javascript", "image/svg+xml")
+
+
+class StaticFingerprints:
+    """
+    🔖 بصمة (md5 قصير) لكل ملف ثابت تُضاف للرابط ?v=... فيُخزَّن في المتصفح سنة كاملة
+    وأي تعديل على الملف يغيّر الرابط. في الإنتاج تُحسب مرة واحدة، وفي التطوير حسب mtime.
+    """
+
+    def __init__(self, static_folder, cache_forever=None):
+        self.static_folder = static_folder
+        self.cache_forever = config.PRODUCTION if cache_forever is None else cache_forever
+        self._lock = threading.Lock()
+        self._hashes = {}   # filename -> (mtime, hash)
+
+    def version(self, filename):
+        cached = self._hashes.get(filename)
+        if cached and self.cache_forever:
+            return cached[1]
+        path = os.path.join(self.static_folder, filename)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, "rb") as f:
+            digest = hashlib.md5(f.read()).hexdigest()[:10]
+        with self._lock:
+            self._hashes[filename] = (mtime, digest)
+        return digest
+
+
+def pick_encoding(accept_encoding):
+    """br إذا كانت مكتبة brotli متاحة والمتصفح يقبلها، وإلا gzip، وإلا None"""
+    accepted = {part.split(";")[0].strip().lower() for part in (accept_encoding or "").split(",")}
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=min(config.COMPRESS_LEVEL, 11))
+    return gzip.compress(data, compresslevel=config.COMPRESS_LEVEL, mtime=0)
+
+
+class CompressedCache:
+    """
+    🗜️ نسخ مضغوطة للملفات الثابتة (المفتاح: الملف + ETag + الترميز) حتى لا تُضغط مع كل طلب
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get_or_compress(self, key, data, encoding):
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is not None:
+                self._items.move_to_end(key)
+                return hit
+        out = compress(data, encoding)
+        with self._lock:
+            self._items[key] = out
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+        return out
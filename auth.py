@@ -0,0 +1,69 @@
+import logging, threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import config
+
+log = logging.getLogger("dz.auth")
+
+
+class HasherBusy(Exception):
+    """كل خيوط الهاش مشغولة وطابورها ممتلئ — الطلب يُرفض فورًا بدل حجز خيط الويب"""
+
+
+class PasswordHasher:
+    """
+    🔐 هاش كلمات المرور على مجمع خيوط محدود (PASSWORD_HASH_WORKERS)
+    - الطريقة من PASSWORD_HASH_METHOD؛ الهاشات القديمة تُعاد عند أول دخول ناجح (needs_rehash)
+    - عدد المنتظرين محدود (PASSWORD_HASH_QUEUE): موجة محاولات لا تستهلك كل خيوط Waitress
+    """
+
+    def __init__(self, method=None, workers=None, queue=None):
+        self.method = method or config.PASSWORD_HASH_METHOD
+        self.workers = workers or config.PASSWORD_HASH_WORKERS
+        # البادئة الكاملة كما يكتبها werkzeug (مثلًا "scrypt" → "scrypt:32768:8:1")
+        self.prefix = generate_password_hash("", method=self.method).split("$", 1)[0]
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash")
+        self._slots = threading.BoundedSemaphore(self.workers + (config.PASSWORD_HASH_QUEUE if queue is None else queue))
+
+    def needs_rehash(self, stored):
+        return stored.split("$", 1)[0] != self.prefix
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=config.PASSWORD_HASH_TIMEOUT)
+        except FutureTimeout:
+            raise HasherBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, stored, password):
+        return self._run(check_password_hash, stored, password)
+
+    def rehash_later(self, password, save):
+        """هاش جديد في الخلفية ثم save(new_hash) — لا يؤخر الدخول، ويُتجاهل عند الازدحام"""
+        if not self._slots.acquire(blocking=False):
+            return
+
+        def _job():
+            try:
+                save(generate_password_hash(password, self.method))
+            except Exception:
+                log.exception("فشل تحديث هاش كلمة المرور")
+            finally:
+                self._slots.release()
+
+        try:
+            self._pool.submit(_job)
+        except RuntimeError:
+            self._slots.release()
@@ -0,0 +1,236 @@
+"""
+🧪 محاكي محلي لـ VBOX_API (بديل الـ Agent الحقيقي على Windows)
+
+الاستعمال:
+    python bench/fake_agent.py --port 8099 --fleet-size 300 --latency-ms 40 --failure-rate 0.02 \
+        --webhook-url http://127.0.0.1:5000/api/vm_update
+ثم شغّل اللوحة مع VBOX_API=http://127.0.0.1:8099
+
+يدعم: /api/vm/create, /api/vm/action, /api/vm/status, /api/vm/status_bulk,
+/api/vm/change_password, /api/vm/renew, /api/vm/update_resources
+"""
+import argparse, datetime, random, threading, time
+
+import requests
+from flask import Flask, request, jsonify
+
+
+class FakeAgent:
+    def __init__(self, latency_ms=0, jitter_ms=0, failure_rate=0.0, fleet_size=0,
+                 webhook_url=None, create_seconds=2.0, boot_seconds=1.0, token=None,
+                 bulk=True, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.webhook_url = webhook_url
+        self.create_seconds = create_seconds
+        self.boot_seconds = boot_seconds
+        self.token = token
+        self.bulk = bulk
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.vms = {}
+        self.calls = {}
+        self.http = requests.Session()
+        for i in range(fleet_size):
+            self.vms[fleet_name(i)] = self._new_vm(fleet_name(i), status="running", ip=f"10.0.{i // 250}.{i % 250 + 1}")
+        self.app = self._build_app()
+
+    # ---------- helpers ----------
+    def _new_vm(self, name, status="creating", ip="-", memory_mb=4096, cpus=2, days=35):
+        now = datetime.datetime.utcnow()
+        return {
+            "name": name,
+            "status": status,
+            "ip": ip,
+            "password": "Passw0rd!",
+            "memory_mb": memory_mb,
+            "cpus": cpus,
+            "created_at": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "expires_at": (now + datetime.timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    def _delay(self):
+        ms = self.latency_ms
+        if self.jitter_ms:
+            ms = max(0, ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms))
+        if ms:
+            time.sleep(ms / 1000)
+
+    def _should_fail(self):
+        return self.failure_rate and self.rng.random() < self.failure_rate
+
+    def _count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def _later(self, seconds, fn, *args, **kwargs):
+        t = threading.Timer(seconds, fn, args, kwargs)
+        t.daemon = True
+        t.start()
+
+    def _set(self, name, **fields):
+        with self.lock:
+            vm = self.vms.get(name)
+            if vm is None:
+                return
+            vm.update(fields)
+            snapshot = dict(vm)
+        self.fire_webhook(snapshot)
+
+    def fire_webhook(self, vm):
+        if not self.webhook_url:
+            return
+        try:
+            self.http.post(self.webhook_url, json={
+                "name": vm["name"],
+                "status": vm["status"],
+                "ip_internal": vm["ip"],
+                "password": vm["password"],
+            }, timeout=5)
+        except Exception as e:
+            print(f"[FAKE] ⚠️ فشل إرسال webhook: {e}")
+
+    # ---------- app ----------
+    def _build_app(self):
+        app = Flask("fake_agent")
+        agent = self
+
+        @app.before_request
+        def _gate():
+            agent._count(request.path)
+            if agent.token and request.headers.get("X-API-KEY") != agent.token:
+                return jsonify({"ok": False, "error": "unauthorized"}), 401
+            agent._delay()
+            if agent._should_fail():
+                return jsonify({"ok": False, "error": "injected failure"}), 503
+
+        @app.post("/api/vm/create")
+        def create():
+            d = request.get_json(silent=True) or {}
+            name = d.get("name") or f"Dz_Hosting-{int(time.time() * 1000)}"
+            vm = agent._new_vm(name, memory_mb=d.get("memory_mb") or 4096, cpus=d.get("cpus") or 2)
+            with agent.lock:
+                agent.vms[name] = vm
+            agent._later(agent.create_seconds, agent._set, name, status="running",
+                         ip=f"10.1.{agent.rng.randint(0, 254)}.{agent.rng.randint(1, 254)}")
+            return jsonify({"ok": True, "name": name, "connect": f"sim.local:{33000 + len(agent.vms)}",
+                            "port": 33000 + len(agent.vms), "service_ports": [],
+                            "created_at": vm["created_at"], "expires_at": vm["expires_at"]})
+
+        @app.post("/api/vm/action")
+        def action():
+            d = request.get_json(silent=True) or {}
+            name, act = d.get("name"), d.get("action")
+            with agent.lock:
+                exists = name in agent.vms
+            if not exists:
+                return jsonify({"ok": False, "error": "not_found"}), 404
+            if act == "start":
+                agent._later(agent.boot_seconds, agent._set, name, status="running")
+            elif act == "stop":
+                agent._set(name, status="stopped")
+            elif act == "reset":
+                agent._set(name, status="restarting")
+                agent._later(agent.boot_seconds, agent._set, name, status="running")
+            elif act == "delete":
+                with agent.lock:
+                    agent.vms.pop(name, None)
+            else:
+                return jsonify({"ok": False, "error": "bad_action"}), 400
+            return jsonify({"ok": True})
+
+        @app.get("/api/vm/status")
+        def status():
+            with agent.lock:
+                vm = agent.vms.get(request.args.get("name"))
+                vm = dict(vm) if vm else None
+            if not vm:
+                return jsonify({"ok": False, "status": "not_found"}), 404
+            return jsonify({"ok": True, "status": vm["status"], "ip": vm["ip"]})
+
+        @app.post("/api/vm/status_bulk")
+        def status_bulk():
+            if not agent.bulk:
+                return jsonify({"ok": False, "error": "not_supported"}), 404
+            names = (request.get_json(silent=True) or {}).get("names") or []
+            with agent.lock:
+                out = {n: {"status": agent.vms[n]["status"], "ip": agent.vms[n]["ip"]}
+                       for n in names if n in agent.vms}
+            return jsonify({"ok": True, "vms": out})
+
+        @app.post("/api/vm/change_password")
+        def change_password():
+            d = request.get_json(silent=True) or {}
+            with agent.lock:
+                vm = agent.vms.get(d.get("name"))
+                if not vm or vm["password"] != d.get("current_password"):
+                    return jsonify({"ok": False, "error": "bad_password"})
+                vm["password"] = d.get("new_password")
+            return jsonify({"ok": True})
+
+        @app.post("/api/vm/renew")
+        def renew():
+            d = request.get_json(silent=True) or {}
+            with agent.lock:
+                vm = agent.vms.get(d.get("name"))
+                if not vm:
+                    return jsonify({"ok": False, "error": "not_found"})
+                exp = datetime.datetime.strptime(vm["expires_at"], "%Y-%m-%d %H:%M:%S")
+                vm["expires_at"] = (exp + datetime.timedelta(days=int(d.get("days") or 35))).strftime("%Y-%m-%d %H:%M:%S")
+            return jsonify({"ok": True, "expires_at": vm["expires_at"]})
+
+        @app.post("/api/vm/update_resources")
+        def update_resources():
+            d = request.get_json(silent=True) or {}
+            with agent.lock:
+                vm = agent.vms.get(d.get("name"))
+                if not vm:
+                    return jsonify({"ok": False, "error": "not_found"})
+                vm["memory_mb"], vm["cpus"] = d.get("memory_mb"), d.get("cpus")
+            return jsonify({"ok": True})
+
+        @app.get("/_fake/stats")
+        def stats():
+            with agent.lock:
+                return jsonify({"vms": len(agent.vms), "calls": dict(agent.calls)})
+
+        return app
+
+    def serve_in_thread(self, host="127.0.0.1", port=0):
+        """تشغيل المحاكي في خيط خلفي (للاختبارات والقياس) — يُرجع الرابط"""
+        from werkzeug.serving import make_server
+        server = make_server(host, port, self.app, threaded=True)
+        threading.Thread(target=server.serve_forever, name="fake-agent", daemon=True).start()
+        return f"http://{host}:{server.server_port}", server
+
+
+def fleet_name(i):
+    return f"Dz_Hosting-sim-{i:05d}"
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fake VBOX_API agent")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8099)
+    ap.add_argument("--fleet-size", type=int, default=0)
+    ap.add_argument("--latency-ms", type=float, default=0)
+    ap.add_argument("--jitter-ms", type=float, default=0)
+    ap.add_argument("--failure-rate", type=float, default=0.0)
+    ap.add_argument("--create-seconds", type=float, default=2.0)
+    ap.add_argument("--boot-seconds", type=float, default=1.0)
+    ap.add_argument("--webhook-url", default=None)
+    ap.add_argument("--token", default=None)
+    ap.add_argument("--no-bulk", action="store_true", help="بدون /api/vm/status_bulk (لاختبار المسار الاحتياطي)")
+    args = ap.parse_args()
+
+    agent = FakeAgent(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                      failure_rate=args.failure_rate, fleet_size=args.fleet_size,
+                      webhook_url=args.webhook_url, create_seconds=args.create_seconds,
+                      boot_seconds=args.boot_seconds, token=args.token, bulk=not args.no_bulk)
+    print(f"[FAKE] 🧪 VBOX_API وهمي على http://{args.host}:{args.port} ({args.fleet_size} آلة)")
+    agent.app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
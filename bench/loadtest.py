@@ -0,0 +1,204 @@
+"""
+📈 اختبار حمل لمسارات اللوحة — p50/p95/p99 وعدد الطلبات في الثانية لكل مسار
+
+داخل العملية (افتراضي): قاعدة مؤقتة + VBOX_API وهمي (bench/fake_agent.py) في خيط
+    python bench/loadtest.py --fleet-size 500 --concurrency 16 --seconds 10 \
+        --mix vm_status=6,vm_update=3,admin=1,vm_details=1,customer_action=1 --latency-ms 20
+
+ضد خادم يعمل فعلاً:
+    python bench/loadtest.py --base-url http://127.0.0.1:5000 --admin-user admin --admin-pass changeme
+(في هذا الوضع يجب أن يكون الخادم موصولاً بمحاكي بنفس --fleet-size)
+"""
+import argparse, os, random, sys, tempfile, threading, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_agent import FakeAgent, fleet_name  # noqa: E402
+
+
+def fleet_serial(i):
+    return f"SIM{i:013d}"
+
+
+# ---------- المسارات: fn(client, rng, fleet_size) -> status_code ----------
+def r_vm_status(c, rng, n):
+    return c.get(f"/api/vm_status?serial={fleet_serial(rng.randrange(n))}")
+
+
+def r_vm_update(c, rng, n):
+    return c.post("/api/vm_update", json={
+        "name": fleet_name(rng.randrange(n)),
+        "status": rng.choice(["running", "running", "running", "stopped"]),
+        "ip_internal": f"10.9.{rng.randrange(255)}.{rng.randrange(1, 255)}",
+    })
+
+
+def r_admin(c, rng, n):
+    return c.get("/admin")
+
+
+def r_vm_details(c, rng, n):
+    return c.get(f"/admin/vm/{fleet_name(rng.randrange(n))}")
+
+
+def r_customer_action(c, rng, n):
+    return c.post("/customer/action", data={"serial": fleet_serial(rng.randrange(n)), "action": "refresh"},
+                  headers={"Accept": "application/json"})
+
+
+ROUTES = {
+    "vm_status": r_vm_status,
+    "vm_update": r_vm_update,
+    "admin": r_admin,
+    "vm_details": r_vm_details,
+    "customer_action": r_customer_action,
+}
+
+
+# ---------- العملاء ----------
+class HttpClient:
+    """واجهة مشابهة لـ Flask test client فوق requests.Session"""
+
+    def __init__(self, base_url):
+        import requests
+        self.base = base_url.rstrip("/")
+        self.s = requests.Session()
+
+    def get(self, path, **kw):
+        return _Resp(self.s.get(self.base + path, allow_redirects=False, **kw))
+
+    def post(self, path, **kw):
+        return _Resp(self.s.post(self.base + path, allow_redirects=False, **kw))
+
+
+class _Resp:
+    def __init__(self, r):
+        self.status_code = r.status_code
+
+
+def make_inprocess(args):
+    tmp = tempfile.mkdtemp()
+    os.environ["DB_PATH"] = os.path.join(tmp, "loadtest.db")
+    agent = FakeAgent(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                      failure_rate=args.failure_rate, fleet_size=args.fleet_size)
+    url, _server = agent.serve_in_thread()
+    os.environ["VBOX_API"] = url
+
+    os.environ.setdefault("LOG_LEVEL", "WARNING")  # بدون سجل وصول لكل طلب
+    import db
+    import app as app_module
+    agent.webhook_url = None
+
+    db.init_db()
+    for i in range(args.fleet_size):
+        db.insert_vm(fleet_name(i), fleet_serial(i), f"owner{i % 50}@example.com", "Administrator",
+                     "Passw0rd!", "10.0.0.1", "running", 4096, 2, 25600,
+                     expires_at="2099-01-01 00:00:00")
+
+    def factory():
+        c = app_module.app.test_client()
+        with c.session_transaction() as s:
+            s["is_admin"] = True
+        return c
+    return factory, agent
+
+
+def make_http(args):
+    def factory():
+        c = HttpClient(args.base_url)
+        c.s.post(args.base_url.rstrip("/") + "/admin/login",
+                 data={"user": args.admin_user, "pass": args.admin_pass}, allow_redirects=False)
+        return c
+    return factory, None
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[k]
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(","):
+        name, _, w = part.partition("=")
+        name = name.strip()
+        if name not in ROUTES:
+            raise SystemExit(f"unknown route: {name} (choices: {', '.join(ROUTES)})")
+        mix.append((name, float(w or 1)))
+    return mix
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Load test for the panel routes")
+    ap.add_argument("--base-url", default=None, help="بدونها: داخل العملية مع محاكي")
+    ap.add_argument("--admin-user", default=os.getenv("ADMIN_USER", "admin"))
+    ap.add_argument("--admin-pass", default=os.getenv("ADMIN_PASS", "changeme"))
+    ap.add_argument("--fleet-size", type=int, default=300)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--seconds", type=float, default=10)
+    ap.add_argument("--mix", default="vm_status=6,vm_update=3,admin=1,vm_details=1")
+    ap.add_argument("--latency-ms", type=float, default=0)
+    ap.add_argument("--jitter-ms", type=float, default=0)
+    ap.add_argument("--failure-rate", type=float, default=0.0)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    mix = parse_mix(args.mix)
+    names = [m[0] for m in mix]
+    weights = [m[1] for m in mix]
+    factory, agent = make_http(args) if args.base_url else make_inprocess(args)
+
+    lock = threading.Lock()
+    samples = {n: [] for n in names}
+    errors = {n: 0 for n in names}
+    stop_at = time.perf_counter() + args.seconds
+
+    def worker(idx):
+        rng = random.Random(args.seed * 1000 + idx)
+        client = factory()
+        local = {n: [] for n in names}
+        local_err = {n: 0 for n in names}
+        while time.perf_counter() < stop_at:
+            route = rng.choices(names, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                code = ROUTES[route](client, rng, args.fleet_size).status_code
+            except Exception:
+                code = 599
+            local[route].append(time.perf_counter() - t0)
+            if code >= 400:
+                local_err[route] += 1
+        with lock:
+            for n in names:
+                samples[n].extend(local[n])
+                errors[n] += local_err[n]
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    print(f"\nconcurrency={args.concurrency} seconds={elapsed:.1f} fleet={args.fleet_size} "
+          f"mode={'http ' + args.base_url if args.base_url else 'in-process'}")
+    print(f"{'route':<16}{'count':>8}{'err':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    total = 0
+    for n in names:
+        vals = sorted(samples[n])
+        total += len(vals)
+        print(f"{n:<16}{len(vals):>8}{errors[n]:>6}{len(vals) / elapsed:>9.0f}"
+              f"{percentile(vals, 50) * 1000:>9.1f}{percentile(vals, 95) * 1000:>9.1f}"
+              f"{percentile(vals, 99) * 1000:>9.1f}")
+    print(f"{'TOTAL':<16}{total:>8}{sum(errors.values()):>6}{total / elapsed:>9.0f}")
+    if agent:
+        print(f"fake agent calls: {agent.calls}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+📈 قياس عدد الطلبات في الثانية لـ /api/vm_status (عبر Flask test client)
+
+الاستعمال:
+    python bench/vm_status.py --vms 500 --threads 8 --seconds 5
+    python bench/vm_status.py --baseline   # اتصال جديد لكل استدعاء، بدون WAL وبدون كاش الآلات
+يستعمل قاعدة بيانات مؤقتة، ولا يحتاج VBOX_API حقيقي. طريقة إنتاج الأرقام المنشورة في bench/README.md
+"""
+import argparse, os, sqlite3, sys, tempfile, threading, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--vms", type=int, default=500)
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--seconds", type=float, default=5)
+    ap.add_argument("--baseline", action="store_true",
+                    help="تقريب لما قبل الاتصالات الدائمة: sqlite3.connect لكل استدعاء، journal الافتراضي (DELETE)، بدون كاش")
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    os.environ["DB_PATH"] = os.path.join(tmp, "bench.db")
+    os.environ.setdefault("VBOX_API", "http://127.0.0.1:9")
+    if args.baseline:
+        os.environ["VM_CACHE_TTL"] = "0"
+
+    import db
+    db.DB_PATH = os.environ["DB_PATH"]  # حتى مع الإصدارات التي لا تقرأ DB_PATH من البيئة
+    import app as app_module
+    app_module.app.before_request_funcs.clear()  # بدون طباعة كل طلب
+
+    if args.baseline:
+        # ملف جديد لم يُفتح بـ WAL (الاستيراد فتح الأول بالاتصال الدائم) → journal_mode الافتراضي DELETE
+        db.DB_PATH = os.path.join(tmp, "baseline.db")
+
+        def per_call_conn():
+            conn = sqlite3.connect(db.DB_PATH, isolation_level=None)
+            conn.execute("PRAGMA recursive_triggers=ON")
+            return conn
+        db._conn = per_call_conn
+
+    db.init_db()
+    serials = []
+    for i in range(args.vms):
+        serial = f"BENCH{i:06d}"
+        db.insert_vm(f"bench-{i}", serial, "bench@example.com", "Administrator", "pw",
+                     "10.0.0.1", "running", 4096, 2, 25600)
+        serials.append(serial)
+
+    counts = [0] * args.threads
+    stop_at = time.perf_counter() + args.seconds
+
+    def worker(idx):
+        client = app_module.app.test_client()
+        n = 0
+        while time.perf_counter() < stop_at:
+            r = client.get(f"/api/vm_status?serial={serials[n % len(serials)]}")
+            assert r.status_code == 200, r.status_code
+            n += 1
+        counts[idx] = n
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    total = sum(counts)
+    print(f"/api/vm_status{' [baseline]' if args.baseline else ''}: {total} requests in {elapsed:.2f}s "
+          f"→ {total / elapsed:.0f} req/s ({args.threads} threads, {args.vms} VMs)")
+
+
+if __name__ == "__main__":
+    main()
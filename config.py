@@ -25,6 +25,137 @@ DEFAULT_MEMORY_MB = int(os.getenv("DEFAULT_MEMORY_MB", "4096"))
 DEFAULT_CPUS = int(os.getenv("DEFAULT_CPUS", "2"))
 DEFAULT_DISK_MB = int(os.getenv("DEFAULT_DISK_MB", "25600"))
 
+# 🖥️ الخوادم: الخادم الافتراضي يتبع VBOX_API، والسعة الافتراضية لأي خادم لم تُحدد سعته
+DEFAULT_HOST = os.getenv("DEFAULT_HOST", "default")
+HOST_MEMORY_MB = int(os.getenv("HOST_MEMORY_MB", "131072"))
+HOST_CPUS = int(os.getenv("HOST_CPUS", "32"))
+HOST_DISK_MB = int(os.getenv("HOST_DISK_MB", "2097152"))
+HOSTS_REFRESH_SECONDS = float(os.getenv("HOSTS_REFRESH_SECONDS", "30"))   # إعادة قراءة جدول الخوادم (تعديلات من عمليات أخرى)
+# نسب الإفراط في الحجز (overcommit): السعة القابلة للحجز = السعة × النسبة
+OVERCOMMIT_MEMORY = float(os.getenv("OVERCOMMIT_MEMORY", "1.0"))
+OVERCOMMIT_CPU = float(os.getenv("OVERCOMMIT_CPU", "4.0"))
+OVERCOMMIT_DISK = float(os.getenv("OVERCOMMIT_DISK", "1.0"))
+
+# ⏰ مهلة السماح بعد انتهاء الاشتراك قبل الإيقاف التلقائي (بالأيام)
+EXPIRY_GRACE_DAYS = int(os.getenv("EXPIRY_GRACE_DAYS", "3"))
+
+# 📄 عدد الآلات في كل صفحة من لوحة الأدمن
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "50"))
+
+# 🔌 إعدادات الاتصال بـ VBOX_API (مجمع الاتصالات + المهلات + إعادة المحاولة)
+VBOX_POOL_SIZE = int(os.getenv("VBOX_POOL_SIZE", "16"))
+VBOX_CONNECT_TIMEOUT = float(os.getenv("VBOX_CONNECT_TIMEOUT", "3"))
+VBOX_STATUS_TIMEOUT = float(os.getenv("VBOX_STATUS_TIMEOUT", "5"))
+VBOX_ACTION_TIMEOUT = float(os.getenv("VBOX_ACTION_TIMEOUT", "30"))
+VBOX_LONG_TIMEOUT = float(os.getenv("VBOX_LONG_TIMEOUT", "120"))
+VBOX_RETRY_BACKOFF = float(os.getenv("VBOX_RETRY_BACKOFF", "0.3"))
+VBOX_RETRY_BUDGET = float(os.getenv("VBOX_RETRY_BUDGET", "10"))        # أقصى رصيد لإعادة المحاولة
+VBOX_RETRY_RATIO = float(os.getenv("VBOX_RETRY_RATIO", "0.1"))         # رصيد يُكتسب مع كل طلب ناجح
+VBOX_STATUS_CONCURRENCY = int(os.getenv("VBOX_STATUS_CONCURRENCY", "8"))  # توازي الطلبات الفردية عند غياب status_bulk
+VBOX_ACTION_CONCURRENCY = int(os.getenv("VBOX_ACTION_CONCURRENCY", "8"))  # أقصى إجراءات (تشغيل/إيقاف/إنشاء...) متزامنة لكل Agent
+VBOX_ACTION_WAIT = float(os.getenv("VBOX_ACTION_WAIT", "30"))             # انتظار مكان شاغر قبل الرد "agent busy"
+
+# 🔄 محرك مزامنة الحالة: فترة الفحص حسب الحالة (ثوانٍ) + حالات لا تُفحص أبدًا
+SYNC_INTERVALS = os.getenv("SYNC_INTERVALS", "creating=5,restarting=5,starting=5,stopping=5,error=60,stopped=120,running=300")
+SYNC_DEFAULT_INTERVAL = float(os.getenv("SYNC_DEFAULT_INTERVAL", "60"))   # للحالات غير المذكورة أعلاه
+SYNC_SKIP_STATES = os.getenv("SYNC_SKIP_STATES", "expired,deleted")
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "8"))                        # أقصى طلبات حالة متزامنة
+SYNC_BATCH = int(os.getenv("SYNC_BATCH", "200"))                          # آلات لكل طلب status_bulk
+SYNC_TICK = float(os.getenv("SYNC_TICK", "1"))
+SYNC_MAX_BACKOFF = float(os.getenv("SYNC_MAX_BACKOFF", "1800"))           # سقف التراجع بعد الفشل المتكرر
+
+# 👑 قائد واحد لحلقات الخلفية (المزامنة والانتهاء) عند تشغيل عدة عمليات
+LEADER_LEASE_SECONDS = float(os.getenv("LEADER_LEASE_SECONDS", "30"))
+LEADER_HEARTBEAT_SECONDS = float(os.getenv("LEADER_HEARTBEAT_SECONDS", "10"))    # يجب أن تكون أقل من ثلث مدة العقد
+
+# ⚡ مخزون آلات مستنسخة مسبقًا (موقوفة) لكل ملف موارد: "memory_mb:cpus:disk_mb=count,..."
+# مثال: "4096:2:25600=3,8192:4:51200=1" — فارغ = معطّل
+WARM_POOL = os.getenv("WARM_POOL", "")
+WARM_POOL_REFILL_SECONDS = float(os.getenv("WARM_POOL_REFILL_SECONDS", "60"))   # استنساخ واحد كل فترة على الأكثر
+WARM_POOL_MAX_FILLING = int(os.getenv("WARM_POOL_MAX_FILLING", "1"))             # استنساخات متزامنة
+WARM_POOL_BOOT_TIMEOUT = int(os.getenv("WARM_POOL_BOOT_TIMEOUT", "1800"))        # انتظار انتهاء الاستنساخ قبل الإيقاف
+WARM_POOL_JOB_WORKERS = int(os.getenv("WARM_POOL_JOB_WORKERS", "1"))            # عمّال المهام التي قد تنتظرها التعبئة (لكل عملية)
+
+# 🧰 العمليات الجماعية للأدمن (/admin/bulk)
+BULK_MAX_VMS = int(os.getenv("BULK_MAX_VMS", "500"))
+
+# 🧵 طابور المهام (إنشاء/تشغيل/إيقاف/تعديل الموارد في الخلفية)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))   # مهام عملية لم تجدد عقدها خلال هذه المدة → interrupted
+RESIZE_STOP_TIMEOUT = int(os.getenv("RESIZE_STOP_TIMEOUT", "30"))
+# حد إجراءات الزبون لكل سيريال (دلو رموز): الضغطات المتكررة لنفس الإجراء تُدمج في نفس المهمة
+CUSTOMER_ACTION_RATE = float(os.getenv("CUSTOMER_ACTION_RATE", "0.1"))   # إجراء/ثانية
+CUSTOMER_ACTION_BURST = int(os.getenv("CUSTOMER_ACTION_BURST", "5"))
+
+# 📡 قناة الأحداث SSE — كل اتصال SSE يحجز خيطًا من Waitress طوال مدته،
+# لذلك SSE_MAX_CLIENTS يجب أن يبقى أقل من WAITRESS_THREADS
+WAITRESS_THREADS = int(os.getenv("WAITRESS_THREADS", "16"))
+SSE_MAX_CLIENTS = int(os.getenv("SSE_MAX_CLIENTS", "8"))
+SSE_MAX_SECONDS = int(os.getenv("SSE_MAX_SECONDS", "300"))        # ثم يعيد المتصفح الاتصال تلقائيًا
+SSE_HEARTBEAT_SECONDS = int(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+# مع عدة عمليات تمر الأحداث عبر جدول event_relay حتى يراها مشتركو كل العمليات (0 = عملية واحدة، بلا ترحيل)
+EVENT_RELAY_SECONDS = float(os.getenv("EVENT_RELAY_SECONDS", "0.5"))
+EVENT_RELAY_KEEP_SECONDS = float(os.getenv("EVENT_RELAY_KEEP_SECONDS", "60"))
+
+# 📝 الكتابة المؤجلة لتحديثات /api/vm_update
+WEBHOOK_BUFFER_MAX = int(os.getenv("WEBHOOK_BUFFER_MAX", "5000"))       # عدد الآلات المعلّقة قبل الرد 429
+WEBHOOK_FLUSH_BATCH = int(os.getenv("WEBHOOK_FLUSH_BATCH", "200"))
+WEBHOOK_FLUSH_INTERVAL = float(os.getenv("WEBHOOK_FLUSH_INTERVAL", "0.5"))
+
+# 📊 /metrics — إذا تُرك فارغًا يُسمح فقط للأدمن أو من localhost
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# 📝 السجلات: مستوى عام + مستويات لكل وحدة + أخذ عينات للأحداث الكثيرة
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "werkzeug=WARNING,urllib3=WARNING,waitress=INFO")   # "dz.vbox=DEBUG,..."
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "dz.http=0.05")                                      # نسبة سجلات INFO/DEBUG المحتفظ بها
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")                                              # json أو text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# 🗄️ إعدادات SQLite (اتصال دائم لكل خيط + WAL)
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")           # NORMAL آمن مع WAL
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "8192"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+
+# 🧠 كاش سجلات الآلات (vm_by_name / vm_by_serial)
+VM_CACHE_SIZE = int(os.getenv("VM_CACHE_SIZE", "2048"))
+VM_CACHE_TTL = float(os.getenv("VM_CACHE_TTL", "5"))        # 0 = تعطيل الكاش
+
+# 📡 كاش ردود الحالة من الـ Agent (حالة + IP) مع دمج الطلبات المتزامنة لنفس الآلة
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", "2"))     # 0 = تعطيل
+STATUS_CACHE_SIZE = int(os.getenv("STATUS_CACHE_SIZE", "10000"))
+
+# 🕓 سجل حالات الآلات: أحداث تفصيلية لهذه المدة، وما قبلها ملخص يومي فقط
+VM_EVENTS_KEEP_DAYS = int(os.getenv("VM_EVENTS_KEEP_DAYS", "35"))
+VM_EVENTS_ROLLUP_SECONDS = float(os.getenv("VM_EVENTS_ROLLUP_SECONDS", "3600"))
+VM_SLA_KEEP_DAYS = int(os.getenv("VM_SLA_KEEP_DAYS", "35"))            # مجاميع SLA لآلة محذوفة
+VM_OUTAGES_KEEP_DAYS = int(os.getenv("VM_OUTAGES_KEEP_DAYS", "400"))    # نوافذ التعطل المنتهية = أطول فترة للتقارير
+
+# 📈 SLA: حالات "متاح" و"معطل" (غيرها، مثل الإيقاف من الزبون، لا يُحسب) + الهدف
+SLA_UP_STATES = os.getenv("SLA_UP_STATES", "running")
+SLA_DOWN_STATES = os.getenv("SLA_DOWN_STATES", "error,aborted,unknown,gurumeditation")
+SLA_TARGET = float(os.getenv("SLA_TARGET", "0.999"))
+
+# 🔐 كلمات مرور الزبائن: طريقة الهاش (werkzeug) + مجمع خيوط محدود + حد المحاولات
+PASSWORD_HASH_METHOD = os.getenv("PASSWORD_HASH_METHOD", "pbkdf2:sha256:600000")   # أو "scrypt:32768:8:1"
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))      # أقصى هاشات متزامنة
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "16"))         # المنتظرون بعدها يُرفضون فورًا (503)
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "10"))
+LOGIN_RATE_PER_IP = float(os.getenv("LOGIN_RATE_PER_IP", "0.2"))         # محاولة/ثانية (دلو رموز)
+LOGIN_BURST_PER_IP = int(os.getenv("LOGIN_BURST_PER_IP", "10"))
+LOGIN_RATE_PER_EMAIL = float(os.getenv("LOGIN_RATE_PER_EMAIL", "0.05"))
+LOGIN_BURST_PER_EMAIL = int(os.getenv("LOGIN_BURST_PER_EMAIL", "5"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))    # أقدم المفاتيح تُنسى بعدها
+
+# 🚀 وضع الإنتاج: بدون إعادة تحميل القوالب + أصول ثابتة ببصمة وتخزين طويل في المتصفح
+PRODUCTION = os.getenv("DZ_ENV", "development").lower() == "production"
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "31536000"))      # للروابط ذات البصمة (?v=...)
+STATIC_FALLBACK_MAX_AGE = int(os.getenv("STATIC_FALLBACK_MAX_AGE", "300"))
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "500"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
 # ✅ (اختياري) طباعة للتأكد أن القيم تُقرأ بشكل صحيح عند التشغيل
 if __name__ == "__main__":
     print("=== Config Debug ===")
@@ -1,121 +1,125 @@
-import sqlite3, os, datetime
+import sqlite3, os, datetime, threading, json, time, logging, math
+from contextlib import contextmanager
 
-DB_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), "vms.db")
+import config
+from vmcache import VMCache, VMRecord
+from metrics import timed_db
 
+DB_PATH = os.getenv("DB_PATH") or os.path.join(os.path.abspath(os.path.dirname(__file__)), "vms.db")
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+log = logging.getLogger("dz.db")
 
-    # ✅ جدول الآلات الافتراضية (vms)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS vms (
-        name TEXT PRIMARY KEY,
-        serial TEXT,
-        owner TEXT,
-        user TEXT,
-        password TEXT,
-        ip TEXT,
-        status TEXT,
-        memory INT,
-        cpus INT,
-        disk INT,
-        connect TEXT,
-        port INT,
-        service_ports TEXT,
-        activated INT DEFAULT 0,
-        created_at TEXT DEFAULT (datetime('now')),
-        expires_at TEXT
-    )
-    """)
+# 🔹 اتصال واحد دائم لكل خيط (Waitress + حلقة المزامنة) بدل فتح اتصال لكل استعلام
+_local = threading.local()
 
-    # ✅ جدول المستخدمين (الزبائن)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        email TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        serial TEXT,  -- ✅ لحفظ السيريال المرتبط بالمستخدم بعد التفعيل
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
+# 🔔 مستمعون لتغيّر مواعيد الانتهاء (مثل مُجدول الإيقاف في expiry.py)
+_expiry_listeners = []
+
+# 🧠 كاش قراءة vm_by_name / vm_by_serial — يُبطَل بعد كل كتابة على vms
+vm_cache = VMCache()
+
+VM_COLUMNS = """name, serial, owner, user, password, ip, status, memory, cpus, disk,
+               connect, port, service_ports, activated, created_at, expires_at, host"""
 
-    conn.commit()
-    conn.close()
+
+def _open():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=config.DB_BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,  # autocommit — المعاملات صريحة عبر transaction()
+        cached_statements=config.DB_STATEMENT_CACHE,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={config.DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={int(config.DB_BUSY_TIMEOUT_MS)}")
+    conn.execute(f"PRAGMA cache_size={-int(config.DB_CACHE_KB)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # REPLACE INTO يحذف الصف القديم → مشغّلات الحذف يجب أن تعمل حتى يبقى دفتر السعة صحيحًا
+    conn.execute("PRAGMA recursive_triggers=ON")
+    return conn
 
 
 # 🔹 أداة اتصال أساسية
 def _conn():
-    return sqlite3.connect(DB_PATH)
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_PATH:
+        if conn is not None:
+            conn.close()
+        conn = _open()
+        _local.conn = conn
+        _local.path = DB_PATH
+    return conn
 
 
-# ✅ إدخال آلة جديدة
-def insert_vm(name, serial, owner, user, password, ip, status,
-              memory, cpus, disk, connect=None, port=None, service_ports=None,
-              created_at=None, expires_at=None):
-    conn = _conn()
-    c = conn.cursor()
-    c.execute("""
-        REPLACE INTO vms
-        (name, serial, owner, user, password, ip, status, memory, cpus, disk,
-         connect, port, service_ports, created_at, expires_at)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-    """, (name, serial, owner, user, password, ip, status, memory, cpus, disk,
-          connect, port, service_ports, created_at, expires_at))
-    conn.commit()
-    conn.close()
+def close_connection():
+    """إغلاق اتصال الخيط الحالي (عند الإيقاف أو في السكربتات)"""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
 
 
-# ✅ عرض جميع الآلات
-def list_vms():
+@contextmanager
+def transaction():
+    """
+    معاملة كتابة: BEGIN IMMEDIATE ثم COMMIT أو ROLLBACK عند الخطأ.
+    المعاملات المتداخلة تنضم للمعاملة الخارجية، وما سُجّل عبر after_commit يُنفّذ بعد COMMIT الخارجي فقط.
+    """
     conn = _conn()
-    c = conn.cursor()
-    c.execute("""
-        SELECT name, serial, owner, user, password, ip, status, memory, cpus, disk,
-               connect, port, service_ports, activated, created_at, expires_at
-        FROM vms
-    """)
-    rows = c.fetchall()
-    conn.close()
-
-    vms = []
-    for r in rows:
-        vms.append({
-            'name': r[0],
-            'serial': r[1],
-            'owner': r[2],
-            'user': r[3],
-            'password': r[4],
-            'ip': r[5],
-            'status': r[6],
-            'memory': r[7],
-            'cpus': r[8],
-            'disk': r[9],
-            'connect': r[10],
-            'port': r[11],
-            'service_ports': r[12].split(',') if r[12] else [],
-            'activated': r[13],
-            'created_at': r[14],
-            'expires_at': r[15]
-        })
-    return vms
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    _local.after_commit = []
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        _local.after_commit = []
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    callbacks, _local.after_commit = _local.after_commit, []
+    for fn in callbacks:
+        try:
+            fn()
+        except Exception as e:
+            log.warning("فشل إجراء ما بعد المعاملة", extra={"error": str(e)})
 
 
-# ✅ البحث بالـ serial
-def vm_by_serial(serial):
-    conn = _conn()
-    c = conn.cursor()
-    c.execute("""
-        SELECT name, serial, owner, user, password, ip, status, memory, cpus, disk,
-               connect, port, service_ports, activated, created_at, expires_at
-        FROM vms WHERE serial=?
-    """, (serial,))
-    r = c.fetchone()
-    conn.close()
+def after_commit(fn):
+    """
+    تنفيذ fn بعد COMMIT المعاملة الجارية (تُهمل عند ROLLBACK)، أو فورًا خارج أي معاملة.
+    تفريغ الكاش وإيقاظ مُجدول الانتهاء قبل COMMIT يترك قارئًا آخر يخزّن الصف القديم.
+    """
+    if _conn().in_transaction:
+        _local.after_commit.append(fn)
+    else:
+        fn()
+
+
+def _invalidate(names=(), serials=()):
+    after_commit(lambda: vm_cache.invalidate(names=names, serials=serials))
+
+
+def on_expiry_change(fn):
+    _expiry_listeners.append(fn)
+    return fn
 
-    if not r:
-        return None
 
+def _notify_expiry():
+    after_commit(_run_expiry_listeners)
+
+
+def _run_expiry_listeners():
+    for fn in _expiry_listeners:
+        try:
+            fn()
+        except Exception as e:
+            log.warning("فشل إشعار تغيّر الانتهاء", extra={"error": str(e)})
+
+
+def _vm_dict(r):
     return {
         'name': r[0],
         'serial': r[1],
@@ -132,136 +136,1237 @@ def vm_by_serial(serial):
         'service_ports': r[12].split(',') if r[12] else [],
         'activated': r[13],
         'created_at': r[14],
-        'expires_at': r[15]
+        'expires_at': r[15],
+        'host': r[16]
     }
 
 
-# ✅ البحث بالاسم
-def vm_by_name(name):
-    conn = _conn()
-    c = conn.cursor()
-    c.execute("""
-        SELECT name, serial, owner, user, password, ip, status, memory, cpus, disk,
-               connect, port, service_ports, activated, created_at, expires_at
-        FROM vms WHERE name=?
-    """, (name,))
-    r = c.fetchone()
-    conn.close()
+@timed_db
+def init_db():
+    with transaction() as conn:
+        # ✅ جدول الآلات الافتراضية (vms)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS vms (
+            name TEXT PRIMARY KEY,
+            serial TEXT,
+            owner TEXT,
+            user TEXT,
+            password TEXT,
+            ip TEXT,
+            status TEXT,
+            memory INT,
+            cpus INT,
+            disk INT,
+            connect TEXT,
+            port INT,
+            service_ports TEXT,
+            activated INT DEFAULT 0,
+            created_at TEXT DEFAULT (datetime('now')),
+            expires_at TEXT
+        )
+        """)
 
-    if not r:
+        # ✅ جدول المستخدمين (الزبائن)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            serial TEXT,  -- ✅ لحفظ السيريال المرتبط بالمستخدم بعد التفعيل
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+
+    migrate()
+    sync_sla_states()
+
+
+# 🕒 تحويل نص التاريخ (UTC) إلى epoch صحيح للفهرسة
+def to_epoch(value):
+    if not value:
         return None
+    try:
+        dt = datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+    return int(dt.replace(tzinfo=datetime.timezone.utc).timestamp())
 
-    return {
+
+# 🧱 الترحيلات (migrations) — رقم الإصدار محفوظ في PRAGMA user_version
+def _m1_lookup_indexes(conn):
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_vms_serial ON vms(serial)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vms_owner ON vms(owner)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vms_status ON vms(status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_serial ON users(serial)")
+
+
+def _m2_expires_epoch(conn):
+    # expires_at يبقى نصًا للعرض، و expires_ts (epoch) هو المفهرس للاستعلامات
+    conn.execute("ALTER TABLE vms ADD COLUMN expires_ts INTEGER")
+    rows = conn.execute("SELECT name, expires_at FROM vms WHERE expires_at IS NOT NULL").fetchall()
+    conn.executemany("UPDATE vms SET expires_ts=? WHERE name=?",
+                     [(to_epoch(exp), name) for name, exp in rows])
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vms_expires_ts ON vms(expires_ts)")
+
+
+def _m3_jobs(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        vm_name TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        payload TEXT,
+        status TEXT NOT NULL DEFAULT 'queued',   -- queued / running / done / failed
+        progress TEXT,
+        result TEXT,
+        error TEXT,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_vm ON jobs(vm_name, status)")
+
+
+def _m4_leases(conn):
+    # عقد إيجار بين العمليات (انتخاب قائد واحد لحلقات الخلفية)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """)
+
+
+def _m5_hosts(conn):
+    # عدة خوادم (Agent لكل خادم) + خادم كل آلة؛ الآلات القديمة (host NULL) على الخادم الافتراضي
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS hosts (
+        name TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        token TEXT,
+        memory_mb INTEGER,      -- NULL = HOST_MEMORY_MB
+        cpus INTEGER,           -- NULL = HOST_CPUS
+        disk_mb INTEGER,        -- NULL = HOST_DISK_MB
+        enabled INTEGER NOT NULL DEFAULT 1
+    )
+    """)
+    conn.execute("ALTER TABLE vms ADD COLUMN host TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vms_host ON vms(host)")
+
+
+def _m6_capacity_ledger(conn):
+    # دفتر السعة: مجموع موارد الآلات لكل خادم، تحدّثه مشغّلات vms عند كل إدخال/حذف/تعديل
+    default = config.DEFAULT_HOST.replace("'", "''")
+    conn.execute("UPDATE vms SET host=? WHERE host IS NULL", (config.DEFAULT_HOST,))
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS host_usage (
+        host TEXT PRIMARY KEY,
+        memory_mb INTEGER NOT NULL DEFAULT 0,
+        cpus INTEGER NOT NULL DEFAULT 0,
+        disk_mb INTEGER NOT NULL DEFAULT 0,
+        vms INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    add = f"""
+        INSERT INTO host_usage (host, memory_mb, cpus, disk_mb, vms)
+        VALUES (COALESCE(NEW.host, '{default}'), COALESCE(NEW.memory, 0), COALESCE(NEW.cpus, 0), COALESCE(NEW.disk, 0), 1)
+        ON CONFLICT(host) DO UPDATE SET memory_mb=memory_mb+excluded.memory_mb, cpus=cpus+excluded.cpus,
+            disk_mb=disk_mb+excluded.disk_mb, vms=vms+1;
+    """
+    sub = f"""
+        UPDATE host_usage SET memory_mb=memory_mb-COALESCE(OLD.memory, 0), cpus=cpus-COALESCE(OLD.cpus, 0),
+            disk_mb=disk_mb-COALESCE(OLD.disk, 0), vms=vms-1
+        WHERE host=COALESCE(OLD.host, '{default}');
+    """
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_vms_usage_ins AFTER INSERT ON vms BEGIN {add} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_vms_usage_del AFTER DELETE ON vms BEGIN {sub} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_vms_usage_upd AFTER UPDATE OF memory, cpus, disk, host ON vms "
+                 f"BEGIN {sub} {add} END")
+    _rebuild_host_usage(conn)
+
+
+def _rebuild_host_usage(conn):
+    conn.execute("DELETE FROM host_usage")
+    conn.execute("""
+        INSERT INTO host_usage (host, memory_mb, cpus, disk_mb, vms)
+        SELECT host, COALESCE(SUM(memory), 0), COALESCE(SUM(cpus), 0), COALESCE(SUM(disk), 0), COUNT(*)
+        FROM vms WHERE host IS NOT NULL GROUP BY host
+    """)
+
+
+def _m7_warm_pool(conn):
+    # آلات مستنسخة مسبقًا: pool = 'filling' أثناء الاستنساخ، 'ready' متاحة، NULL آلة زبون عادية
+    conn.execute("ALTER TABLE vms ADD COLUMN pool TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vms_pool ON vms(pool, memory, cpus, disk)")
+
+
+# الوقت الحالي (epoch بكسور الثانية) داخل SQL — unixepoch('subsec') يحتاج SQLite ≥ 3.42
+NOW_SQL = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+def _m8_vm_events(conn):
+    # سجل إلحاقي لتغيّرات الآلات تكتبه مشغّلات vms داخل نفس معاملة التعديل (دفعات الـ webhook معاملة واحدة)
+    # + ملخص يومي مضغوط لكل آلة (vm_days) تُحذف بعده الأحداث الأقدم من VM_EVENTS_KEEP_DAYS
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS vm_events (
+        id INTEGER PRIMARY KEY,
+        vm_name TEXT NOT NULL,
+        ts REAL NOT NULL,
+        kind TEXT NOT NULL,      -- created / status / ip / resized / deleted
+        value TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vm_events_vm_ts ON vm_events(vm_name, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vm_events_ts ON vm_events(ts)")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS vm_days (
+        vm_name TEXT NOT NULL,
+        day INTEGER NOT NULL,            -- بداية اليوم (UTC epoch)
+        observed_s REAL NOT NULL,        -- ثوانٍ حالتها معروفة (الآلة موجودة)
+        running_s REAL NOT NULL,
+        transitions INTEGER NOT NULL,
+        last_status TEXT,                -- حالة نهاية اليوم = حالة بداية اليوم التالي
+        PRIMARY KEY (vm_name, day)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vm_days_day ON vm_days(day)")
+
+    def event(row, kind, value):
+        return f"INSERT INTO vm_events (vm_name, ts, kind, value) VALUES ({row}.name, {NOW_SQL}, '{kind}', {value});"
+
+    # آلات المخزون الجاهز لا تُسجَّل حتى تُؤخذ (pool → NULL يُسجَّل كإنشاء)
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_vms_ev_ins AFTER INSERT ON vms WHEN NEW.pool IS NULL
+                     BEGIN {event("NEW", "created", "NEW.status")} END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_vms_ev_claim AFTER UPDATE OF pool ON vms
+                     WHEN OLD.pool IS NOT NULL AND NEW.pool IS NULL
+                     BEGIN {event("NEW", "created", "NEW.status")} END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_vms_ev_status AFTER UPDATE OF status ON vms
+                     WHEN OLD.pool IS NULL AND NEW.pool IS NULL AND NEW.status IS NOT OLD.status
+                     BEGIN {event("NEW", "status", "NEW.status")} END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_vms_ev_ip AFTER UPDATE OF ip ON vms
+                     WHEN NEW.pool IS NULL AND NEW.ip IS NOT OLD.ip
+                     BEGIN {event("NEW", "ip", "NEW.ip")} END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_vms_ev_resize AFTER UPDATE OF memory, cpus ON vms
+                     WHEN NEW.pool IS NULL AND (NEW.memory IS NOT OLD.memory OR NEW.cpus IS NOT OLD.cpus)
+                     BEGIN {event("NEW", "resized", "NEW.memory || '/' || NEW.cpus")} END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS trg_vms_ev_del AFTER DELETE ON vms WHEN OLD.pool IS NULL
+                     BEGIN {event("OLD", "deleted", "NULL")} END""")
+    # نقطة البداية: الحالة الحالية لكل آلة موجودة
+    conn.execute(f"""
+        INSERT INTO vm_events (vm_name, ts, kind, value)
+        SELECT name, {NOW_SQL}, 'status', status FROM vms WHERE pool IS NULL
+    """)
+
+
+def _m9_sla(conn):
+    # 📈 مجاميع SLA تراكمية لكل آلة + نوافذ التعطل، يحدّثها مشغّل على vm_events مع كل تحول (بلا إعادة مسح)
+    # تصنيف الحالات (up / down / other) في sla_states ويُزامَن من الإعدادات عند كل تشغيل
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sla_states (
+        status TEXT PRIMARY KEY,
+        category TEXT NOT NULL            -- up / down (غير المذكورة: other لا تُحسب)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS vm_sla (
+        vm_name TEXT PRIMARY KEY,
+        status TEXT,
+        since REAL NOT NULL,              -- بداية الحالة الحالية
+        up_s REAL NOT NULL DEFAULT 0,
+        down_s REAL NOT NULL DEFAULT 0,
+        outages INTEGER NOT NULL DEFAULT 0,
+        recoveries INTEGER NOT NULL DEFAULT 0,
+        recovery_s REAL NOT NULL DEFAULT 0,
+        down_since REAL                   -- بداية التعطل الجاري (NULL إن لم يكن معطلًا)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS vm_outages (
+        id INTEGER PRIMARY KEY,
+        vm_name TEXT NOT NULL,
+        started REAL NOT NULL,
+        ended REAL,
+        status TEXT
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vm_outages_vm ON vm_outages(vm_name, started)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vm_outages_started ON vm_outages(started)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vm_outages_open ON vm_outages(vm_name) WHERE ended IS NULL")
+
+    new = "(CASE NEW.kind WHEN 'deleted' THEN 'deleted' ELSE NEW.value END)"
+
+    def cat(expr):
+        return f"COALESCE((SELECT category FROM sla_states WHERE status = {expr}), 'other')"
+
+    def went_down(t):
+        return f"({cat(t + '.status')} != 'down' AND {cat(new)} = 'down')"
+
+    def came_back(t):
+        return f"({cat(t + '.status')} = 'down' AND {cat(new)} != 'down')"
+
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_vm_events_sla AFTER INSERT ON vm_events
+    WHEN NEW.kind IN ('created', 'status', 'deleted')
+    BEGIN
+        INSERT OR IGNORE INTO vm_sla (vm_name, status, since) VALUES (NEW.vm_name, NULL, NEW.ts);
+        INSERT INTO vm_outages (vm_name, started, status)
+            SELECT NEW.vm_name, NEW.ts, {new} FROM vm_sla s WHERE s.vm_name = NEW.vm_name AND {went_down('s')};
+        UPDATE vm_outages SET ended = NEW.ts
+            WHERE vm_name = NEW.vm_name AND ended IS NULL AND {cat(new)} != 'down';
+        UPDATE vm_sla SET
+            up_s = up_s + CASE WHEN {cat('vm_sla.status')} = 'up' THEN MAX(NEW.ts - since, 0) ELSE 0 END,
+            down_s = down_s + CASE WHEN {cat('vm_sla.status')} = 'down' THEN MAX(NEW.ts - since, 0) ELSE 0 END,
+            outages = outages + {went_down('vm_sla')},
+            recoveries = recoveries + {came_back('vm_sla')},
+            recovery_s = recovery_s + CASE WHEN {came_back('vm_sla')} THEN MAX(NEW.ts - down_since, 0) ELSE 0 END,
+            down_since = CASE WHEN {went_down('vm_sla')} THEN NEW.ts WHEN {cat(new)} != 'down' THEN NULL ELSE down_since END,
+            status = {new},
+            since = NEW.ts
+        WHERE vm_name = NEW.vm_name;
+    END
+    """)
+    # نقطة البداية: الحالة الحالية لكل آلة (التاريخ قبل الترحيل غير معروف)
+    conn.execute(f"""
+        INSERT OR IGNORE INTO vm_sla (vm_name, status, since)
+        SELECT name, status, {NOW_SQL} FROM vms WHERE pool IS NULL
+    """)
+
+
+def _m10_multiprocess(conn):
+    # عدة عمليات: كل مهمة running تحمل عقد العملية التي تنفّذها،
+    # وجدول مرحّل للأحداث كي تصل أحداث SSE لمشتركي كل العمليات
+    conn.execute("ALTER TABLE jobs ADD COLUMN worker TEXT")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS event_relay (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        origin TEXT NOT NULL,
+        event TEXT NOT NULL,
+        ts REAL NOT NULL
+    )
+    """)
+
+
+def _m11_live_vm_indexes(conn):
+    # فهارس جزئية لقائمة اللوحة (pool IS NULL): كل ترتيب/فلتر يُقرأ من فهرس بالترتيب بدل TEMP B-TREE
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vms_live_name ON vms(name) WHERE pool IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vms_live_status ON vms(status, name) WHERE pool IS NULL")
+    conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_vms_live_expires
+        ON vms({_EXPIRES_KEY}, name) WHERE pool IS NULL
+    """)
+
+
+def _m12_live_vm_filters(conn):
+    # فلاتر المالك/الخادم في اللوحة والعمليات الجماعية: مرتبة بالاسم وبدون آلات المخزون
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vms_live_owner ON vms(owner, name) WHERE pool IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vms_live_host ON vms(host, name) WHERE pool IS NULL")
+
+
+def _m13_watermarks(conn):
+    # علامات تقدّم المهام الدورية (أول يوم لم يُلخَّص في vm_days...) بدل استنتاجها من آخر صف كُتب:
+    # يوم بلا آلات لا يكتب صفًا، فكان يُعاد تلخيصه مع كل ما بعده في كل دورة
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS watermarks (
+        name TEXT PRIMARY KEY,
+        value REAL NOT NULL
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO watermarks (name, value)
+        SELECT 'vm_days', MAX(day) + 86400 FROM vm_days HAVING MAX(day) IS NOT NULL
+    """)
+
+
+MIGRATIONS = [
+    (1, _m1_lookup_indexes),
+    (2, _m2_expires_epoch),
+    (3, _m3_jobs),
+    (4, _m4_leases),
+    (5, _m5_hosts),
+    (6, _m6_capacity_ledger),
+    (7, _m7_warm_pool),
+    (8, _m8_vm_events),
+    (9, _m9_sla),
+    (10, _m10_multiprocess),
+    (11, _m11_live_vm_indexes),
+    (12, _m12_live_vm_filters),
+    (13, _m13_watermarks),
+]
+
+
+@timed_db
+def migrate():
+    """تطبيق الترحيلات الناقصة بالترتيب، كلها في معاملة واحدة"""
+    with transaction() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, step in MIGRATIONS:
+            if target <= version:
+                continue
+            step(conn)
+            conn.execute(f"PRAGMA user_version={target}")
+            log.info("تم تطبيق الترحيل", extra={"version": target, "step": step.__name__})
+
+
+# ✅ إدخال آلة جديدة
+@timed_db
+def insert_vm(name, serial, owner, user, password, ip, status,
+              memory, cpus, disk, connect=None, port=None, service_ports=None,
+              created_at=None, expires_at=None, host=None, pool=None):
+    host = host or config.DEFAULT_HOST
+    with transaction() as conn:
+        conn.execute("""
+            REPLACE INTO vms
+            (name, serial, owner, user, password, ip, status, memory, cpus, disk,
+             connect, port, service_ports, created_at, expires_at, expires_ts, host, pool)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+        """, (name, serial, owner, user, password, ip, status, memory, cpus, disk,
+              connect, port, service_ports, created_at, expires_at, to_epoch(expires_at), host, pool))
+    _invalidate(names=[name], serials=[serial])
+    if expires_at:
+        _notify_expiry()
+
+
+# ✅ عرض جميع الآلات
+@timed_db
+def list_vms():
+    rows = _conn().execute(f"SELECT {VM_COLUMNS} FROM vms").fetchall()
+    return [_vm_dict(r) for r in rows]
+
+
+# ✅ صفحة من الآلات للوحة الأدمن (keyset pagination + فلترة + ترتيب) — أعمدة مختصرة بدون كلمات المرور
+VM_SLIM_COLUMNS = "name, serial, owner, status, memory, cpus, disk, activated, expires_at, expires_ts, host"
+_NO_EXPIRY = 2 ** 62   # الآلات بلا تاريخ انتهاء تأتي آخر القائمة
+# نفس النص حرفيًا في الاستعلام وفي فهرس idx_vms_live_expires (شرط استعمال فهرس التعبير)
+_EXPIRES_KEY = f"COALESCE(expires_ts, {_NO_EXPIRY})"
+
+
+@timed_db
+def list_vms_page(limit=50, cursor=None, status=None, owner=None, expires_before=None, sort="name", host=None):
+    """
+    يُرجع (vms, next_cursor). cursor نص غير شفاف يأتي من الصفحة السابقة (ValueError إذا كان تالفًا).
+    sort: "name" أو "expires"
+    """
+    where, args = ["pool IS NULL"], []   # آلات المخزون الجاهز لا تظهر في اللوحة
+    if status:
+        where.append("status=?")
+        args.append(status)
+    if owner:
+        where.append("owner=?")
+        args.append(owner)
+    if host:
+        where.append("host=?")
+        args.append(host)
+    if sort == "expires":
+        key = _EXPIRES_KEY
+        if expires_before:
+            # مكافئ لـ expires_ts < ? (NULL → _NO_EXPIRY لا يمر) لكنه مدى على نفس فهرس الترتيب
+            where.append(f"{key} < ?")
+            args.append(int(expires_before))
+        if cursor:
+            ts, sep, after = cursor.partition(":")
+            if not sep or not ts.isdigit():
+                raise ValueError("invalid cursor")
+            # (key, name) > (ts, after) مكتوبة بحيث يبدأ البحث في الفهرس من ts مباشرة
+            where.append(f"{key} >= ? AND ({key} > ? OR name > ?)")
+            args += [int(ts), int(ts), after]
+        order = f"{key}, name"
+    else:
+        if expires_before:
+            where.append("expires_ts < ?")
+            args.append(int(expires_before))
+        if cursor:
+            where.append("name > ?")
+            args.append(cursor)
+        order = "name"
+
+    sql = f"SELECT {VM_SLIM_COLUMNS} FROM vms"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order} LIMIT ?"
+    rows = _conn().execute(sql, args + [limit + 1]).fetchall()
+
+    vms = [{
         'name': r[0],
         'serial': r[1],
         'owner': r[2],
-        'user': r[3],
-        'password': r[4],
-        'ip': r[5],
-        'status': r[6],
-        'memory': r[7],
-        'cpus': r[8],
-        'disk': r[9],
-        'connect': r[10],
-        'port': r[11],
-        'service_ports': r[12].split(',') if r[12] else [],
-        'activated': r[13],
-        'created_at': r[14],
-        'expires_at': r[15]
-    }
+        'status': r[3],
+        'memory': r[4],
+        'cpus': r[5],
+        'disk': r[6],
+        'activated': r[7],
+        'expires_at': r[8],
+        'host': r[10]
+    } for r in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        if sort == "expires":
+            next_cursor = f"{last[9] if last[9] is not None else _NO_EXPIRY}:{last[0]}"
+        else:
+            next_cursor = last[0]
+    return vms, next_cursor
+
+
+# ✅ عدد الآلات لكل حالة (للمقاييس) — عبر فهرس status
+@timed_db
+def vm_status_counts():
+    return dict(_conn().execute("SELECT status, COUNT(*) FROM vms GROUP BY status").fetchall())
+
+
+# ✅ (الاسم، الحالة) فقط للآلات التي تحتاج مزامنة — بدون تحميل كل الأعمدة
+@timed_db
+def vm_sync_states(skip=()):
+    # آلات المخزون (filling/ready) يديرها WarmPool ولا تُزامن حالتها
+    skip = tuple(skip)
+    sql = "SELECT name, status FROM vms WHERE pool IS NULL"
+    if skip:
+        sql += f" AND (status IS NULL OR status NOT IN ({','.join('?' * len(skip))}))"
+    return _conn().execute(sql, skip).fetchall()
+
+
+# ✅ البحث بالـ serial
+@timed_db
+def vm_by_serial(serial):
+    conn = _conn()
+    # داخل معاملة: نقرأ من القاعدة (نرى تعديلاتنا غير المؤكدة) ولا نخزّنها في الكاش
+    cached = not conn.in_transaction
+    rec = vm_cache.get_by_serial(serial) if cached else None
+    if rec is not None:
+        return rec
+    gen = vm_cache.generation()
+    r = conn.execute(f"SELECT {VM_COLUMNS} FROM vms WHERE serial=?", (serial,)).fetchone()
+    if not r:
+        return None
+    rec = VMRecord(r)
+    if cached:
+        vm_cache.put(rec, gen)
+    return rec
+
+
+# ✅ البحث بالاسم
+@timed_db
+def vm_by_name(name):
+    conn = _conn()
+    # داخل معاملة: نقرأ من القاعدة (نرى تعديلاتنا غير المؤكدة) ولا نخزّنها في الكاش
+    cached = not conn.in_transaction
+    rec = vm_cache.get_by_name(name) if cached else None
+    if rec is not None:
+        return rec
+    gen = vm_cache.generation()
+    r = conn.execute(f"SELECT {VM_COLUMNS} FROM vms WHERE name=?", (name,)).fetchone()
+    if not r:
+        return None
+    rec = VMRecord(r)
+    if cached:
+        vm_cache.put(rec, gen)
+    return rec
+
+
+# ✅ الآلات التي انتهت صلاحيتها قبل cutoff (epoch) ولم تُوقف بعد — عبر فهرس expires_ts
+@timed_db
+def list_expired_vms(cutoff_ts):
+    rows = _conn().execute(f"""
+        SELECT {VM_COLUMNS} FROM vms
+        WHERE expires_ts < ? AND status NOT IN ('expired', 'deleted') AND pool IS NULL
+    """, (int(cutoff_ts),)).fetchall()
+    return [_vm_dict(r) for r in rows]
+
+
+# ✅ أقرب موعد انتهاء (epoch) لآلة لم تُوقف بعد — أو None
+@timed_db
+def next_expiry_deadline():
+    row = _conn().execute("""
+        SELECT MIN(expires_ts) FROM vms
+        WHERE expires_ts IS NOT NULL AND status NOT IN ('expired', 'deleted') AND pool IS NULL
+    """).fetchone()
+    return row[0] if row else None
 
 
 # ✅ تحديث الحقول
+@timed_db
 def update_vm_fields(name, **kwargs):
+    if "expires_at" in kwargs:
+        kwargs["expires_ts"] = to_epoch(kwargs["expires_at"])
     keys = []
     vals = []
     for k, v in kwargs.items():
         keys.append(f"{k}=?")
         vals.append(v)
     vals.append(name)
-    conn = _conn()
-    c = conn.cursor()
-    c.execute(f"UPDATE vms SET {','.join(keys)} WHERE name=?", vals)
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute(f"UPDATE vms SET {','.join(keys)} WHERE name=?", vals)
+    _invalidate(names=[name])
+    if "expires_ts" in kwargs:
+        _notify_expiry()
+
+
+# ✅ تحديث حالات عدة آلات في معاملة واحدة
+@timed_db
+def update_vm_statuses(changes):
+    """changes: قائمة (status, name)"""
+    changes = list(changes)
+    with transaction() as conn:
+        conn.executemany("UPDATE vms SET status=? WHERE name=?", changes)
+    _invalidate(names=[name for _, name in changes])
+
+
+# ✅ تحديث حقول عدة آلات في معاملة واحدة (دفعات الـ webhook)
+@timed_db
+def update_vms_bulk(updates):
+    """updates: قائمة (name, {field: value}) — تُجمَّع حسب الحقول لاستعمال executemany"""
+    groups = {}
+    expiry_changed = False
+    for name, fields in updates:
+        fields = dict(fields)
+        if "expires_at" in fields:
+            fields["expires_ts"] = to_epoch(fields["expires_at"])
+            expiry_changed = True
+        keys = tuple(sorted(fields))
+        groups.setdefault(keys, []).append([fields[k] for k in keys] + [name])
+    with transaction() as conn:
+        for keys, rows in groups.items():
+            conn.executemany(f"UPDATE vms SET {','.join(f'{k}=?' for k in keys)} WHERE name=?", rows)
+    _invalidate(names=[name for name, _ in updates])
+    if expiry_changed:
+        _notify_expiry()
 
 
 # ✅ حذف آلة
+@timed_db
 def delete_vm(name):
-    conn = _conn()
-    c = conn.cursor()
-    c.execute('DELETE FROM vms WHERE name=?', (name,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute('DELETE FROM vms WHERE name=?', (name,))
+    _invalidate(names=[name])
+
+
+# ✅ حذف عدة آلات في معاملة واحدة
+@timed_db
+def delete_vms(names):
+    names = list(names)
+    with transaction() as conn:
+        conn.executemany('DELETE FROM vms WHERE name=?', [(n,) for n in names])
+    _invalidate(names=names)
+
+
+# ✅ تمديد صلاحية عدة آلات في معاملة واحدة → {name: expires_at الجديد}
+@timed_db
+def renew_vms(names, extra_days):
+    out = {}
+    with transaction() as conn:
+        for name in names:
+            row = conn.execute("SELECT expires_at FROM vms WHERE name=?", (name,)).fetchone()
+            if row is None:
+                continue
+            out[name] = _extended(row[0], extra_days)
+        conn.executemany("UPDATE vms SET expires_at=?, expires_ts=? WHERE name=?",
+                         [(exp, to_epoch(exp), name) for name, exp in out.items()])
+    _invalidate(names=list(out))
+    if out:
+        _notify_expiry()
+    return out
 
 
 # ✅ تفعيل آلة عبر السيريال
+@timed_db
 def activate_vm_by_serial(serial):
-    conn = _conn()
-    c = conn.cursor()
-    c.execute('UPDATE vms SET activated=1 WHERE serial=?', (serial,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute('UPDATE vms SET activated=1 WHERE serial=?', (serial,))
+    _invalidate(serials=[serial])
 
 
 # ✅ إنشاء مستخدم جديد
+@timed_db
 def create_user(email, password):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("INSERT INTO users (email, password) VALUES (?, ?)", (email, password))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("INSERT INTO users (email, password) VALUES (?, ?)", (email, password))
 
 
 # ✅ جلب مستخدم عبر البريد الإلكتروني
+@timed_db
 def get_user(email):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE email = ?", (email,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return _conn().execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
+
+
+# 🔐 استبدال هاش كلمة المرور بعد تغيير إعدادات الهاش (فقط إن لم يتغير منذ قراءته)
+@timed_db
+def update_user_password(email, new_hash, old_hash):
+    with transaction() as conn:
+        cur = conn.execute("UPDATE users SET password=? WHERE email=? AND password=?", (new_hash, email, old_hash))
+        return cur.rowcount == 1
 
 
 # ✅ تحديث السيريال للمستخدم بعد أول تفعيل
+@timed_db
 def update_user_serial(email, serial):
-    conn = _conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET serial=? WHERE email=?", (serial, email))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("UPDATE users SET serial=? WHERE email=?", (serial, email))
 
 
 # ✅ تجديد اشتراك العميل (تحديث تاريخ الانتهاء)
+def _extended(expires_at, extra_days):
+    """الموعد الحالي (أو الآن إن لم يوجد) + عدد الأيام → نص"""
+    if expires_at:
+        base = datetime.datetime.strptime(expires_at, "%Y-%m-%d %H:%M:%S")
+    else:
+        base = datetime.datetime.utcnow()
+    return (base + datetime.timedelta(days=extra_days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+@timed_db
 def renew_vm(serial, extra_days=30):
     """
     تمديد صلاحية السيريال بعدد الأيام المحددة (افتراضياً 30 يومًا)
     """
-    conn = _conn()
-    cur = conn.cursor()
-
-    cur.execute("SELECT expires_at FROM vms WHERE serial = ?", (serial,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return False
-
     try:
-        now = datetime.datetime.utcnow()
-        if row[0]:
-            current_exp = datetime.datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S")
-            new_exp = current_exp + datetime.timedelta(days=extra_days)
-        else:
-            new_exp = now + datetime.timedelta(days=extra_days)
+        with transaction() as conn:
+            row = conn.execute("SELECT expires_at FROM vms WHERE serial = ?", (serial,)).fetchone()
+            if not row:
+                return False
 
-        new_exp_str = new_exp.strftime("%Y-%m-%d %H:%M:%S")
-        cur.execute("UPDATE vms SET expires_at = ? WHERE serial = ?", (new_exp_str, serial))
-        conn.commit()
-        conn.close()
-        print(f"[OK] ✅ تم تمديد صلاحية الآلة {serial} حتى {new_exp_str}")
+            new_exp_str = _extended(row[0], extra_days)
+            conn.execute("UPDATE vms SET expires_at = ?, expires_ts = ? WHERE serial = ?",
+                         (new_exp_str, to_epoch(new_exp_str), serial))
+
+        _invalidate(serials=[serial])
+        log.info("تم تمديد صلاحية الآلة", extra={"serial": serial, "expires_at": new_exp_str})
+        _notify_expiry()
         return True
 
     except Exception as e:
-        print(f"[ERR] أثناء تجديد الاشتراك: {e}")
-        conn.close()
+        log.warning("خطأ أثناء تجديد الاشتراك", extra={"serial": serial, "error": str(e)})
         return False
+
+
+# 🧵 طابور المهام (jobs) — العمليات الطويلة على الآلات
+JOB_COLUMNS = "id, vm_name, kind, payload, status, progress, result, error, created_at, started_at, finished_at"
+
+
+def _job_dict(r):
+    return {
+        'id': r[0],
+        'vm_name': r[1],
+        'kind': r[2],
+        'payload': json.loads(r[3]) if r[3] else {},
+        'status': r[4],
+        'progress': r[5],
+        'result': json.loads(r[6]) if r[6] else None,
+        'error': r[7],
+        'created_at': r[8],
+        'started_at': r[9],
+        'finished_at': r[10]
+    }
+
+
+@timed_db
+def enqueue_job(vm_name, kind, payload=None):
+    with transaction() as conn:
+        cur = conn.execute(
+            "INSERT INTO jobs (vm_name, kind, payload, created_at) VALUES (?,?,?,?)",
+            (vm_name, kind, json.dumps(payload or {}), time.time()))
+        return cur.lastrowid
+
+
+@timed_db
+def enqueue_job_once(vm_name, kind, payload, fields):
+    """
+    مثل enqueue_job، لكن إذا كانت آخر مهمة منتظرة/جارية للآلة من نفس النوع وبنفس قيم fields
+    يُرجع رقمها بدل مهمة مكررة → (job_id, merged)
+    (آخر مهمة فقط: stop ثم start ثم stop جديد يجب أن يبقى ثلاث مهام)
+    """
+    with transaction() as conn:
+        r = conn.execute("""
+            SELECT id, kind, payload FROM jobs
+            WHERE vm_name=? AND status IN ('queued', 'running') ORDER BY id DESC LIMIT 1
+        """, (vm_name,)).fetchone()
+        if r and r[1] == kind:
+            current = json.loads(r[2]) if r[2] else {}
+            if all(current.get(f) == payload.get(f) for f in fields):
+                return r[0], True
+        cur = conn.execute(
+            "INSERT INTO jobs (vm_name, kind, payload, created_at) VALUES (?,?,?,?)",
+            (vm_name, kind, json.dumps(payload), time.time()))
+        return cur.lastrowid, False
+
+
+@timed_db
+def job_status_counts():
+    return dict(_conn().execute("""
+        SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status
+    """).fetchall())
+
+
+@timed_db
+def get_job(job_id):
+    r = _conn().execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id=?", (job_id,)).fetchone()
+    return _job_dict(r) if r else None
+
+
+@timed_db
+def jobs_by_ids(ids):
+    """المهام بأرقامها (متابعة دفعة /admin/bulk) بترتيب الأرقام"""
+    ids = [int(i) for i in ids]
+    if not ids:
+        return []
+    marks = ",".join("?" * len(ids))
+    rows = _conn().execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id IN ({marks}) ORDER BY id", ids).fetchall()
+    return [_job_dict(r) for r in rows]
+
+
+@timed_db
+def queued_jobs(limit=100):
+    """أقدم المهام المنتظرة (الأقدم أولاً ليبقى ترتيب مهام كل آلة محفوظًا)"""
+    rows = _conn().execute(f"""
+        SELECT {JOB_COLUMNS} FROM jobs WHERE status='queued' ORDER BY id LIMIT ?
+    """, (limit,)).fetchall()
+    return [_job_dict(r) for r in rows]
+
+
+@timed_db
+def claim_job(job_id, vm_name, worker=None):
+    """
+    queued → running بشكل ذري؛ يُرجع False إذا سبقنا إليها عامل آخر
+    أو إذا كانت للآلة مهمة جارية في أي عملية (ترتيب مهام الآلة مضمون عبر العمليات لا داخلها فقط)
+    worker: اسم عقد العملية المنفّذة (انظر fail_stale_jobs)
+    """
+    with transaction() as conn:
+        cur = conn.execute("""
+            UPDATE jobs SET status='running', started_at=?, worker=?
+            WHERE id=? AND status='queued'
+              AND NOT EXISTS (SELECT 1 FROM jobs WHERE vm_name=? AND status='running')
+        """, (time.time(), worker, job_id, vm_name))
+        return cur.rowcount == 1
+
+
+@timed_db
+def update_job_progress(job_id, progress):
+    with transaction() as conn:
+        conn.execute("UPDATE jobs SET progress=? WHERE id=?", (progress, job_id))
+
+
+@timed_db
+def finish_job(job_id, result=None, error=None):
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE jobs SET status=?, result=?, error=?, finished_at=? WHERE id=?",
+            ('failed' if error else 'done',
+             json.dumps(result) if result is not None else None,
+             error, time.time(), job_id))
+
+
+@timed_db
+def fail_stale_jobs():
+    """
+    المهام العالقة في running → failed: فقط التي ماتت عمليتها (عقدها منتهٍ أو غير موجود)،
+    فلا تُلغى مهمة طويلة ما زالت عملية أخرى حية تنفّذها. ثم تُحذف عقود العمّال المنتهية.
+    """
+    now = time.time()
+    with transaction() as conn:
+        cur = conn.execute("""
+            UPDATE jobs SET status='failed', error='interrupted', finished_at=?
+            WHERE status='running' AND NOT EXISTS (
+                SELECT 1 FROM leases WHERE leases.name = jobs.worker AND leases.expires_at >= ?)
+        """, (now, now))
+        conn.execute("DELETE FROM leases WHERE name LIKE 'jobs:%' AND expires_at < ?", (now,))
+        return cur.rowcount
+
+
+# ===================== عقود الإيجار (Leases) =====================
+@timed_db
+def acquire_lease(name, holder, ttl):
+    """أخذ العقد أو تجديده بشكل ذري: ينجح إذا كان حرًا أو منتهيًا أو لنا أصلًا"""
+    now = time.time()
+    with transaction() as conn:
+        cur = conn.execute("""
+            INSERT INTO leases (name, holder, expires_at) VALUES (?,?,?)
+            ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at
+            WHERE leases.holder=excluded.holder OR leases.expires_at < ?
+        """, (name, holder, now + ttl, now))
+        return cur.rowcount == 1
+
+
+@timed_db
+def release_lease(name, holder):
+    with transaction() as conn:
+        conn.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, holder))
+
+
+@timed_db
+def get_lease(name):
+    row = _conn().execute("SELECT holder, expires_at FROM leases WHERE name=?", (name,)).fetchone()
+    return {"holder": row[0], "expires_at": row[1]} if row else None
+
+
+# ===================== مرحّل الأحداث بين العمليات =====================
+@timed_db
+def relay_publish(origin, events):
+    """events: نصوص JSON؛ دفعة واحدة في معاملة واحدة"""
+    now = time.time()
+    with transaction() as conn:
+        conn.executemany("INSERT INTO event_relay (origin, event, ts) VALUES (?,?,?)",
+                         [(origin, e, now) for e in events])
+
+
+@timed_db
+def relay_fetch(after_id, origin, limit=500):
+    """أحداث العمليات الأخرى بعد after_id → [(id, event_json)]"""
+    return _conn().execute("""
+        SELECT id, event FROM event_relay WHERE id > ? AND origin != ? ORDER BY id LIMIT ?
+    """, (after_id, origin, limit)).fetchall()
+
+
+@timed_db
+def relay_last_id():
+    return _conn().execute("SELECT COALESCE(MAX(id), 0) FROM event_relay").fetchone()[0]
+
+
+@timed_db
+def relay_prune(older_than):
+    with transaction() as conn:
+        return conn.execute("DELETE FROM event_relay WHERE ts < ?", (older_than,)).rowcount
+
+
+# ===================== الخوادم (Hosts) =====================
+HOST_COLUMNS = "name, url, token, memory_mb, cpus, disk_mb, enabled"
+
+
+def _host_dict(r):
+    return {
+        'name': r[0],
+        'url': r[1],
+        'token': r[2],
+        'memory_mb': r[3] if r[3] is not None else config.HOST_MEMORY_MB,
+        'cpus': r[4] if r[4] is not None else config.HOST_CPUS,
+        'disk_mb': r[5] if r[5] is not None else config.HOST_DISK_MB,
+        'enabled': bool(r[6])
+    }
+
+
+@timed_db
+def list_hosts():
+    rows = _conn().execute(f"SELECT {HOST_COLUMNS} FROM hosts ORDER BY name").fetchall()
+    return [_host_dict(r) for r in rows]
+
+
+@timed_db
+def upsert_host(name, url, token=None, memory_mb=None, cpus=None, disk_mb=None, enabled=True):
+    with transaction() as conn:
+        conn.execute(f"""
+            INSERT INTO hosts ({HOST_COLUMNS}) VALUES (?,?,?,?,?,?,?)
+            ON CONFLICT(name) DO UPDATE SET url=excluded.url, token=excluded.token,
+                memory_mb=excluded.memory_mb, cpus=excluded.cpus,
+                disk_mb=excluded.disk_mb, enabled=excluded.enabled
+        """, (name, url, token, memory_mb, cpus, disk_mb, int(bool(enabled))))
+
+
+@timed_db
+def ensure_host(name, url, token=None):
+    """الخادم الافتراضي يتبع VBOX_API: يُنشأ إن لم يوجد ويُحدَّث رابطه دون لمس السعة"""
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO hosts (name, url, token) VALUES (?,?,?)
+            ON CONFLICT(name) DO UPDATE SET url=excluded.url, token=excluded.token
+        """, (name, url, token))
+
+
+@timed_db
+def host_usage():
+    """الموارد المحجوزة لكل خادم من دفتر السعة (بدون جمع صفوف vms) → {host: {...}}"""
+    rows = _conn().execute("SELECT host, memory_mb, cpus, disk_mb, vms FROM host_usage").fetchall()
+    return {r[0]: {"memory_mb": r[1], "cpus": r[2], "disk_mb": r[3], "vms": r[4]} for r in rows}
+
+
+@timed_db
+def rebuild_host_usage():
+    """إعادة بناء دفتر السعة من جدول vms (إصلاح يدوي)"""
+    with transaction() as conn:
+        _rebuild_host_usage(conn)
+
+
+# ===================== مخزون الآلات الجاهزة (Warm pool) =====================
+@timed_db
+def pool_counts():
+    """{(memory, cpus, disk): {"ready": n, "filling": n}} عبر فهرس pool"""
+    out = {}
+    rows = _conn().execute("""
+        SELECT memory, cpus, disk, pool, COUNT(*) FROM vms
+        WHERE pool IS NOT NULL GROUP BY memory, cpus, disk, pool
+    """).fetchall()
+    for mem, cpus, disk, pool, n in rows:
+        out.setdefault((mem, cpus, disk), {"ready": 0, "filling": 0})[pool] = n
+    return out
+
+
+@timed_db
+def claim_pooled_vm(memory, cpus, disk, serial, owner, password):
+    """
+    أخذ آلة جاهزة بنفس الموارد وتحويلها لآلة زبون (serial/owner/password جديدة) — أو None.
+    الـ Agent لا يعرف بعد بهذا التحويل: مهمة pool_handover تغيّر كلمة المرور عنده وتمدد انتهاءه
+    بعدد أيام صحيح (renew)، لذلك الانتهاء الجديد = انتهاء الـ Agent الحالي + renew_days
+    (≥ مدة الاشتراك الأصلية محسوبة من لحظة الأخذ) فيبقى الطرفان متفقين.
+    → {"name", "previous_password", "renew_days"}
+    """
+    with transaction() as conn:
+        row = conn.execute("""
+            SELECT name, created_at, expires_at, password FROM vms
+            WHERE pool='ready' AND memory=? AND cpus=? AND disk=? ORDER BY name LIMIT 1
+        """, (memory, cpus, disk)).fetchone()
+        if row is None:
+            return None
+        name, created_at, expires_at, previous_password = row
+        now = datetime.datetime.now(datetime.timezone.utc)
+        new_created = now.strftime("%Y-%m-%d %H:%M:%S")
+        new_expires, renew_days = expires_at, 0
+        start, end = to_epoch(created_at), to_epoch(expires_at)
+        if start is not None and end is not None:
+            # المدة المستهلكة وهي في المخزون تُعوَّض بأيام كاملة (renew في الـ Agent بالأيام)
+            renew_days = max(1, math.ceil((now.timestamp() - start) / DAY))
+            new_expires = (datetime.datetime.fromtimestamp(end, datetime.timezone.utc)
+                           + datetime.timedelta(days=renew_days)).strftime("%Y-%m-%d %H:%M:%S")
+        conn.execute("""
+            UPDATE vms SET pool=NULL, serial=?, owner=?, password=?, created_at=?, expires_at=?, expires_ts=?
+            WHERE name=?
+        """, (serial, owner, password, new_created, new_expires, to_epoch(new_expires), name))
+    _invalidate(names=[name], serials=[serial])
+    if new_expires:
+        _notify_expiry()
+    return {"name": name, "previous_password": previous_password, "renew_days": renew_days}
+
+
+# ===================== سجل حالات الآلات (vm_events / vm_days) =====================
+DAY = 86400
+_STATE_KINDS = ("created", "status", "deleted")
+
+
+def day_start(ts):
+    return int(ts // DAY) * DAY
+
+
+def _status_seconds(status, start, end, events):
+    """
+    مرور على أحداث [start, end) بدءًا من status → (observed_s, running_s, transitions, last_status)
+    events: [(ts, kind, value)] مرتبة زمنيًا (أنواع الحالة فقط)
+    """
+    observed = running = 0.0
+    transitions = 0
+    t = start
+    for ts, kind, value in events:
+        if status not in (None, "deleted"):
+            observed += ts - t
+            if status == "running":
+                running += ts - t
+        new = "deleted" if kind == "deleted" else value
+        if kind == "status" and status not in (None, "deleted") and new != status:
+            transitions += 1
+        status, t = new, ts
+    if status not in (None, "deleted") and end > t:
+        observed += end - t
+        if status == "running":
+            running += end - t
+    return observed, running, transitions, status
+
+
+def _roll_day(conn, day):
+    """يوم مكتمل واحد: حالة بدايته من صفوف اليوم السابق + أحداثه → صف لكل آلة موجودة"""
+    end = day + DAY
+    state = dict(conn.execute(
+        "SELECT vm_name, last_status FROM vm_days WHERE day=? AND last_status IS NOT 'deleted'", (day - DAY,)))
+    events = {}
+    for name, ts, kind, value in conn.execute(f"""
+        SELECT vm_name, ts, kind, value FROM vm_events
+        WHERE ts >= ? AND ts < ? AND kind IN {_STATE_KINDS} ORDER BY ts, id
+    """, (day, end)):
+        events.setdefault(name, []).append((ts, kind, value))
+    rows = []
+    for name in set(state) | set(events):
+        observed, running, transitions, last = _status_seconds(state.get(name), day, end, events.get(name, ()))
+        if last is not None:
+            rows.append((name, day, observed, running, transitions, last))
+    conn.executemany("""
+        INSERT OR REPLACE INTO vm_days (vm_name, day, observed_s, running_s, transitions, last_status)
+        VALUES (?,?,?,?,?,?)
+    """, rows)
+    # العلامة تتقدم في نفس المعاملة، حتى لو كان اليوم بلا صفوف
+    conn.execute("INSERT OR REPLACE INTO watermarks (name, value) VALUES ('vm_days', ?)", (end,))
+    return len(rows)
+
+
+def _rolled_until(conn):
+    """أول يوم لم يُلخَّص بعد (0 إن لم يُلخَّص شيء)"""
+    r = conn.execute("SELECT value FROM watermarks WHERE name='vm_days'").fetchone()
+    return 0 if r is None else int(r[0])
+
+
+@timed_db
+def rollup_vm_events(now=None):
+    """
+    تلخيص كل يوم مكتمل لم يُلخَّص بعد (معاملة لكل يوم)، ثم حذف الأحداث الأقدم من VM_EVENTS_KEEP_DAYS
+    ومجاميع SLA للآلات المحذوفة منذ VM_SLA_KEEP_DAYS ونوافذ التعطل المنتهية قبل VM_OUTAGES_KEEP_DAYS
+    → عدد الأيام الملخّصة
+    """
+    today = day_start(time.time() if now is None else now)
+    conn = _conn()
+    day = _rolled_until(conn)
+    if not day:
+        first = conn.execute("SELECT MIN(ts) FROM vm_events").fetchone()[0]
+        if first is None:
+            return 0
+        day = day_start(first)
+    done = 0
+    while day < today:
+        with transaction() as conn:
+            _roll_day(conn, day)
+        day += DAY
+        done += 1
+    keep = max(1, config.VM_EVENTS_KEEP_DAYS)
+    sla_keep = max(1, config.VM_SLA_KEEP_DAYS)
+    outages_keep = max(1, config.VM_OUTAGES_KEEP_DAYS)
+    with transaction() as conn:
+        conn.execute("DELETE FROM vm_events WHERE ts < ?", (today - keep * DAY,))
+        # صف vm_sla لآلة لم تعد موجودة (حالته deleted منذ since) لا يظهر في أي تقرير
+        conn.execute("""
+            DELETE FROM vm_sla WHERE since < ? AND NOT EXISTS (SELECT 1 FROM vms WHERE name = vm_sla.vm_name)
+        """, (today - sla_keep * DAY,))
+        # النوافذ المفتوحة تبقى مهما قدمت (التعطل ما زال جاريًا)
+        conn.execute("DELETE FROM vm_outages WHERE started < ? AND ended < ?",
+                     (today - outages_keep * DAY, today - outages_keep * DAY))
+    return done
+
+
+def _status_at(conn, name, ts):
+    """حالة الآلة لحظة ts: آخر حدث قبلها، وإلا حالة نهاية آخر يوم ملخّص قبلها"""
+    r = conn.execute(f"""
+        SELECT kind, value FROM vm_events
+        WHERE vm_name=? AND ts < ? AND kind IN {_STATE_KINDS} ORDER BY ts DESC, id DESC LIMIT 1
+    """, (name, ts)).fetchone()
+    if r:
+        return "deleted" if r[0] == "deleted" else r[1]
+    r = conn.execute("SELECT last_status FROM vm_days WHERE vm_name=? AND day < ? ORDER BY day DESC LIMIT 1",
+                     (name, day_start(ts))).fetchone()
+    return r[0] if r else None
+
+
+@timed_db
+def vm_status_summary(name, since, until=None):
+    """
+    ⏱️ لآلة في [since, until): الثواني المرصودة وثواني التشغيل وعدد التحولات
+    الأيام الملخّصة تُقرأ من vm_days (بدقة يوم)، وما بعدها من vm_events — استعلامات نطاق مفهرسة فقط
+    """
+    until = min(time.time(), until or time.time())
+    conn = _conn()
+    rolled = _rolled_until(conn)
+    observed = running = 0.0
+    transitions = 0
+    if since < rolled:
+        r = conn.execute("""
+            SELECT COALESCE(SUM(observed_s), 0), COALESCE(SUM(running_s), 0), COALESCE(SUM(transitions), 0)
+            FROM vm_days WHERE vm_name=? AND day >= ? AND day < ?
+        """, (name, day_start(since), min(until, rolled))).fetchone()
+        observed, running, transitions = r
+    start = max(since, rolled)
+    if start < until:
+        events = conn.execute(f"""
+            SELECT ts, kind, value FROM vm_events
+            WHERE vm_name=? AND ts >= ? AND ts < ? AND kind IN {_STATE_KINDS} ORDER BY ts, id
+        """, (name, start, until)).fetchall()
+        o, r, t, _ = _status_seconds(_status_at(conn, name, start), start, until, events)
+        observed, running, transitions = observed + o, running + r, transitions + t
+    return {
+        "name": name,
+        "since": since,
+        "until": until,
+        "observed_seconds": round(observed, 1),
+        "running_seconds": round(running, 1),
+        "transitions": transitions,
+        "uptime": round(running / observed, 5) if observed else None,
+    }
+
+
+@timed_db
+def vm_events_range(name, since, until=None, limit=500):
+    """أحداث آلة (الأحدث أولًا) في نطاق زمني — ما زال ضمن VM_EVENTS_KEEP_DAYS"""
+    rows = _conn().execute("""
+        SELECT ts, kind, value FROM vm_events
+        WHERE vm_name=? AND ts >= ? AND ts < ? ORDER BY ts DESC, id DESC LIMIT ?
+    """, (name, since, until or time.time() + 1, limit)).fetchall()
+    return [{"ts": ts, "kind": kind, "value": value} for ts, kind, value in rows]
+
+
+# ===================== SLA (vm_sla / vm_outages) =====================
+@timed_db
+def sync_sla_states():
+    """تصنيف الحالات من SLA_UP_STATES / SLA_DOWN_STATES (يسري على التحولات القادمة فقط)"""
+    rows = [(s.strip(), "up") for s in config.SLA_UP_STATES.split(",") if s.strip()]
+    rows += [(s.strip(), "down") for s in config.SLA_DOWN_STATES.split(",") if s.strip()]
+    with transaction() as conn:
+        current = set(conn.execute("SELECT status, category FROM sla_states").fetchall())
+        if current == set(rows):
+            return
+        conn.execute("DELETE FROM sla_states")
+        conn.executemany("INSERT OR REPLACE INTO sla_states (status, category) VALUES (?, ?)", rows)
+
+
+SLA_COLUMNS = """s.vm_name, v.owner, s.status, s.since, s.up_s, s.down_s, s.outages, s.recoveries,
+                 s.recovery_s, s.down_since, COALESCE(c.category, 'other')"""
+
+
+def _sla_dict(r):
+    return {
+        "name": r[0], "owner": r[1], "status": r[2], "since": r[3], "up_s": r[4], "down_s": r[5],
+        "outages": r[6], "recoveries": r[7], "recovery_s": r[8], "down_since": r[9], "category": r[10],
+    }
+
+
+@timed_db
+def sla_rows(owner=None, name=None):
+    """المجاميع التراكمية للآلات الموجودة (صف لكل آلة، بلا مسح للأحداث)"""
+    where, args = ["v.pool IS NULL"], []
+    if owner:
+        where.append("v.owner=?")
+        args.append(owner)
+    if name:
+        where.append("s.vm_name=?")
+        args.append(name)
+    rows = _conn().execute(f"""
+        SELECT {SLA_COLUMNS} FROM vm_sla s
+        JOIN vms v ON v.name = s.vm_name
+        LEFT JOIN sla_states c ON c.status = s.status
+        WHERE {' AND '.join(where)}
+    """, args).fetchall()
+    return [_sla_dict(r) for r in rows]
+
+
+@timed_db
+def outages_range(since, until=None, name=None, owner=None, limit=200):
+    """نوافذ التعطل التي بدأت في [since, until) — الأحدث أولًا (فهرس started أو vm_name)"""
+    where, args = ["o.started >= ?", "o.started < ?"], [since, until or time.time() + 1]
+    if name:
+        where.append("o.vm_name=?")
+        args.append(name)
+    if owner:
+        where.append("v.owner=?")
+        args.append(owner)
+    rows = _conn().execute(f"""
+        SELECT o.vm_name, v.owner, o.started, o.ended, o.status FROM vm_outages o
+        LEFT JOIN vms v ON v.name = o.vm_name
+        WHERE {' AND '.join(where)} ORDER BY o.started DESC LIMIT ?
+    """, args + [limit]).fetchall()
+    return [{"name": n, "owner": ow, "started": s, "ended": e, "status": st} for n, ow, s, e, st in rows]
+
+
+@timed_db
+def outage_totals(since, until=None, owner=None):
+    """عدد نوافذ التعطل المنتهية ومجموع مددها في الفترة (لآلات مالك واحد اختياريًا) → (count, seconds) لحساب MTTR"""
+    where, args = ["o.started >= ?", "o.started < ?", "o.ended IS NOT NULL"], [since, until or time.time() + 1]
+    if owner:
+        where.append("v.owner=?")
+        args.append(owner)
+    r = _conn().execute(f"""
+        SELECT COUNT(*), COALESCE(SUM(o.ended - o.started), 0) FROM vm_outages o
+        LEFT JOIN vms v ON v.name = o.vm_name
+        WHERE {' AND '.join(where)}
+    """, args).fetchone()
+    return r[0], r[1]
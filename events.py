@@ -0,0 +1,182 @@
+import json, logging, os, queue, secrets, socket, threading, time
+from collections import deque
+
+import config
+from db import relay_publish, relay_fetch, relay_last_id, relay_prune
+
+log = logging.getLogger("dz.events")
+
+# أحداث داخلية بين العمليات (مثل تغيّر مواعيد الانتهاء) لا تُرسل لقنوات SSE
+INTERNAL_KINDS = {"expiry"}
+
+
+class Subscription:
+    """مشترك واحد (اتصال SSE) — طابور محدود + نطاق اختياري لآلة واحدة"""
+
+    def __init__(self, vm_name=None, maxsize=100):
+        self.vm_name = vm_name
+        self._q = queue.Queue(maxsize=maxsize)
+
+    def wants(self, event):
+        if event["type"] in INTERNAL_KINDS:
+            return False
+        return self.vm_name is None or self.vm_name == event.get("name")
+
+    def put(self, event):
+        try:
+            self._q.put_nowait(event)
+        except queue.Full:
+            # مشترك بطيء: نُسقط الأقدم بدل حجب الناشر
+            try:
+                self._q.get_nowait()
+            except queue.Empty:
+                pass
+            try:
+                self._q.put_nowait(event)
+            except queue.Full:
+                pass
+
+    def get(self, timeout):
+        try:
+            return self._q.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventHub:
+    """
+    📡 ناشر/مشترك داخل العملية
+    الـ webhook وحلقة المزامنة وطابور المهام ينشرون، وقنوات SSE تستهلك.
+    taps ترى ما يُنشر محليًا فقط (المرحّل)، و listeners ترى كل ما يُسلَّم (محليًا أو من عملية أخرى).
+    """
+
+    def __init__(self, max_subscribers=None):
+        self.max_subscribers = config.SSE_MAX_CLIENTS if max_subscribers is None else max_subscribers
+        self._lock = threading.Lock()
+        self._subs = set()
+        self._taps = []
+        self._listeners = []
+
+    def tap(self, fn):
+        self._taps.append(fn)
+        return fn
+
+    def listen(self, fn):
+        self._listeners.append(fn)
+        return fn
+
+    def subscribe(self, vm_name=None):
+        """None إذا امتلأ الحد الأقصى للمشتركين (الواجهة ترجع للـ polling)"""
+        with self._lock:
+            if len(self._subs) >= self.max_subscribers:
+                return None
+            sub = Subscription(vm_name)
+            self._subs.add(sub)
+            return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subs.discard(sub)
+
+    def publish(self, kind, vm_name, /, **data):
+        event = {"type": kind, "name": vm_name, "ts": time.time()}
+        event.update({k: v for k, v in data.items() if v is not None})
+        self.deliver(event)
+        for fn in self._taps:
+            fn(event)
+        return event
+
+    def deliver(self, event):
+        """تسليم حدث للمشتركين والمستمعين في هذه العملية فقط"""
+        with self._lock:
+            subs = list(self._subs)
+        for sub in subs:
+            if sub.wants(event):
+                sub.put(event)
+        for fn in self._listeners:
+            try:
+                fn(event)
+            except Exception as e:
+                log.warning("فشل مستمع الأحداث", extra={"error": str(e)})
+
+    def count(self):
+        with self._lock:
+            return len(self._subs)
+
+
+class EventRelay:
+    """
+    🔁 مرحّل الأحداث بين العمليات (gunicorn -w N) عبر جدول event_relay
+    - ما يُنشر محليًا يُجمع ويُكتب دفعة واحدة كل EVENT_RELAY_SECONDS
+    - وتُقرأ أحداث العمليات الأخرى الجديدة (id > آخر ما رأيناه) وتُسلَّم للمشتركين هنا
+    - الصفوف الأقدم من EVENT_RELAY_KEEP_SECONDS تُحذف
+    """
+
+    MAX_PENDING = 5000
+
+    def __init__(self, hub, interval=None, keep=None):
+        self.hub = hub
+        self.interval = config.EVENT_RELAY_SECONDS if interval is None else interval
+        self.keep = config.EVENT_RELAY_KEEP_SECONDS if keep is None else keep
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self._pending = deque(maxlen=self.MAX_PENDING)
+        self._last_id = 0
+        self._stop = threading.Event()
+        self._thread = None
+        hub.tap(self._pending.append)
+
+    def start(self):
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._last_id = relay_last_id()
+        self._thread = threading.Thread(target=self._run, name="event-relay", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def flush(self):
+        batch = []
+        while self._pending:
+            batch.append(self._pending.popleft())
+        if not batch:
+            return
+        try:
+            relay_publish(self.origin, [json.dumps(e) for e in batch])
+        except Exception:
+            # القاعدة مشغولة مثلًا: تبقى الدفعة للدورة التالية
+            self._pending.extendleft(reversed(batch))
+            raise
+
+    def poll(self):
+        """أحداث العمليات الأخرى منذ آخر قراءة → عددها"""
+        n = 0
+        while True:
+            rows = relay_fetch(self._last_id, self.origin)
+            for row_id, raw in rows:
+                self._last_id = row_id
+                self.hub.deliver(json.loads(raw))
+            n += len(rows)
+            if len(rows) < 500:
+                return n
+
+    def _run(self):
+        last_prune = 0.0
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+                self.poll()
+                if time.time() - last_prune >= self.keep:
+                    relay_prune(time.time() - self.keep)
+                    last_prune = time.time()
+            except Exception as e:
+                log.warning("فشل ترحيل الأحداث", extra={"error": str(e)})
+
+
+# المثيل المشترك للتطبيق
+hub = EventHub()
+relay = EventRelay(hub)
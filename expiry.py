@@ -0,0 +1,78 @@
+import logging, threading, time
+
+import config
+from db import list_expired_vms, next_expiry_deadline, update_vm_fields
+from logsetup import bind_request_id, new_request_id
+
+log = logging.getLogger("dz.expiry")
+
+
+class ExpiryScheduler:
+    """
+    ⏰ مُجدول إيقاف الآلات المنتهية
+    ينام حتى أقرب موعد (أقل expires_ts + مهلة السماح) عبر استعلام مفهرس،
+    ويوقف فقط الآلات المستحقة. أي تغيير في expires_at يوقظه ليعيد الحساب.
+    """
+
+    MAX_SLEEP = 3600      # إعادة فحص دورية حتى لو لم يتغير شيء (تعديلات من عمليات أخرى)
+    RETRY_DELAY = 60      # إعادة محاولة الآلات التي فشل إيقافها
+
+    def __init__(self, vbox, grace_days=None):
+        self.vbox = vbox
+        self.grace = (config.EXPIRY_GRACE_DAYS if grace_days is None else grace_days) * 86400
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            if not self._stop.is_set():
+                return
+            self._thread.join()   # إعادة تشغيل بعد stop (مثلًا عند استعادة القيادة)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="expiry-scheduler", daemon=True)
+        self._thread.start()
+        log.info("تم تشغيل مُجدول انتهاء الاشتراكات.")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def reschedule(self, *_):
+        """يُستدعى عند تغيّر أي موعد انتهاء"""
+        self._wake.set()
+
+    def run_once(self):
+        """إيقاف الآلات المستحقة الآن، ويُرجع عدد الثواني حتى الموعد التالي"""
+        now = time.time()
+        failed = 0
+        for vm in list_expired_vms(now - self.grace):
+            log.info("إيقاف آلة لانتهاء الاشتراك", extra={"vm": vm["name"]})
+            try:
+                resp = self.vbox.poweroff_vm(vm["name"])
+                if resp.get("ok") is False:
+                    raise RuntimeError(resp.get("error"))
+                update_vm_fields(vm["name"], status="expired")
+            except Exception as e:
+                failed += 1
+                log.warning("فشل إيقاف آلة منتهية", extra={"vm": vm["name"], "error": str(e)})
+
+        nxt = next_expiry_deadline()
+        if nxt is None:
+            return self.MAX_SLEEP
+        delay = nxt + self.grace - time.time()
+        if delay <= 0:
+            # لم يبق مستحق إلا ما فشل إيقافه → لا ندور في حلقة مفرغة
+            delay = self.RETRY_DELAY if failed else 0.5
+        return min(delay, self.MAX_SLEEP)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                with bind_request_id(new_request_id("expiry-")):
+                    delay = self.run_once()
+            except Exception:
+                log.exception("خطأ في مُجدول الانتهاء")
+                delay = self.RETRY_DELAY
+            self._wake.wait(delay)
@@ -0,0 +1,13 @@
+# ⚙️ إعدادات gunicorn: gunicorn -c gunicorn.conf.py app:app
+# كل عامل يشغّل خيوط المهام والكتابة المؤجلة ومرحّل الأحداث، وعامل واحد فقط (القائد) يشغّل المزامنة والانتهاء
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("WAITRESS_THREADS", "16"))
+worker_class = "gthread"
+
+
+def post_worker_init(worker):
+    from app import start_background
+    start_background()
@@ -0,0 +1,44 @@
+import logging, threading
+
+import config
+from db import rollup_vm_events
+
+log = logging.getLogger("dz.history")
+
+
+class HistoryRollup:
+    """
+    🕓 تلخيص سجل الحالات (vm_events → vm_days) في القائد فقط، كل VM_EVENTS_ROLLUP_SECONDS
+    الأيام المكتملة فقط تُلخَّص، فالتشغيل المتكرر آمن ولا يعيد قراءة ما لُخّص
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or config.VM_EVENTS_ROLLUP_SECONDS
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            if not self._stop.is_set():
+                return
+            self._thread.join()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="history-rollup", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        days = rollup_vm_events()
+        if days:
+            log.info("تم تلخيص سجل الحالات", extra={"days": days})
+        return days
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                log.exception("خطأ في تلخيص سجل الحالات")
+            self._stop.wait(self.interval)
@@ -0,0 +1,250 @@
+import logging, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from db import list_hosts, ensure_host, host_usage, vm_by_name
+from logsetup import bind_request_id, current_request_id
+
+log = logging.getLogger("dz.hosts")
+
+
+RESOURCES = ("memory_mb", "cpus", "disk_mb")
+
+
+def _overcommit():
+    return {"memory_mb": config.OVERCOMMIT_MEMORY, "cpus": config.OVERCOMMIT_CPU, "disk_mb": config.OVERCOMMIT_DISK}
+
+
+class PlacementError(Exception):
+    """لا يوجد خادم مفعّل يتسع للآلة المطلوبة (أو لزيادة مواردها)"""
+
+
+class HostRegistry:
+    """
+    🖥️ سجل الخوادم: عميل VBoxRemote واحد لكل Agent (جدول hosts)
+    client_factory: fn(host_dict) -> VBoxRemote
+    """
+
+    def __init__(self, client_factory, default_host=None):
+        self.client_factory = client_factory
+        self.default_host = default_host or config.DEFAULT_HOST
+        self._lock = threading.Lock()
+        self._hosts = {}      # name -> host dict
+        self._clients = {}    # name -> (url, token, client)
+        self._loaded_at = 0.0
+
+    def ensure_default(self, url, token=None):
+        if url:
+            ensure_host(self.default_host, url, token)
+            self.reload()
+
+    def reload(self):
+        hosts = {h["name"]: h for h in list_hosts()}
+        with self._lock:
+            self._hosts = hosts
+            for name, h in hosts.items():
+                cached = self._clients.get(name)
+                if cached is None or cached[:2] != (h["url"], h["token"]):
+                    self._clients[name] = (h["url"], h["token"], self.client_factory(h))
+            for name in set(self._clients) - set(hosts):
+                del self._clients[name]
+            self._loaded_at = time.monotonic()
+
+    def _maybe_reload(self):
+        if time.monotonic() - self._loaded_at > config.HOSTS_REFRESH_SECONDS:
+            self.reload()
+
+    def hosts(self):
+        self._maybe_reload()
+        with self._lock:
+            return list(self._hosts.values())
+
+    def client(self, host=None):
+        self._maybe_reload()
+        host = host or self.default_host
+        with self._lock:
+            cached = self._clients.get(host)
+        if cached is None:
+            self.reload()   # خادم أُضيف من عملية أخرى
+            with self._lock:
+                cached = self._clients.get(host)
+        if cached is None:
+            raise KeyError(f"unknown host: {host}")
+        return cached[2]
+
+    def clients(self):
+        self._maybe_reload()
+        with self._lock:
+            return {name: c[2] for name, c in self._clients.items()}
+
+    def capacity(self):
+        """
+        لكل خادم من دفتر السعة: السعة الفعلية، الحد القابل للحجز (× نسبة الإفراط)،
+        المحجوز، المتبقي، ونسبة الاستعمال
+        """
+        usage = host_usage()
+        ratios = _overcommit()
+        out = []
+        for h in self.hosts():
+            used = usage.get(h["name"], {"memory_mb": 0, "cpus": 0, "disk_mb": 0, "vms": 0})
+            limit = {k: int(h[k] * ratios[k]) for k in RESOURCES}
+            out.append({
+                "name": h["name"],
+                "url": h["url"],
+                "enabled": h["enabled"],
+                "vms": used["vms"],
+                "total": {k: h[k] for k in RESOURCES},
+                "limit": limit,
+                "used": {k: used[k] for k in RESOURCES},
+                "free": {k: limit[k] - used[k] for k in RESOURCES},
+                "utilization": {k: round(used[k] / limit[k], 3) if limit[k] else 0.0 for k in RESOURCES},
+            })
+        return out
+
+    def place(self, memory_mb, cpus, disk_mb):
+        """
+        اختيار الخادم الأنسب (best-fit): من بين الخوادم التي تتسع للطلب،
+        الذي يبقى فيه أقل فراغ نسبي بعد الوضع — يملأ الخوادم قبل فتح غيرها.
+        """
+        want = {"memory_mb": memory_mb, "cpus": cpus, "disk_mb": disk_mb}
+        best = None
+        for h in self.capacity():
+            if not h["enabled"]:
+                continue
+            if any(h["free"][k] < want[k] for k in want):
+                continue
+            score = sum((h["free"][k] - want[k]) / h["limit"][k] for k in want if h["limit"][k])
+            if best is None or (score, h["name"]) < best:
+                best = (score, h["name"])
+        if best is None:
+            raise PlacementError(
+                f"no host can fit memory={memory_mb}MB cpus={cpus} disk={disk_mb}MB")
+        return best[1]
+
+    def check_resize(self, vm, memory_mb, cpus):
+        """رفض زيادة موارد آلة إذا تجاوزت المتبقي على خادمها (التخفيض مسموح دائمًا)"""
+        host = vm["host"] or self.default_host
+        delta = {"memory_mb": memory_mb - (vm["memory"] or 0), "cpus": cpus - (vm["cpus"] or 0)}
+        for h in self.capacity():
+            if h["name"] != host:
+                continue
+            short = [k for k, d in delta.items() if d > 0 and h["free"][k] < d]
+            if short:
+                raise PlacementError(f"host {host} lacks {', '.join(short)} for this resize")
+            return
+        raise PlacementError(f"unknown host: {host}")
+
+
+class Fleet:
+    """
+    🌐 نفس واجهة VBoxRemote، لكن كل استدعاء يُوجَّه لخادم الآلة (عمود vms.host)
+    خادم الآلة لا يتغير بعد إنشائها → خريطة name→host في الذاكرة بدل قراءة صف الآلة مع كل استدعاء
+    (مسار الـ webhook خصوصًا)؛ تُحذف الآلة منها عند حذفها
+    """
+
+    MAX_HOSTS = 100000
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def host_of(self, name):
+        with self._lock:
+            host = self._hosts.get(name)
+        if host is not None:
+            return host
+        vm = vm_by_name(name)
+        if vm is None:
+            return None   # لا نحفظ الغياب: قد تُنشأ الآلة بعد قليل
+        host = vm["host"] or self.registry.default_host
+        with self._lock:
+            if len(self._hosts) >= self.MAX_HOSTS:
+                self._hosts.clear()
+            self._hosts[name] = host
+        return host
+
+    def forget(self, name):
+        with self._lock:
+            self._hosts.pop(name, None)
+
+    def client_for(self, name):
+        return self.registry.client(self.host_of(name))
+
+    # === إجراءات آلة واحدة ===
+    def create_vm_async(self, name, **kwargs):
+        return self.client_for(name).create_vm_async(name, **kwargs)
+
+    def start_vm(self, name):
+        return self.client_for(name).start_vm(name)
+
+    def poweroff_vm(self, name):
+        return self.client_for(name).poweroff_vm(name)
+
+    def reset_vm(self, name):
+        return self.client_for(name).reset_vm(name)
+
+    def delete_vm_full(self, name):
+        try:
+            return self.client_for(name).delete_vm_full(name)
+        finally:
+            self.forget(name)
+
+    def get_vm_status(self, name):
+        return self.client_for(name).get_vm_status(name)
+
+    def remember_status(self, name, **fields):
+        try:
+            self.client_for(name).remember_status(name, **fields)
+        except KeyError:
+            pass   # آلة على خادم غير معروف: لا كاش
+
+    def get_ip(self, name):
+        return self.client_for(name).get_ip(name)
+
+    def change_vm_password(self, name, current_pw, new_pw):
+        return self.client_for(name).change_vm_password(name, current_pw, new_pw)
+
+    def renew_vm_expiry(self, name, days=35, owner_email=None):
+        return self.client_for(name).renew_vm_expiry(name, days=days, owner_email=owner_email)
+
+    def update_resources(self, name, memory_mb, cpus):
+        return self.client_for(name).update_resources(name, memory_mb, cpus)
+
+    # === عدة آلات ===
+    @property
+    def bulk_supported(self):
+        return any(c.bulk_supported for c in self.registry.clients().values())
+
+    def get_statuses(self, names):
+        """تجميع الآلات حسب الخادم؛ الخوادم تُسأل بالتوازي فلا يؤخر خادمٌ بطيء غيره"""
+        groups = {}
+        for name in names:
+            groups.setdefault(self.host_of(name) or self.registry.default_host, []).append(name)
+        if not groups:
+            return {}
+
+        rid = current_request_id()
+
+        def _one(item):
+            host, group = item
+            try:
+                with bind_request_id(rid):
+                    return self.registry.client(host).get_statuses(group)
+            except KeyError:
+                log.warning("آلات على خادم غير معروف", extra={"host": host, "count": len(group)})
+                return {}
+
+        if len(groups) == 1:
+            return _one(next(iter(groups.items())))
+        out = {}
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            for part in pool.map(_one, groups.items()):
+                out.update(part)
+        return out
+
+    def stats(self):
+        return {name: c.stats() for name, c in self.registry.clients().items()}
+
+    def status_cache_stats(self):
+        return {name: c.status_cache.stats() for name, c in self.registry.clients().items()}
@@ -0,0 +1,196 @@
+import logging, os, secrets, socket, threading
+
+import config
+from events import hub
+from logsetup import bind_request_id, current_request_id
+from metrics import jobs_merged
+from db import enqueue_job, enqueue_job_once, queued_jobs, claim_job, update_job_progress, finish_job, fail_stale_jobs
+from db import acquire_lease, release_lease, after_commit
+
+log = logging.getLogger("dz.jobs")
+
+
+class JobQueue:
+    """
+    🧵 طابور مهام دائم (جدول jobs في SQLite) مع مجموعة عمّال محدودة
+    - مهام نفس الآلة تُنفّذ بالترتيب واحدة تلو الأخرى
+    - مهام الآلات المختلفة تُنفّذ بالتوازي
+    handlers: {kind: fn(job, progress) -> dict}
+    كل عملية تجدد عقدًا باسم jobs:<holder> ما دامت حية، وكل مهمة running تحمل اسمه؛
+    المهام التي انتهى عقد عمليتها فقط تُعتبر عالقة (interrupted)
+    """
+
+    def __init__(self, handlers=None, workers=None):
+        self.handlers = dict(handlers or {})
+        self.workers = workers or config.JOB_WORKERS
+        self._cond = threading.Condition()
+        self._busy_vms = set()
+        self._kind_limits = {}
+        self._running_kinds = {}
+        self._seq = 0          # يزيد مع كل إشعار، كي لا يضيع إشعار وصل أثناء البحث خارج القفل
+        self._threads = []
+        self._started = False
+        self._stop = False
+        self.lease_ttl = config.JOB_LEASE_SECONDS
+        self.lease = f"jobs:{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self._halt = threading.Event()
+
+    def limit(self, kind, n):
+        """
+        سقف لعمّال هذه العملية على نوع مهمة طويل (مثل pool_fill الذي ينتظر الاستنساخ دقائق)،
+        ولا يتجاوز workers-1 حتى يبقى عامل واحد على الأقل لمهام الإنشاء/الإجراءات
+        """
+        self._kind_limits[kind] = max(1, min(n, self.workers - 1)) if self.workers > 1 else 1
+
+    def handler(self, kind):
+        """مُزخرف لتسجيل دالة تنفيذ نوع مهمة"""
+        def deco(fn):
+            self.handlers[kind] = fn
+            return fn
+        return deco
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+            self._stop = False
+        # العقد أولًا: مهامنا لن تُعتبر عالقة عند أي عملية أخرى
+        acquire_lease(self.lease, self.lease, self.lease_ttl)
+        self._sweep()
+        t = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+        t.start()
+        self._threads.append(t)
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        log.info("تم تشغيل عمّال المهام", extra={"workers": self.workers, "lease": self.lease})
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._seq += 1
+            self._cond.notify_all()
+        self._halt.set()
+        try:
+            release_lease(self.lease, self.lease)
+        except Exception as e:
+            log.warning("فشل تحرير عقد العمّال", extra={"lease": self.lease, "error": str(e)})
+
+    def _sweep(self):
+        n = fail_stale_jobs()
+        if n:
+            log.warning("مهام عالقة اعتُبرت فاشلة (interrupted)", extra={"count": n})
+
+    def _heartbeat(self):
+        """تجديد عقد العملية، ومعه تنظيف مهام العمليات الميتة (ولو لم تُعد تشغيلها)"""
+        while not self._halt.wait(self.lease_ttl / 3):
+            try:
+                acquire_lease(self.lease, self.lease, self.lease_ttl)
+                self._sweep()
+            except Exception as e:
+                log.warning("فشل تجديد عقد العمّال", extra={"lease": self.lease, "error": str(e)})
+
+    def submit(self, vm_name, kind, **payload):
+        if kind not in self.handlers:
+            raise ValueError(f"unknown job kind: {kind}")
+        # رقم الطلب الذي أنشأ المهمة يرافقها حتى تنفيذها (لربط السجلات)
+        payload.setdefault("request_id", current_request_id())
+        job_id = enqueue_job(vm_name, kind, payload)
+        self.start()
+        after_commit(self._kick)   # داخل معاملة (دفعة مهام) يوقظ العمّال بعد ظهور الصفوف فقط
+        return job_id
+
+    def submit_once(self, vm_name, kind, fields, **payload):
+        """
+        🔂 single-flight: إذا كانت نفس المهمة (نفس قيم fields) ما زالت منتظرة أو جارية
+        لهذه الآلة يُرجع رقمها، فكل الطالبين يتابعون نفس المهمة ونفس النتيجة → (job_id, merged)
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"unknown job kind: {kind}")
+        payload.setdefault("request_id", current_request_id())
+        job_id, merged = enqueue_job_once(vm_name, kind, payload, fields)
+        if merged:
+            jobs_merged.inc(kind=kind)
+            log.info("دمج مع مهمة جارية", extra={"job_id": job_id, "kind": kind, "vm": vm_name})
+            return job_id, True
+        self.start()
+        after_commit(self._kick)
+        return job_id, False
+
+    def _kick(self, all_workers=False):
+        with self._cond:
+            self._seq += 1
+            if all_workers:
+                self._cond.notify_all()
+            else:
+                self._cond.notify()
+
+    def _next_job(self):
+        """
+        أقدم مهمة منتظرة لآلة ليست مشغولة (هنا أو في عملية أخرى)
+        قراءة/حجز قاعدة البيانات تتم خارج القفل؛ القفل يحمي _busy_vms فقط
+        """
+        with self._cond:
+            busy = set(self._busy_vms)
+            full = {k for k, n in self._kind_limits.items() if self._running_kinds.get(k, 0) >= n}
+        skipped = set()
+        for job in queued_jobs():
+            vm = job["vm_name"]
+            if vm in busy or vm in skipped or job["kind"] in full:
+                skipped.add(vm)   # مهام الآلة اللاحقة تنتظر أيضًا (الترتيب)
+                continue
+            # الحجز في قاعدة البيانات يرفض أي آلة لها مهمة running (ولو من عملية أخرى)
+            if claim_job(job["id"], vm, self.lease):
+                with self._cond:
+                    self._busy_vms.add(vm)
+                    self._running_kinds[job["kind"]] = self._running_kinds.get(job["kind"], 0) + 1
+                return job
+            skipped.add(vm)
+        return None
+
+    def _worker(self):
+        while True:
+            while True:
+                with self._cond:
+                    if self._stop:
+                        return
+                    seq = self._seq
+                job = self._next_job()
+                if job:
+                    break
+                with self._cond:
+                    if self._stop:
+                        return
+                    if seq == self._seq:
+                        # ننتظر إشعارًا، أو نعيد الفحص دوريًا (مهام أُضيفت من عملية أخرى)
+                        self._cond.wait(config.JOB_POLL_SECONDS)
+            try:
+                with bind_request_id(job["payload"].get("request_id") or f"job-{job['id']}"):
+                    self._run(job)
+            finally:
+                with self._cond:
+                    self._busy_vms.discard(job["vm_name"])
+                    self._running_kinds[job["kind"]] -= 1
+                self._kick(all_workers=True)
+
+    def _run(self, job):
+        fn = self.handlers.get(job["kind"])
+
+        def progress(msg):
+            update_job_progress(job["id"], msg)
+
+        try:
+            if fn is None:
+                raise ValueError(f"unknown job kind: {job['kind']}")
+            result = fn(job, progress) or {}
+            finish_job(job["id"], result=result)
+            log.info("job done", extra={"job_id": job["id"], "kind": job["kind"], "vm": job["vm_name"]})
+            hub.publish("job", job["vm_name"], job_id=job["id"], kind=job["kind"],
+                        status="done", result=result)
+        except Exception as e:
+            log.exception("job failed", extra={"job_id": job["id"], "kind": job["kind"], "vm": job["vm_name"]})
+            finish_job(job["id"], error=str(e))
+            hub.publish("job", job["vm_name"], job_id=job["id"], kind=job["kind"],
+                        status="failed", error=str(e))
@@ -0,0 +1,90 @@
+import logging, os, secrets, socket, threading, time
+
+import config
+from db import acquire_lease, release_lease, get_lease
+
+log = logging.getLogger("dz.leader")
+
+
+class LeaderElection:
+    """
+    👑 انتخاب قائد واحد بين العمليات عبر صف عقد (lease) في SQLite
+    - كل عملية تحاول أخذ/تجديد العقد كل LEADER_HEARTBEAT_SECONDS
+    - القائد فقط يشغّل on_elected؛ إذا فشل التجديد قبل انتهاء العقد يتنحى (on_demoted)
+    - عند موت القائد ينتهي عقده بعد LEADER_LEASE_SECONDS فتأخذه عملية أخرى
+    """
+
+    def __init__(self, name, on_elected, on_demoted, ttl=None, heartbeat=None):
+        self.name = name
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.ttl = ttl or config.LEADER_LEASE_SECONDS
+        self.heartbeat = heartbeat or config.LEADER_HEARTBEAT_SECONDS
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self._leader = False
+        self._valid_until = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return self._leader
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"leader-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """إيقاف المحاولات والتنحي وتحرير العقد فورًا (حتى لا ينتظر الآخرون انتهاءه)"""
+        self._stop.set()
+        if self._leader:
+            self._demote()
+            try:
+                release_lease(self.name, self.holder)
+            except Exception as e:
+                log.warning("فشل تحرير العقد", extra={"lease": self.name, "error": str(e)})
+
+    def status(self):
+        out = {"name": self.name, "holder": self.holder, "is_leader": self._leader}
+        try:
+            out["current"] = get_lease(self.name)
+        except Exception as e:
+            out["error"] = str(e)
+        return out
+
+    def tick(self):
+        """محاولة واحدة لأخذ/تجديد العقد"""
+        now = time.time()
+        try:
+            ok = acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            # القاعدة مشغولة مثلًا: نبقى قادة ما دام عقدنا صالحًا لدورة أخرى على الأقل
+            log.warning("فشل تجديد العقد", extra={"lease": self.name, "error": str(e)})
+            ok = None
+        if ok:
+            self._valid_until = now + self.ttl
+            if not self._leader:
+                self._leader = True
+                log.info("أصبحت هذه العملية القائد", extra={"lease": self.name, "holder": self.holder})
+                self.on_elected()
+        elif self._leader and (ok is False or time.time() + self.heartbeat >= self._valid_until):
+            self._demote()
+
+    def _demote(self):
+        self._leader = False
+        log.warning("تنحّي عن القيادة", extra={"lease": self.name, "holder": self.holder})
+        try:
+            self.on_demoted()
+        except Exception:
+            log.exception("خطأ أثناء التنحي")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except Exception:
+                log.exception("خطأ في حلقة الانتخاب")
+            self._stop.wait(self.heartbeat)
@@ -0,0 +1,156 @@
+import atexit, contextvars, copy, datetime, json, logging, logging.handlers, queue, random, secrets, sys
+
+import config
+
+# 🔗 رقم الطلب الحالي — يربط سجلات الـ webhook وحلقة المزامنة واستدعاءات VBoxRemote
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+_STD_ATTRS = set(vars(logging.LogRecord("x", logging.INFO, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+
+def new_request_id(prefix=""):
+    return f"{prefix}{secrets.token_hex(6)}"
+
+
+def current_request_id():
+    return request_id_var.get()
+
+
+class bind_request_id:
+    """مدير سياق: يثبّت رقم الطلب للسجلات داخل الكتلة"""
+
+    def __init__(self, rid):
+        self.rid = rid
+
+    def __enter__(self):
+        self._token = request_id_var.set(self.rid)
+        return self.rid
+
+    def __exit__(self, *exc):
+        request_id_var.reset(self._token)
+        return False
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    أخذ عينات للأحداث الكثيرة: rates = {"dz.http": 0.05}
+    التحذيرات والأخطاء تمر دائمًا.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._cache = {}
+
+    def _rate(self, name):
+        rate = self._cache.get(name)
+        if rate is None:
+            rate = 1.0
+            best = -1
+            for prefix, r in self.rates.items():
+                if (name == prefix or name.startswith(prefix + ".")) and len(prefix) > best:
+                    rate, best = r, len(prefix)
+            self._cache[name] = rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        out = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            out["request_id"] = record.request_id
+        for k, v in record.__dict__.items():
+            if k not in _STD_ATTRS and not k.startswith("_"):
+                out[k] = v
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        rid = getattr(record, "request_id", None)
+        extra = {k: v for k, v in record.__dict__.items() if k not in _STD_ATTRS and not k.startswith("_")}
+        line = f"{self.formatTime(record)} {record.levelname:<7} {record.name} [{rid or '-'}] {record.getMessage()}"
+        if extra:
+            line += " " + " ".join(f"{k}={v}" for k, v in extra.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """لا يحجب خيط الطلب أبدًا: إذا امتلأ الطابور يُسقط السجل ويعدّه"""
+
+    dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def _parse_pairs(text, cast):
+    out = {}
+    for part in (text or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            out[name.strip()] = cast(value.strip())
+    return out
+
+
+_listener = None
+
+
+def setup_logging():
+    """تهيئة السجلات مرة واحدة: طابور + خيط كاتب خلفي + مستويات لكل وحدة من config.py"""
+    global _listener
+    if _listener is not None:
+        return
+
+    q = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+    qh = DroppingQueueHandler(q)
+    qh.addFilter(RequestIdFilter())
+    qh.addFilter(SamplingFilter(_parse_pairs(config.LOG_SAMPLE, float)))
+
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(JsonFormatter() if config.LOG_FORMAT == "json" else TextFormatter())
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(qh)
+    root.setLevel(config.LOG_LEVEL.upper())
+    for name, level in _parse_pairs(config.LOG_LEVELS, str.upper).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(q, out, respect_handler_level=False)
+    _listener.start()
+    atexit.register(_listener.stop)
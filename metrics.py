@@ -0,0 +1,191 @@
+import bisect, functools, threading, time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _esc(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in pairs) + "}"
+
+
+def _fmt_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def render(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.label_names, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][idx] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """مُزخرف/مدير سياق لقياس مدة التنفيذ"""
+        return _Timer(self, labels)
+
+    def render(self):
+        with self._lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        lines = []
+        for key, (counts, total, n) in items:
+            running = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                running += c
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.label_names, key, ('le', _fmt_value(bound)))} {running}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.label_names, key)} {n}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, hist, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, **self.labels)
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*a, **kw):
+            t0 = time.perf_counter()
+            try:
+                return fn(*a, **kw)
+            finally:
+                self.hist.observe(time.perf_counter() - t0, **self.labels)
+        return wrapper
+
+
+class Registry:
+    """
+    📊 سجل مقاييس داخل العملية بصيغة Prometheus النصية
+    collectors: دوال تُستدعى عند القراءة فقط وتُرجع [(name, kind, help, [(labels_dict, value)])]
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text, labels=()):
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._add(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        out = []
+        for m in self._metrics:
+            out.append(f"# HELP {m.name} {m.help}")
+            out.append(f"# TYPE {m.name} {m.kind}")
+            out.extend(m.render())
+        for fn in self._collectors:
+            try:
+                families = fn()
+            except Exception as e:
+                out.append(f"# collector {getattr(fn, '__name__', fn)} failed: {e}")
+                continue
+            for name, kind, help_text, samples in families:
+                out.append(f"# HELP {name} {help_text}")
+                out.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    names = tuple(labels)
+                    out.append(f"{name}{_fmt_labels(names, tuple(labels[n] for n in names))} {_fmt_value(value)}")
+        return "\n".join(out) + "\n"
+
+
+# المثيل المشترك + المقاييس الأساسية على المسارات الساخنة
+registry = Registry()
+
+http_request_seconds = registry.histogram(
+    "dz_http_request_seconds", "HTTP request latency by route", ("method", "route", "code"))
+db_query_seconds = registry.histogram(
+    "dz_db_query_seconds", "SQLite time per db.py function", ("fn",))
+vbox_request_seconds = registry.histogram(
+    "dz_vbox_request_seconds", "VBOX_API call latency by operation and outcome", ("op", "outcome"))
+sync_batch_seconds = registry.histogram(
+    "dz_sync_batch_seconds", "Duration of one status-sync chunk: one agent status request plus applying its changes",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120))
+
+jobs_merged = registry.counter(
+    "dz_jobs_merged_total", "Submissions merged into an identical in-flight job", ("kind",))
+login_attempts = registry.counter(
+    "dz_login_attempts_total", "Login/register attempts by outcome", ("result",))
+
+
+def timed_db(fn):
+    """مُزخرف لدوال db.py"""
+    return db_query_seconds.time(fn=fn.__name__)(fn)
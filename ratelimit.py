@@ -0,0 +1,43 @@
+import threading, time
+from collections import OrderedDict
+
+import config
+
+
+class TokenBucketLimiter:
+    """
+    🪣 حد معدل بدلو رموز لكل مفتاح (IP، بريد، آلة...) في الذاكرة
+    - rate رمز/ثانية، burst سعة الدلو؛ كل محاولة تستهلك رمزًا
+    - المفاتيح في OrderedDict محدود (RATE_LIMIT_MAX_KEYS): الأقدم استعمالًا يُنسى أولًا
+    """
+
+    def __init__(self, rate, burst, max_keys=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys or config.RATE_LIMIT_MAX_KEYS
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()   # key -> [tokens, last_ts]
+        self.rejected = 0
+
+    def allow(self, key, cost=1):
+        """(True, 0) أو (False, ثوانٍ حتى تتوفر المحاولة التالية)"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return True, 0
+            self.rejected += 1
+            return False, (cost - bucket[0]) / self.rate if self.rate else float("inf")
+
+    def stats(self):
+        with self._lock:
+            return {"keys": len(self._buckets), "rejected": self.rejected}
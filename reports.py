@@ -0,0 +1,110 @@
+import time
+
+import config
+from db import sla_rows, outages_range, outage_totals, vm_status_summary
+
+
+def _ratio(part, total):
+    return round(part / total, 6) if total else None
+
+
+def _mttr(recovery_s, recoveries):
+    return round(recovery_s / recoveries, 1) if recoveries else None
+
+
+def _vm_report(row, now):
+    """المجاميع المخزنة + المدة الجارية للحالة الحالية (لم تُضف بعد لأن التحول التالي لم يحدث)"""
+    up, down = row["up_s"], row["down_s"]
+    current = max(now - row["since"], 0)
+    if row["category"] == "up":
+        up += current
+    elif row["category"] == "down":
+        down += current
+    uptime = _ratio(up, up + down)
+    return {
+        "name": row["name"],
+        "owner": row["owner"],
+        "status": row["status"],
+        "uptime": uptime,
+        "up_seconds": round(up, 1),
+        "down_seconds": round(down, 1),
+        "outages": row["outages"],
+        "recoveries": row["recoveries"],
+        "recovery_seconds": round(row["recovery_s"], 1),
+        "mttr_seconds": _mttr(row["recovery_s"], row["recoveries"]),
+        "down_since": row["down_since"],
+        "meets_target": uptime is None or uptime >= config.SLA_TARGET,
+    }
+
+
+def fleet_report(owner=None, days=30, worst=50):
+    """
+    📈 تقرير الأسطول: إجمالي، لكل مالك، أسوأ الآلات، وآخر نوافذ التعطل
+    - summary.lifetime والمالكون وأسوأ الآلات: مجاميع vm_sla منذ بدء تتبع كل آلة (صف واحد لكل آلة)
+    - summary.window ونوافذ التعطل: آخر days يومًا من vm_outages
+    لا يمر على سجل الأحداث مهما طال
+    """
+    now = time.time()
+    vms = [_vm_report(r, now) for r in sla_rows(owner=owner)]
+
+    owners = {}
+    for vm in vms:
+        o = owners.setdefault(vm["owner"] or "-", {"owner": vm["owner"] or "-", "vms": 0, "up_seconds": 0.0,
+                                                   "down_seconds": 0.0, "outages": 0, "below_target": 0,
+                                                   "recoveries": 0, "recovery_seconds": 0.0})
+        o["vms"] += 1
+        o["up_seconds"] += vm["up_seconds"]
+        o["down_seconds"] += vm["down_seconds"]
+        o["outages"] += vm["outages"]
+        o["below_target"] += not vm["meets_target"]
+        o["recoveries"] += vm["recoveries"]
+        o["recovery_seconds"] += vm["recovery_seconds"]
+    for o in owners.values():
+        o["uptime"] = _ratio(o["up_seconds"], o["up_seconds"] + o["down_seconds"])
+        o["mttr_seconds"] = _mttr(o["recovery_seconds"], o["recoveries"])
+        o["recovery_seconds"] = round(o["recovery_seconds"], 1)
+        o["up_seconds"], o["down_seconds"] = round(o["up_seconds"], 1), round(o["down_seconds"], 1)
+
+    up = sum(vm["up_seconds"] for vm in vms)
+    down = sum(vm["down_seconds"] for vm in vms)
+    recoveries = sum(vm["recoveries"] for vm in vms)
+    recovery_total = sum(vm["recovery_seconds"] for vm in vms)
+    since = now - days * 86400
+    recovered, recovery_s = outage_totals(since, owner=owner)
+    ranked = sorted(vms, key=lambda vm: (vm["uptime"] is None, vm["uptime"] or 0, -vm["down_seconds"]))
+    return {
+        "generated_at": now,
+        "target": config.SLA_TARGET,
+        "summary": {
+            "vms": len(vms),
+            "down_now": sum(1 for vm in vms if vm["down_since"] is not None),
+            "lifetime": {
+                "uptime": _ratio(up, up + down),
+                "below_target": sum(not vm["meets_target"] for vm in vms),
+                "outages": sum(vm["outages"] for vm in vms),
+                "recoveries": recoveries,
+                "mttr_seconds": _mttr(recovery_total, recoveries),
+            },
+            "window": {
+                "days": days,
+                "since": since,
+                "outages_recovered": recovered,
+                "mttr_seconds": _mttr(recovery_s, recovered),
+            },
+        },
+        "owners": sorted(owners.values(), key=lambda o: (o["uptime"] is None, o["uptime"] or 0)),
+        "worst": ranked[:worst],
+        "outages": outages_range(since, owner=owner, limit=50),
+    }
+
+
+def vm_report(name, days=30):
+    """تقرير آلة: المجاميع التراكمية + ملخص الفترة (vm_days/vm_events) + نوافذ التعطل فيها"""
+    rows = sla_rows(name=name)
+    if not rows:
+        return None
+    since = time.time() - days * 86400
+    out = _vm_report(rows[0], time.time())
+    out["period"] = vm_status_summary(name, since)
+    out["outages"] = outages_range(since, name=name, limit=200)
+    return out
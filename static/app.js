@@ -59,6 +59,22 @@ function showDetails(name, ip, user, pass, connect, ports){
   modal.classList.add('show');
 }
 
+// Credentials and details are fetched on demand instead of being inlined in the page
+function loadDetails(name){
+  fetch(`/admin/vm/${encodeURIComponent(name)}`)
+    .then(r => r.json())
+    .then(data => {
+      if (!data.ok) {
+        toast('⚠️ VM not found.', 'warn');
+        return;
+      }
+      const vm = data.vm;
+      const ports = vm.service_ports && vm.service_ports.length ? vm.service_ports.join(', ') : '-';
+      showDetails(vm.name, vm.ip || '-', vm.user, vm.password, vm.connect, ports);
+    })
+    .catch(() => toast('❌ Failed to load details.', 'err'));
+}
+
 function closeDetails(){
   document.getElementById('vmDetailsModal').classList.remove('show');
 }
@@ -74,6 +90,33 @@ document.addEventListener('DOMContentLoaded', ()=>{
   });
 });
 
+// Server-Sent Events (/api/events) with a fallback callback when unavailable
+function openEvents(handlers, onFail) {
+  if (!window.EventSource) {
+    if (onFail) onFail();
+    return null;
+  }
+  const es = new EventSource('/api/events');
+  let failed = false;
+  Object.entries(handlers).forEach(([type, fn]) => {
+    es.addEventListener(type, (ev) => {
+      try {
+        fn(JSON.parse(ev.data));
+      } catch (err) {
+        console.warn('event parse error', err);
+      }
+    });
+  });
+  es.onerror = () => {
+    // CLOSED means the server refused the stream (403/503); CONNECTING is a normal reconnect
+    if (es.readyState === EventSource.CLOSED && !failed) {
+      failed = true;
+      if (onFail) onFail();
+    }
+  };
+  return es;
+}
+
 // Status update after actions
 document.addEventListener('DOMContentLoaded', () => {
   const vmStatusEl = document.querySelector('.vm-status');
@@ -93,6 +136,25 @@ document.addEventListener('DOMContentLoaded', () => {
       .catch(err => console.warn('status check error', err));
   }
 
+  // Live updates over SSE; fall back to a one-off poll after each click
+  if (!serial || !vmStatusEl) return;
+  const es = openEvents({
+    vm: (ev) => {
+      if (ev.status_text) {
+        vmStatusEl.innerHTML = ev.status_text.trim();
+        toast(`✅ Status updated: ${ev.status_text}`, 'ok');
+      }
+    },
+    // A failed job leaves the status unchanged (no vm event), so re-read it and say why
+    job: (ev) => {
+      if (ev.status === 'failed') {
+        toast(`❌ Action failed: ${ev.error || ev.kind}`, 'err');
+        refreshStatusOnce();
+      }
+    }
+  });
+  if (es) return;
+
   document.querySelectorAll('form button[name="action"]').forEach(btn => {
     btn.addEventListener('click', () => {
       setTimeout(refreshStatusOnce, 4000);
@@ -111,7 +173,6 @@ document.addEventListener('DOMContentLoaded', () => {
     const overlay = document.getElementById('creatingMessage');
     if (overlay) overlay.classList.add('show');
 
-    toast('⏳ Creating virtual machine... This may take 5–20 minutes.', 'warn', 6000);
 
     createForm.querySelectorAll('button, select').forEach(el => el.disabled = true);
 
@@ -127,13 +188,19 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     if (!resp.ok) {
-      toast('⚠️ Request was not accepted (check the server).', 'err');
+      const err = await resp.json().catch(() => ({}));
+      toast(err.error ? `⚠️ ${err.error}` : '⚠️ Request was not accepted (check the server).', 'err');
       if (overlay) overlay.classList.remove('show');
       createForm.querySelectorAll('button, select').forEach(el => el.disabled = false);
       return;
     }
 
     const data = await resp.json();
+    if (data.pooled) {
+      toast('⚡ Assigned a pre-provisioned VM — starting now.', 'ok', 6000);
+    } else {
+      toast('⏳ Creating virtual machine... This may take 5–20 minutes.', 'warn', 6000);
+    }
     const vmName = data.name || data.vm_name || null;
     if (!vmName) {
       toast('⚠️ VM name was not provided!', 'warn');
@@ -142,10 +209,64 @@ document.addEventListener('DOMContentLoaded', () => {
       return;
     }
 
-    pollVmStatus(vmName, createForm, overlay);
+    watchVmStatus(vmName, createForm, overlay, data.job_id);
   });
 });
 
+function finishCreate(vmName, formEl, overlay, status, note) {
+  if (overlay) overlay.classList.remove('show');
+  if (status === 'ready' || status === 'running') {
+    toast(`✅ VM ${vmName} is now ready!`, 'ok', 6000);
+    setTimeout(() => window.location.reload(), 3000);
+    return;
+  }
+  if (status === 'error') {
+    toast(`❌ VM creation failed: ${note || 'Unknown error'}`, 'err', 6000);
+  } else {
+    toast('⚠️ Time limit exceeded. VM did not become ready.', 'warn', 6000);
+  }
+  formEl.querySelectorAll('button, select').forEach(el => el.disabled = false);
+}
+
+// Follow a new VM over SSE; poll /api/vm_status only if SSE is unavailable
+// jobId: the create job, or the handover job of a pooled VM (whose completion means it is running)
+function watchVmStatus(vmName, formEl, overlay, jobId) {
+  let done = false;
+  let es = null;
+  const finish = (status, note) => {
+    if (done) return;
+    done = true;
+    if (es) es.close();
+    clearTimeout(limit);
+    finishCreate(vmName, formEl, overlay, status, note);
+  };
+  const limit = setTimeout(() => finish('timeout'), 20 * 60 * 1000);
+
+  es = openEvents({
+    vm: (ev) => {
+      if (ev.name !== vmName || !ev.status) return;
+      if (ev.status === 'ready' || ev.status === 'running' || ev.status === 'error') {
+        finish(ev.status, ev.note);
+      }
+    },
+    job: (ev) => {
+      if (ev.name !== vmName || (jobId && ev.job_id !== jobId)) return;
+      if (ev.status === 'failed') {
+        finish('error', ev.error);
+      } else if (ev.status === 'done' && ev.kind === 'pool_handover') {
+        // A create job only means cloning started; a pooled handover ends with the VM started
+        finish((ev.result && ev.result.status) || 'running');
+      }
+    }
+  }, () => {
+    if (done) return;
+    done = true;
+    clearTimeout(limit);
+    pollVmStatus(vmName, formEl, overlay);
+  });
+  if (es) toast(`🚧 Tracking status of ${vmName}...`, 'info', 4000);
+}
+
 async function pollVmStatus(vmName, formEl, overlay) {
   let tries = 0;
   const maxTries = 120; // ~20 minutes
@@ -0,0 +1,183 @@
+import logging, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from db import vm_sync_states
+from logsetup import bind_request_id, new_request_id
+from metrics import sync_batch_seconds
+
+log = logging.getLogger("dz.sync")
+
+
+def _parse_intervals(text):
+    out = {}
+    for part in (text or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            out[name.strip()] = float(value)
+    return out
+
+
+class _VMState:
+    __slots__ = ("status", "due", "failures")
+
+    def __init__(self, status, due):
+        self.status = status
+        self.due = due
+        self.failures = 0
+
+
+class SyncEngine:
+    """
+    🔄 محرك مزامنة الحالة الفعلية للآلات مع الـ Agent
+    - لكل آلة موعد فحص حسب حالتها (الانتقالية كثيرًا، المستقرة نادرًا، المنتهية أبدًا)
+    - الطلبات تُوزَّع على مجمع خيوط محدود: آلة بطيئة لا تؤخر البقية
+    - تراجع أسّي لكل آلة بعد فشل متكرر
+    on_changes: fn([(status, name), ...]) تُستدعى بالتغييرات فقط
+    """
+
+    def __init__(self, vbox, on_changes, workers=None):
+        self.vbox = vbox
+        self.on_changes = on_changes
+        self.workers = workers or config.SYNC_WORKERS
+        self.intervals = _parse_intervals(config.SYNC_INTERVALS)
+        self.skip = tuple(s.strip() for s in config.SYNC_SKIP_STATES.split(",") if s.strip())
+        self._lock = threading.Lock()
+        self._vms = {}            # name -> _VMState
+        self._in_flight = set()
+        self._inflight_tasks = 0
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._pool = None
+        self._thread = None
+        self._counters = {"checks": 0, "failures": 0, "changes": 0}
+
+    # ---------- التشغيل ----------
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            if not self._stop.is_set():
+                return
+            self._thread.join()   # إعادة تشغيل بعد stop (مثلًا عند استعادة القيادة)
+        self._stop.clear()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sync")
+        self._thread = threading.Thread(target=self._run, name="sync-engine", daemon=True)
+        self._thread.start()
+        log.info("تم تشغيل محرك المزامنة", extra={"workers": self.workers})
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._pool:
+            # الدفعات المرسلة (≤ workers) تكمل وتُحرر علامة in_flight
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def interval_for(self, status):
+        return self.intervals.get(status, config.SYNC_DEFAULT_INTERVAL)
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._counters)
+            out["tracked"] = len(self._vms)
+            out["in_flight"] = len(self._in_flight)
+            out["backoff"] = sum(1 for st in self._vms.values() if st.failures)
+        return out
+
+    # ---------- الجدولة ----------
+    def _jitter(self, seconds):
+        # ±10% حتى لا تتزامن فحوص الآلات التي أُضيفت معًا
+        return seconds * random.uniform(0.9, 1.1)
+
+    def _refresh(self, now):
+        """مزامنة القائمة مع القاعدة وإرجاع الآلات المستحقة الآن"""
+        rows = vm_sync_states(self.skip)
+        due = []
+        with self._lock:
+            seen = set()
+            for name, status in rows:
+                seen.add(name)
+                st = self._vms.get(name)
+                if st is None:
+                    st = self._vms[name] = _VMState(status, now + random.uniform(0, self.interval_for(status)))
+                elif st.status != status:
+                    # تغيّرت الحالة من مصدر آخر (إجراء، webhook) → فترة الحالة الجديدة
+                    st.status = status
+                    if not st.failures:
+                        st.due = min(st.due, now + self.interval_for(status))
+                if st.due <= now and name not in self._in_flight:
+                    due.append(name)
+            for name in set(self._vms) - seen:
+                del self._vms[name]
+        due.sort(key=lambda n: self._vms[n].due)
+        return due
+
+    def _dispatch(self, due):
+        batch = config.SYNC_BATCH if self.vbox.bulk_supported else 1
+        for i in range(0, len(due), batch):
+            with self._lock:
+                if self._inflight_tasks >= self.workers:
+                    return   # البقية في الدورة التالية
+                chunk = [n for n in due[i:i + batch] if n not in self._in_flight]
+                if not chunk:
+                    continue
+                self._in_flight.update(chunk)
+                self._inflight_tasks += 1
+            try:
+                self._pool.submit(self._check, chunk)
+            except (AttributeError, RuntimeError):   # أُوقف المحرك أثناء التوزيع
+                with self._lock:
+                    self._in_flight.difference_update(chunk)
+                    self._inflight_tasks -= 1
+                return
+
+    def _check(self, names):
+        try:
+            with bind_request_id(new_request_id("sync-")), sync_batch_seconds.time():
+                try:
+                    statuses = self.vbox.get_statuses(names)
+                except Exception:
+                    log.exception("خطأ في جلب الحالة", extra={"count": len(names)})
+                    statuses = {}
+                self._apply(names, statuses)
+        finally:
+            with self._lock:
+                self._in_flight.difference_update(names)
+                self._inflight_tasks -= 1
+
+    def _apply(self, names, statuses):
+        now = time.time()
+        changes = []
+        with self._lock:
+            for name in names:
+                st = self._vms.get(name)
+                if st is None:
+                    continue
+                self._counters["checks"] += 1
+                real = statuses.get(name)
+                if not real:
+                    st.failures += 1
+                    self._counters["failures"] += 1
+                    delay = min(self.interval_for(st.status) * 2 ** st.failures, config.SYNC_MAX_BACKOFF)
+                    st.due = now + self._jitter(delay)
+                    continue
+                st.failures = 0
+                if real != st.status:
+                    changes.append((real, name))
+                    st.status = real
+                st.due = now + self._jitter(self.interval_for(real))
+            self._counters["changes"] += len(changes)
+        if changes:
+            for real, name in changes:
+                log.info("تحديث حالة", extra={"vm": name, "status": real})
+            self.on_changes(changes)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                due = self._refresh(time.time())
+                if due:
+                    self._dispatch(due)
+            except Exception:
+                log.exception("خطأ في حلقة المزامنة")
+            self._wake.wait(config.SYNC_TICK)
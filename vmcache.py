@@ -0,0 +1,258 @@
+import threading, time
+from collections import OrderedDict
+
+import config
+
+
+class VMRecord:
+    """
+    سجل آلة مضغوط (__slots__) بدل dict — يدعم vm.name و vm["name"] و vm.get("name")
+    للتوافق مع القوالب والكود الحالي. مشترك بين الطلبات، فلا يُعدَّل بعد إنشائه.
+    """
+
+    __slots__ = ("name", "serial", "owner", "user", "password", "ip", "status", "memory",
+                 "cpus", "disk", "connect", "port", "service_ports", "activated",
+                 "created_at", "expires_at", "host")
+
+    def __init__(self, row):
+        (self.name, self.serial, self.owner, self.user, self.password, self.ip,
+         self.status, self.memory, self.cpus, self.disk, self.connect, self.port,
+         ports, self.activated, self.created_at, self.expires_at, self.host) = row
+        self.service_ports = tuple(ports.split(',')) if ports else ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.__slots__
+
+    def to_dict(self):
+        d = {k: getattr(self, k) for k in self.__slots__}
+        d["service_ports"] = list(self.service_ports)
+        return d
+
+    def __repr__(self):
+        return f"<VMRecord {self.name} serial={self.serial} status={self.status}>"
+
+
+class VMCache:
+    """
+    🧠 كاش قراءة للآلات بالاسم والسيريال — TTL + حد أقصى LRU
+    الإبطال يرفع رقم "الجيل"، فلا تُخزَّن قراءة بدأت قبل آخر كتابة.
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize or config.VM_CACHE_SIZE
+        self.ttl = config.VM_CACHE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._by_name = OrderedDict()   # name → (expires_at, record)
+        self._serials = {}              # serial → name
+        self._gen = 0
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def generation(self):
+        return self._gen
+
+    def _lookup(self, name):
+        entry = self._by_name.get(name)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(name)
+            return None
+        self._by_name.move_to_end(name)
+        return entry[1]
+
+    def _drop(self, name):
+        entry = self._by_name.pop(name, None)
+        if entry is not None and self._serials.get(entry[1].serial) == name:
+            del self._serials[entry[1].serial]
+
+    def get_by_name(self, name):
+        with self._lock:
+            rec = self._lookup(name)
+            self._counters["hits" if rec else "misses"] += 1
+            return rec
+
+    def get_by_serial(self, serial):
+        with self._lock:
+            name = self._serials.get(serial)
+            rec = self._lookup(name) if name is not None else None
+            self._counters["hits" if rec else "misses"] += 1
+            return rec
+
+    def put(self, rec, generation):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation != self._gen:
+                return
+            self._drop(rec.name)
+            self._by_name[rec.name] = (time.monotonic() + self.ttl, rec)
+            if rec.serial:
+                self._serials[rec.serial] = rec.name
+            while len(self._by_name) > self.maxsize:
+                oldest = next(iter(self._by_name))
+                self._drop(oldest)
+                self._counters["evictions"] += 1
+
+    def invalidate(self, names=(), serials=()):
+        with self._lock:
+            self._gen += 1
+            self._counters["invalidations"] += 1
+            for name in names:
+                self._drop(name)
+            for serial in serials:
+                name = self._serials.get(serial)
+                if name is not None:
+                    self._drop(name)
+
+    def clear(self):
+        with self._lock:
+            self._gen += 1
+            self._by_name.clear()
+            self._serials.clear()
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._counters)
+            out["size"] = len(self._by_name)
+            out["maxsize"] = self.maxsize
+            out["ttl"] = self.ttl
+        lookups = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / lookups, 3) if lookups else 0.0
+        return out
+
+
+class _Flight:
+    __slots__ = ("done", "result")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class StatusCache:
+    """
+    📡 كاش قصير (STATUS_CACHE_TTL) لردود /api/vm/status من الـ Agent + دمج الطلبات المتزامنة:
+    get_ip و get_vm_status والمزامنة يتشاركون جلبًا واحدًا لكل آلة في كل نافذة TTL.
+    - update: دفع من الـ webhook يحدّث القيمة فورًا
+    - invalidate: بعد أي إجراء يغيّر الحالة (تشغيل، إيقاف، حذف...)
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize or config.STATUS_CACHE_SIZE
+        self.ttl = config.STATUS_CACHE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()   # name → (expires_at, payload)
+        self._flights = {}            # name → _Flight
+        self._gen = 0
+        self._counters = {"hits": 0, "misses": 0, "coalesced": 0, "pushes": 0}
+
+    def _fresh(self, name, now):
+        entry = self._items.get(name)
+        if entry is None or entry[0] < now:
+            return None
+        self._items.move_to_end(name)
+        return entry[1]
+
+    def _store(self, name, payload, now):
+        self._items[name] = (now + self.ttl, payload)
+        self._items.move_to_end(name)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def get(self, name, fetch):
+        """الرد المخزّن إن كان حديثًا، وإلا fetch() مرة واحدة مهما كان عدد الطالبين في نفس اللحظة"""
+        if self.ttl <= 0:
+            return fetch()
+        with self._lock:
+            payload = self._fresh(name, time.monotonic())
+            if payload is not None:
+                self._counters["hits"] += 1
+                return payload
+            flight = self._flights.get(name)
+            leader = flight is None
+            if leader:
+                flight = self._flights[name] = _Flight()
+                gen = self._gen
+                self._counters["misses"] += 1
+            else:
+                self._counters["coalesced"] += 1
+        if not leader:
+            flight.done.wait(config.VBOX_STATUS_TIMEOUT * 3)
+            return flight.result if flight.result is not None else fetch()
+        try:
+            flight.result = fetch()
+            if flight.result.get("ok", True) and flight.result.get("status"):
+                with self._lock:
+                    if gen == self._gen:   # لم يُبطَل أو يُدفع شيء أحدث أثناء الجلب
+                        self._store(name, flight.result, time.monotonic())
+            return flight.result
+        finally:
+            with self._lock:
+                self._flights.pop(name, None)
+            flight.done.set()
+
+    def fresh_many(self, names):
+        """{name: payload} للآلات ذات القيمة الحديثة فقط"""
+        if self.ttl <= 0:
+            return {}
+        now = time.monotonic()
+        out = {}
+        with self._lock:
+            for name in names:
+                payload = self._fresh(name, now)
+                if payload is not None:
+                    out[name] = payload
+            self._counters["hits"] += len(out)
+            self._counters["misses"] += len(names) - len(out)
+        return out
+
+    def generation(self):
+        return self._gen
+
+    def put(self, name, payload, generation=None):
+        """تخزين رد جُلب خارج get (مثلًا status_bulk)؛ يُتجاهل إن تغيّر الجيل منذ بدء الجلب"""
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generation is None or generation == self._gen:
+                self._store(name, payload, time.monotonic())
+
+    def update(self, name, **fields):
+        """دفع من الـ webhook: دمج الحقول الجديدة مع المخزّن (أو تخزينها إن وُجدت الحالة)"""
+        if self.ttl <= 0:
+            return
+        fields = {k: v for k, v in fields.items() if v is not None}
+        with self._lock:
+            self._gen += 1
+            entry = self._items.get(name)
+            if entry is not None:
+                payload = {**entry[1], **fields}
+            elif fields.get("status"):
+                payload = {"ok": True, **fields}
+            else:
+                return
+            self._store(name, payload, time.monotonic())
+            self._counters["pushes"] += 1
+
+    def invalidate(self, name):
+        with self._lock:
+            self._gen += 1
+            self._items.pop(name, None)
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._counters)
+            out["size"] = len(self._items)
+        return out
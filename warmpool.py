@@ -0,0 +1,124 @@
+import logging, secrets, threading, time
+
+import config
+from db import pool_counts, claim_pooled_vm, insert_vm, transaction
+from hosts import PlacementError
+
+log = logging.getLogger("dz.pool")
+
+
+def parse_profiles(text):
+    """"4096:2:25600=3,..." → {(4096, 2, 25600): 3}"""
+    out = {}
+    for part in (text or "").split(","):
+        spec, _, count = part.partition("=")
+        if not spec.strip():
+            continue
+        mem, cpus, disk = (int(x) for x in spec.strip().split(":"))
+        out[(mem, cpus, disk)] = int(count or 1)
+    return out
+
+
+class WarmPool:
+    """
+    ⚡ مخزون آلات مستنسخة وموقوفة لكل ملف موارد (WARM_POOL)
+    - claim: يحوّل آلة جاهزة لآلة زبون في معاملة واحدة (ثوانٍ بدل دقائق)
+    - المُعبّئ (في القائد فقط) يستنسخ آلة واحدة كل WARM_POOL_REFILL_SECONDS على الأكثر
+    الاستنساخ نفسه مهمة "pool_fill" في طابور المهام.
+    """
+
+    def __init__(self, host_registry, job_queue, profiles=None):
+        self.hosts = host_registry
+        self.jobs = job_queue
+        self.profiles = parse_profiles(config.WARM_POOL) if profiles is None else profiles
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "fills": 0, "fill_skipped": 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ---------- الأخذ ----------
+    def claim(self, memory_mb, cpus, disk_mb, serial, owner, password):
+        """
+        الآلة المأخوذة {"name", "previous_password", "renew_days"} أو None (ملف غير مُعرَّف أو المخزون فارغ)
+        بعدها يجب إرسال مهمة pool_handover (مزامنة كلمة المرور والمالك والانتهاء مع الـ Agent ثم التشغيل)
+        """
+        key = (memory_mb, cpus, disk_mb)
+        if key not in self.profiles:
+            return None
+        claimed = claim_pooled_vm(memory_mb, cpus, disk_mb, serial, owner, password)
+        with self._lock:
+            self._counters["hits" if claimed else "misses"] += 1
+        if claimed:
+            log.info("آلة من المخزون الجاهز", extra={"vm": claimed["name"], "profile": "%d:%d:%d" % key})
+        return claimed
+
+    # ---------- التعبئة ----------
+    def refill_once(self):
+        """استنساخ آلة واحدة لأكثر ملف ناقص — يُرجع اسمها أو None"""
+        counts = pool_counts()
+        filling = sum(c["filling"] for c in counts.values())
+        if filling >= config.WARM_POOL_MAX_FILLING:
+            return None
+        gaps = []
+        for key, target in self.profiles.items():
+            c = counts.get(key, {"ready": 0, "filling": 0})
+            missing = target - c["ready"] - c["filling"]
+            if missing > 0:
+                gaps.append((-missing / target, key))
+        if not gaps:
+            return None
+        mem, cpus, disk = min(gaps)[1]
+
+        name = f"Dz_Hosting-{int(time.time())}{secrets.randbelow(1000):03d}"
+        try:
+            with transaction():
+                host = self.hosts.place(mem, cpus, disk)
+                insert_vm(name, secrets.token_hex(8).upper(), None, "Administrator",
+                          secrets.token_urlsafe(10)[:12], "-", "creating", mem, cpus, disk,
+                          host=host, pool="filling")
+        except PlacementError as e:
+            with self._lock:
+                self._counters["fill_skipped"] += 1
+            log.info("لا سعة لتعبئة المخزون", extra={"profile": f"{mem}:{cpus}:{disk}", "error": str(e)})
+            return None
+        self.jobs.submit(name, "pool_fill", memory_mb=mem, cpus=cpus, disk_mb=disk)
+        with self._lock:
+            self._counters["fills"] += 1
+        return name
+
+    def stats(self):
+        counts = pool_counts()
+        with self._lock:
+            out = dict(self._counters)
+        lookups = out["hits"] + out["misses"]
+        out["hit_rate"] = round(out["hits"] / lookups, 3) if lookups else None
+        out["profiles"] = [
+            {"memory_mb": k[0], "cpus": k[1], "disk_mb": k[2], "target": target,
+             **counts.get(k, {"ready": 0, "filling": 0})}
+            for k, target in self.profiles.items()
+        ]
+        return out
+
+    # ---------- التشغيل ----------
+    def start(self):
+        if not self.profiles:
+            return
+        if self._thread and self._thread.is_alive():
+            if not self._stop.is_set():
+                return
+            self._thread.join()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="warm-pool", daemon=True)
+        self._thread.start()
+        log.info("تم تشغيل مُعبّئ المخزون الجاهز", extra={"profiles": len(self.profiles)})
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refill_once()
+            except Exception:
+                log.exception("خطأ في تعبئة المخزون")
+            self._stop.wait(config.WARM_POOL_REFILL_SECONDS)
@@ -0,0 +1,98 @@
+import logging, threading
+
+import config
+
+log = logging.getLogger("dz.webhook")
+
+
+class WriteBehindBuffer:
+    """
+    📝 مخزن كتابة مؤجلة لتحديثات الـ webhook
+    - يدمج التحديثات لكل آلة (آخر قيمة لكل حقل)
+    - يكتبها دفعة واحدة في معاملة عند امتلاء الدفعة أو مرور الفترة
+    - يرفض الجديد عند الامتلاء (الـ webhook يرد 429) ويُفرغ نفسه عند الإيقاف
+    flush_fn: fn([(name, {field: value}), ...])
+    """
+
+    def __init__(self, flush_fn, max_pending=None, batch_size=None, interval=None):
+        self.flush_fn = flush_fn
+        self.max_pending = max_pending or config.WEBHOOK_BUFFER_MAX
+        self.batch_size = batch_size or config.WEBHOOK_FLUSH_BATCH
+        self.interval = interval or config.WEBHOOK_FLUSH_INTERVAL
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._kick = threading.Event()
+        self._stop = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._counters = {"accepted": 0, "merged": 0, "rejected": 0,
+                          "flushed": 0, "batches": 0, "flush_errors": 0}
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="webhook-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, name, **fields):
+        """False عند الامتلاء (backpressure)"""
+        fields = {k: v for k, v in fields.items() if v is not None}
+        if not fields:
+            return True
+        with self._lock:
+            current = self._pending.get(name)
+            if current is None:
+                if len(self._pending) >= self.max_pending:
+                    self._counters["rejected"] += 1
+                    return False
+                self._pending[name] = fields
+                self._counters["accepted"] += 1
+            else:
+                current.update(fields)
+                self._counters["merged"] += 1
+            full = len(self._pending) >= self.batch_size
+        self.start()
+        if full:
+            self._kick.set()
+        return True
+
+    def flush(self):
+        """كتابة كل المعلّق الآن (يُستدعى من الخيط الخلفي أو عند الإيقاف)"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            try:
+                self.flush_fn(list(batch.items()))
+            except Exception as e:
+                # نعيد الدفعة دون أن نطغى على ما وصل بعدها
+                with self._lock:
+                    for name, fields in batch.items():
+                        newer = self._pending.get(name, {})
+                        self._pending[name] = {**fields, **newer}
+                    self._counters["flush_errors"] += 1
+                log.warning("فشل كتابة دفعة التحديثات", extra={"size": len(batch), "error": str(e)})
+                return 0
+            with self._lock:
+                self._counters["flushed"] += len(batch)
+                self._counters["batches"] += 1
+            return len(batch)
+
+    def close(self):
+        self._stop.set()
+        self._kick.set()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._counters)
+            out["pending"] = len(self._pending)
+        return out
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._kick.wait(self.interval)
+            self._kick.clear()
+            self.flush()